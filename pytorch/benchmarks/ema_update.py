@@ -0,0 +1,55 @@
+"""Time a teacher update with the per-tensor loop and with the fused updater
+
+Run from the pytorch directory, e.g.
+python -m benchmarks.ema_update --arch resnext152 --device cuda
+"""
+
+import argparse
+import copy
+import time
+
+import torch
+
+from mean_teacher import architectures, ema
+
+
+def per_tensor_update(model, ema_model, alpha, global_step):
+    alpha = min(1 - 1 / (global_step + 1), alpha)
+    for ema_param, param in zip(ema_model.parameters(), model.parameters()):
+        ema_param.data.mul_(alpha).add_(param.data, alpha=1 - alpha)
+
+
+def time_per_step(update, steps, device):
+    update(1)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for global_step in range(2, steps + 2):
+        update(global_step)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / steps
+
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--arch', default='cifar_shakeshake26', choices=architectures.__all__)
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+parser.add_argument('--steps', default=100, type=int)
+args = parser.parse_args()
+
+device = torch.device(args.device)
+model = architectures.__dict__[args.arch](num_classes=1000).to(device)
+ema_model = copy.deepcopy(model)
+n_tensors = len(list(model.parameters()))
+
+per_tensor = time_per_step(lambda step: per_tensor_update(model, ema_model, 0.999, step),
+                           args.steps, device)
+print("{} ({} parameter tensors) on {}".format(args.arch, n_tensors, device))
+print("per-tensor loop:        {:8.3f} ms/step".format(1000 * per_tensor))
+for interval in [1, 4]:
+    for buffers in [False, True]:
+        updater = ema.ExponentialMovingAverage(model, ema_model, 0.999,
+                                               interval=interval, buffers=buffers)
+        fused = time_per_step(updater.update, args.steps, device)
+        print("fused, interval {}{}: {:8.3f} ms/step ({:.1f}x)".format(
+            interval, ", buffers" if buffers else "         ", 1000 * fused, per_tensor / fused))
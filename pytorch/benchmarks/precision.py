@@ -0,0 +1,59 @@
+"""Compare the throughput and accuracy of a short run in fp32 and in bf16
+
+Takes the arguments of main.py (except --precision), e.g. for CIFAR-10 on
+the CPU, from the pytorch directory:
+
+python -m benchmarks.precision --device cpu --dataset cifar10_packed \\
+    --labels data-local/labels/cifar10/4000_balanced_labels/00.txt \\
+    --arch cifar_shakeshake26 --consistency 100.0 --consistency-rampup 5 \\
+    --labeled-batch-size 62 --epochs 2 --lr-rampdown-epochs 210
+"""
+
+import copy
+import sys
+import time
+
+import torch
+import torch.nn as nn
+
+import main
+from mean_teacher import architectures, backend, cli, datasets, ema
+
+
+def run(precision, argv):
+    torch.manual_seed(0)
+    main.args = args = cli.create_parser().parse_args(argv + ['--precision', precision])
+    main.device = device = backend.select_device(args.device)
+    main.global_step = 0
+
+    dataset_config = datasets.__dict__[args.dataset](batch_augmentation=args.batch_augmentation)
+    num_classes = dataset_config.pop('num_classes')
+    train_loader, eval_loader = main.create_data_loaders(**dataset_config, args=args)
+
+    model = architectures.__dict__[args.arch](num_classes=num_classes)
+    model = nn.DataParallel(model).to(device)
+    ema_model = copy.deepcopy(model)
+    for param in ema_model.parameters():
+        param.detach_()
+    ema_updater = ema.ExponentialMovingAverage(model, ema_model, args.ema_decay)
+    optimizer = torch.optim.SGD(model.parameters(), args.lr,
+                                momentum=args.momentum,
+                                weight_decay=args.weight_decay,
+                                nesterov=args.nesterov)
+
+    train_time = 0
+    for epoch in range(args.epochs):
+        start_time = time.time()
+        main.train(train_loader, model, ema_model, ema_updater, optimizer, epoch, log=None)
+        train_time += time.time() - start_time
+    images = args.epochs * len(train_loader) * args.batch_size
+    prec1 = main.validate(eval_loader, {'primary': (model, None), 'EMA': (ema_model, None)},
+                          main.global_step, args.epochs)
+    return images / train_time, prec1['primary'], prec1['EMA']
+
+
+if __name__ == '__main__':
+    results = {precision: run(precision, sys.argv[1:]) for precision in ['fp32', 'bf16']}
+    print("precision   images/s   Prec@1   EMA Prec@1")
+    for precision, (throughput, prec1, ema_prec1) in results.items():
+        print("{:<9} {:>10.1f} {:>8.2f} {:>12.2f}".format(precision, throughput, prec1, ema_prec1))
@@ -0,0 +1,83 @@
+"""Time the forward and backward passes of shake and of the original implementation
+
+Run from the pytorch directory, e.g.
+python -m benchmarks.shake --device cuda
+"""
+
+import argparse
+import itertools
+import time
+
+import torch
+from torch.autograd import Variable, Function
+
+from mean_teacher import architectures
+
+
+class OriginalShake(Function):
+    @classmethod
+    def forward(cls, ctx, inp1, inp2, training):
+        assert inp1.size() == inp2.size()
+        gate_size = [inp1.size()[0], *itertools.repeat(1, inp1.dim() - 1)]
+        gate = inp1.new(*gate_size)
+        if training:
+            gate.uniform_(0, 1)
+        else:
+            gate.fill_(0.5)
+        return inp1 * gate + inp2 * (1. - gate)
+
+    @classmethod
+    def backward(cls, ctx, grad_output):
+        grad_inp1 = grad_inp2 = grad_training = None
+        gate_size = [grad_output.size()[0], *itertools.repeat(1,
+                                                              grad_output.dim() - 1)]
+        gate = Variable(grad_output.data.new(*gate_size).uniform_(0, 1))
+        if ctx.needs_input_grad[0]:
+            grad_inp1 = grad_output * gate
+        if ctx.needs_input_grad[1]:
+            grad_inp2 = grad_output * (1 - gate)
+        assert not ctx.needs_input_grad[2]
+        return grad_inp1, grad_inp2, grad_training
+
+
+def original_shake(inp1, inp2, training=False):
+    return OriginalShake.apply(inp1, inp2, training)
+
+
+def time_per_step(shake_function, inp1, inp2, grad_output, steps, device):
+    def step():
+        output = shake_function(inp1, inp2, training=True)
+        output.backward(grad_output)
+
+    step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / steps
+
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+parser.add_argument('--batch-size', default=128, type=int)
+parser.add_argument('--channels', default=96, type=int)
+parser.add_argument('--size', default=32, type=int)
+parser.add_argument('--steps', default=50, type=int)
+args = parser.parse_args()
+
+device = torch.device(args.device)
+shape = (args.batch_size, args.channels, args.size, args.size)
+inp1 = torch.randn(shape, device=device, requires_grad=True)
+inp2 = torch.randn(shape, device=device, requires_grad=True)
+grad_output = torch.randn(shape, device=device)
+
+print("shake of {} on {}".format('x'.join(map(str, shape)), device))
+original = time_per_step(original_shake, inp1, inp2, grad_output, args.steps, device)
+print("original:  {:8.3f} ms/step".format(1000 * original))
+for name, shake_function in [('shake', architectures.shake),
+                             ('traceable', architectures.traceable_shake)]:
+    seconds = time_per_step(shake_function, inp1, inp2, grad_output, args.steps, device)
+    print("{:10} {:8.3f} ms/step ({:.2f}x)".format(name + ':', 1000 * seconds, original / seconds))
@@ -0,0 +1,18 @@
+"""Write a checkpoint as a memory-mapped checkpoint, for fast loading
+
+Usage: python convert_checkpoint.py CHECKPOINT OUTPUT
+
+CHECKPOINT can be any checkpoint of main.py, also of a --checkpoint-store.
+main.py --resume and generate_predictions.py read OUTPUT like any other
+checkpoint, but only read the parts they need.
+"""
+
+import sys
+
+from mean_teacher import checkpoints
+
+
+if __name__ == '__main__':
+    input_path, output_path = sys.argv[1:]
+    checkpoints.save_mapped_checkpoint(checkpoints.load_checkpoint(input_path, map_location='cpu'), output_path)
+    print("Wrote {} to {}".format(input_path, output_path))
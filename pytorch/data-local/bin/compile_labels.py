@@ -0,0 +1,27 @@
+"""Compile label files into the label splits read by mean_teacher.data.load_label_split
+
+Usage: compile_labels.py DATADIR LABEL_FILE...
+
+Relabels the dataset in DATADIR (a packed dataset or an image folder)
+with each label file, e.g. labels/cifar10/1000_balanced_labels/00.txt,
+and writes its labeled and unlabeled indices next to the label file.
+Training compiles missing splits itself, but compiling them up front
+keeps the text parsing and matching out of the job start.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from mean_teacher import data, folders
+
+
+datadir = sys.argv[1]
+dataset = folders.image_folder(datadir)
+fingerprint = data.dataset_fingerprint(dataset)
+
+for labels_path in sys.argv[2:]:
+    labeled_idxs, unlabeled_idxs = data.compile_label_split(dataset, labels_path)
+    print("Compiled {} ({} labeled, {} unlabeled) to {}".format(
+        labels_path, len(labeled_idxs), len(unlabeled_idxs),
+        data.label_split_path(labels_path, fingerprint)))
@@ -0,0 +1,67 @@
+"""Pack CIFAR-10 into memory-mapped arrays read by mean_teacher.folders.PackedImageFolder
+
+Writes the train+val and test sets from the CIFAR pickles, and the train
+and val subsets listed in link_cifar10_train.sh and link_cifar10_val.sh.
+The images get the same file names as in the by-image directory, so the
+label files work with both.
+"""
+
+import re
+import os
+import pickle
+import sys
+
+from torchvision.datasets import CIFAR10
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from mean_teacher.folders import write_packed
+
+
+bin_dir = os.path.dirname(os.path.abspath(__file__))
+work_dir = os.path.abspath(sys.argv[1])
+target_dir = os.path.abspath(sys.argv[2])
+
+cifar10 = CIFAR10(work_dir, download=True)
+
+
+def load_file(file_name):
+    with open(os.path.join(work_dir, cifar10.base_folder, file_name), 'rb') as meta_f:
+        return pickle.load(meta_f, encoding="latin1")
+
+
+def load_data_files(file_list):
+    images, labels = [], []
+    for source_file_path, _ in file_list:
+        data = load_file(source_file_path)
+        images.append(data['data'].reshape(-1, 3, 32, 32).transpose(0, 2, 3, 1))
+        labels.extend(data['labels'])
+    images = np.concatenate(images)
+    labels = np.array(labels, dtype=np.int64)
+    filenames = ["{}_{}.png".format(idx, label_names[label_idx])
+                 for idx, label_idx in enumerate(labels)]
+    return images, labels, filenames
+
+
+def linked_filenames(link_script):
+    with open(os.path.join(bin_dir, link_script)) as f:
+        return {match.group(1) for match in re.finditer(r"^ln -s \S+ [^/\s]+/[^/\s]+/(\S+)$", f.read(), re.MULTILINE)}
+
+
+def pack(name, images, labels, filenames):
+    print("Packing {} images to {}".format(len(images), os.path.join(target_dir, name)))
+    write_packed(os.path.join(target_dir, name), images, labels, filenames, label_names)
+
+
+label_names = load_file('batches.meta')['label_names']
+print("Found {} label names: {}".format(len(label_names), ", ".join(label_names)))
+
+pack('test', *load_data_files(cifar10.test_list))
+
+images, labels, filenames = load_data_files(cifar10.train_list)
+pack('train+val', images, labels, filenames)
+for subset, link_script in [('train', 'link_cifar10_train.sh'), ('val', 'link_cifar10_val.sh')]:
+    names = linked_filenames(link_script)
+    idxs = [idx for idx, filename in enumerate(filenames) if filename in names]
+    assert len(idxs) == len(names)
+    pack(subset, images[idxs], labels[idxs], [filenames[idx] for idx in idxs])
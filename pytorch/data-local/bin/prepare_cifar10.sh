@@ -17,3 +17,6 @@ echo "Linking validation set"
     cd $DIR/../images/cifar/cifar10/by-image/
     bash $DIR/link_cifar10_val.sh
 )
+
+echo "Packing CIFAR-10 into memory-mapped arrays"
+python $DIR/pack_cifar10.py $DIR/../workdir $DIR/../images/cifar/cifar10/packed/
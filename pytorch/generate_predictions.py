@@ -5,7 +5,7 @@ import os
 from torch.utils.data.sampler import BatchSampler
 import time
 
-from mean_teacher import architectures, datasets, cli
+from mean_teacher import architectures, backend, checkpoints, datasets, metrics, cli
 from mean_teacher.data import NO_LABEL
 from mean_teacher.utils import *
 
@@ -29,7 +29,7 @@ def create_model(arch, num_classes, word_vocab_embed, word_vocab_size,
     model_params['update_pretrained_wordemb'] = False
 
     model = model_factory(**model_params)
-    model = model.cpu()  # nn.DataParallel(model).cpu() .. # NOTE: Disabling data parallelism
+    model = model.to(device)  # nn.DataParallel(model).cpu() .. # NOTE: Disabling data parallelism
 
     if ema:
         for param in model.parameters():
@@ -44,19 +44,19 @@ def generate_prediction_minibatch(min_batch_id, mini_batch_outputs, dataset, bat
     softmax = nn.Softmax(dim=1)
     scores = softmax(mini_batch_outputs)
     res_max = torch.max(scores, dim=1)
-    results = list(zip(res_max[0].data, res_max[1].data))
+    results = list(zip(res_max[0].tolist(), res_max[1].tolist()))
 
     for idx, (max_value, predictionId) in enumerate(results):
         dataset_id = (min_batch_id * batch_size) + idx
         mention_str = dataset.entity_vocab.get_word(dataset.mentions[dataset_id])
         gold_label = dataset.labels_str[dataset_id]
-        min_batch_predictions_gold.append((mention_str, gold_label, category_labels[predictionId], max_value, list(scores[idx].data)))
+        min_batch_predictions_gold.append((mention_str, gold_label, category_labels[predictionId], max_value, scores[idx].tolist()))
 
     return min_batch_predictions_gold
 
 
 def predict_validate(eval_loader, model, model_type, arch, dataset, batch_size, result_filename):
-    class_criterion = nn.CrossEntropyLoss(size_average=False, ignore_index=NO_LABEL).cpu()
+    class_criterion = nn.CrossEntropyLoss(size_average=False, ignore_index=NO_LABEL).to(device)
     meters = AverageMeterSet()
 
     category_labels = dict(enumerate(sorted(list({l for l in dataset.labels_str}))))
@@ -74,9 +74,9 @@ def predict_validate(eval_loader, model, model_type, arch, dataset, batch_size,
             patterns = datapoint[0][1]
             target = datapoint[1]
 
-            entity_var = torch.autograd.Variable(entity, volatile=True).cpu()
-            patterns_var = torch.autograd.Variable(patterns, volatile=True).cpu()
-        
+            entity_var = entity.to(device)
+            patterns_var = patterns.to(device)
+
         elif args.dataset in ['riedel']:
             inputs = datapoint[0]
             target = datapoint[1]
@@ -85,48 +85,47 @@ def predict_validate(eval_loader, model, model_type, arch, dataset, batch_size,
             input_entity2 = inputs[1]
             input_inbetween_chunk = inputs[2]
 
-            entity1_var = torch.autograd.Variable(input_entity1, volatile=True).cpu()
-            entity2_var = torch.autograd.Variable(input_entity2, volatile=True).cpu()
-            inbetween_chunk_var = torch.autograd.Variable(input_inbetween_chunk, volatile=True).cpu()
+            entity1_var = input_entity1.to(device)
+            entity2_var = input_entity2.to(device)
+            inbetween_chunk_var = input_inbetween_chunk.to(device)
 
-        target_var = torch.autograd.Variable(target.cpu(), volatile=True)
+        target_var = target.to(device)
 
         minibatch_size = len(target_var)
-        labeled_minibatch_size = target_var.data.ne(NO_LABEL).sum()
+        labeled_minibatch_size = target_var.ne(NO_LABEL).sum()
         meters.update('labeled_minibatch_size', labeled_minibatch_size)
 
         # compute output
-
-        if arch == "custom_embed":
-            output1, entity_custom_embed, pattern_custom_embed = model(entity_var, patterns_var)
-        elif args.dataset in ['riedel'] and args.arch == 'simple_MLP_embed_RE':
-            output1 = model(entity1_var, entity2_var, inbetween_chunk_var)
-        else:
-            output1 = model(entity_var, patterns_var)
+        with torch.no_grad():
+            if arch == "custom_embed":
+                output1, entity_custom_embed, pattern_custom_embed = model(entity_var, patterns_var)
+            elif args.dataset in ['riedel'] and args.arch == 'simple_MLP_embed_RE':
+                output1 = model(entity1_var, entity2_var, inbetween_chunk_var)
+            else:
+                output1 = model(entity_var, patterns_var)
 
         entity_prediction_gold_list += generate_prediction_minibatch(i, output1, dataset, batch_size, category_labels)
 
         class_loss = class_criterion(output1, target_var) / minibatch_size
 
         # measure accuracy and record loss
-        prec1, prec2 = accuracy(output1.data, target_var.data, topk=(1, 2)) #Note: Ajay changing this to 2 .. since there are only 4 labels in CoNLL dataset
-        meters.update('class_loss', class_loss.data[0], labeled_minibatch_size)
-        meters.update('top1', prec1[0], labeled_minibatch_size)
-        meters.update('error1', 100.0 - prec1[0], labeled_minibatch_size)
-        meters.update('top2', prec2[0], labeled_minibatch_size)
-        meters.update('error2', 100.0 - prec2[0], labeled_minibatch_size)
+        precisions = metrics.topk_precisions(output1, target_var, topk=(1, 2)) #Note: Ajay changing this to 2 .. since there are only 4 labels in CoNLL dataset
+        meters.update('class_loss', class_loss, labeled_minibatch_size)
+        meters.update_many(metrics.precision_names(topk=(1, 2)), precisions, labeled_minibatch_size)
 
         # measure elapsed time
         meters.update('batch_time', time.time() - end)
         end = time.time()
 
         if i % args.print_freq == 0:
+            meters.synchronize()
             print(
                 'Test: [{0}/{1}]\t'
                 'ClassLoss {meters[class_loss]:.4f}\t'
                 'Prec@1 {meters[top1]:.3f}'.format(
                     i, len(eval_loader), meters=meters))
 
+    meters.synchronize()
     print(' * Prec@1 {top1.avg:.3f}\tClassLoss {class_loss.avg:.3f}'
           .format(top1=meters['top1'], class_loss=meters['class_loss']))
 
@@ -141,26 +140,12 @@ def predict_validate(eval_loader, model, model_type, arch, dataset, batch_size,
     return meters['top1'].avg
 
 
-def accuracy(output, target, topk=(1,)):
-    """Computes the precision@k for the specified values of k"""
-    maxk = max(topk)
-    labeled_minibatch_size = max(target.ne(NO_LABEL).sum(), 1e-8)
-
-    _, pred = output.topk(maxk, 1, True, True)
-    pred = pred.t()
-    correct = pred.eq(target.view(1, -1).expand_as(pred))
-
-    res = []
-    for k in topk:
-        correct_k = correct[:k].view(-1).float().sum(0, keepdim=True)
-        res.append(correct_k.mul_(100.0 / labeled_minibatch_size))
-    return res
-
-
 def create_data_loaders(train_transformation,
                         eval_transformation,
                         datadir,
-                        args):
+                        args,
+                        train_batch_transformation=None,
+                        train_reflect_padding=0):
 
     evaldir = os.path.join(datadir, args.eval_subdir)  # NOTE: test data is the same as train data. To load the word_vectors using the train_subdir
     print("evaldir : " + evaldir)
@@ -201,7 +186,8 @@ if __name__ == '__main__':
     batch_size = 64
 
     # 2. Initialize the configuration
-    ckpt = torch.load(ckpt_file)
+    # Without the optimizer state, which is not even read from memory-mapped checkpoints
+    ckpt = checkpoints.load_checkpoint(ckpt_file, map_location='cpu', keys=['arch', 'state_dict', 'ema_state_dict'])
     arch = ckpt['arch']
     parser = cli.create_parser()
     parser.set_defaults(dataset=dataset_name,
@@ -212,6 +198,12 @@ if __name__ == '__main__':
                         word_noise='drop:1',
                         batch_size=batch_size)
     args = parser.parse_known_args()[0]
+    device = backend.select_device(args.device)
+    if device.type == 'cpu':
+        backend.configure_cpu_backend(intra_op_threads=args.intra_op_threads,
+                                      inter_op_threads=args.inter_op_threads,
+                                      mkldnn=args.mkldnn,
+                                      pin_threads=args.pin_threads)
 
     # 3. Load the eval data
     dataset_config = datasets.__dict__[args.dataset]()
@@ -1,7 +1,6 @@
 import re
 import argparse
 import os
-import shutil
 import time
 import math
 import logging
@@ -12,11 +11,12 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.backends.cudnn as cudnn
 from torch.autograd import Variable
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import DataLoader
 from torch.utils.data.sampler import BatchSampler, SubsetRandomSampler
-import torchvision.datasets
 
-from mean_teacher import architectures, datasets, data, losses, ramps, cli
+from mean_teacher import (architectures, backend, batch_transforms, checkpoints, datasets, data,
+                          distributed, ema, eval_cache, folders, losses, metrics, ramps, cli)
 from mean_teacher.run_context import RunContext
 from mean_teacher.data import NO_LABEL
 from mean_teacher.utils import *
@@ -25,20 +25,63 @@ from mean_teacher.utils import *
 LOG = logging.getLogger('main')
 
 args = None
+device = None
 best_prec1 = 0
 global_step = 0
 
 
 def main(context):
+    if args.compile:
+        backend.configure_compile_cache(args.compile_cache_dir)
+    if args.world_size > 1:
+        assert not args.pin_threads, "--pin-threads is not supported with --world-size > 1"
+        dist_url = distributed.free_local_url() if args.dist_url == 'auto' else args.dist_url
+        torch.multiprocessing.spawn(distributed_main, args=(args, context, dist_url),
+                                    nprocs=args.world_size)
+    else:
+        main_worker(context)
+
+
+def distributed_main(rank, run_args, context, dist_url):
+    global args
+    args = run_args
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    try:
+        main_worker(context, rank, dist_url)
+    finally:
+        if torch.distributed.is_initialized():
+            torch.distributed.destroy_process_group()
+
+
+def main_worker(context, rank=None, dist_url=None):
     global global_step
     global best_prec1
+    global device
+
+    device = backend.select_device(args.device)
+    if rank is not None:
+        device = distributed.init_process_group(rank, args.world_size, device,
+                                                backend=args.dist_backend, url=dist_url,
+                                                timeout_minutes=args.dist_timeout)
+    if device.type == 'cpu':
+        intra_op_threads = args.intra_op_threads
+        if intra_op_threads is None and args.world_size > 1:
+            # Share the cores between the processes
+            intra_op_threads = max(os.cpu_count() // args.world_size, 1)
+        backend.configure_cpu_backend(intra_op_threads=intra_op_threads,
+                                      inter_op_threads=args.inter_op_threads,
+                                      mkldnn=args.mkldnn,
+                                      pin_threads=args.pin_threads)
 
     checkpoint_path = context.transient_dir
-    training_log = context.create_train_log("training")
-    validation_log = context.create_train_log("validation")
-    ema_validation_log = context.create_train_log("ema_validation")
+    if distributed.is_main_process():
+        training_log = context.create_train_log("training")
+        validation_log = context.create_train_log("validation")
+        ema_validation_log = context.create_train_log("ema_validation")
+    else:
+        training_log = validation_log = ema_validation_log = None
 
-    dataset_config = datasets.__dict__[args.dataset]()
+    dataset_config = datasets.__dict__[args.dataset](batch_augmentation=args.batch_augmentation)
     num_classes = dataset_config.pop('num_classes')
     train_loader, eval_loader = create_data_loaders(**dataset_config, args=args)
 
@@ -51,7 +94,24 @@ def main(context):
         model_factory = architectures.__dict__[args.arch]
         model_params = dict(pretrained=args.pretrained, num_classes=num_classes)
         model = model_factory(**model_params)
-        model = nn.DataParallel(model).cuda()
+        if args.activation_checkpointing and not ema:
+            architectures.set_activation_checkpointing(model, args.activation_checkpointing)
+        if args.compile:
+            architectures.compile_model(model)
+        if not distributed.is_distributed():
+            model = nn.DataParallel(model).to(device)
+        elif ema:
+            # Every process keeps an identical copy of the teacher parameters,
+            # since the student parameters are in sync. The BatchNorm statistics
+            # follow the shards of the processes and are averaged with
+            # distributed.average_buffers before they are saved or evaluated.
+            # The wrapper keeps the checkpoint keys.
+            device_ids = [device] if device.type == 'cuda' else None
+            model = nn.DataParallel(model.to(device), device_ids=device_ids)
+        else:
+            device_ids = [device] if device.type == 'cuda' else None
+            model = DistributedDataParallel(model.to(device), device_ids=device_ids,
+                                            find_unused_parameters=args.logit_distance_cost < 0)
 
         if ema:
             for param in model.parameters():
@@ -64,61 +124,124 @@ def main(context):
 
     LOG.info(parameters_string(model))
 
+    ema_updater = ema.ExponentialMovingAverage(model, ema_model, args.ema_decay,
+                                               interval=args.ema_update_interval,
+                                               buffers=args.ema_buffers)
+
     optimizer = torch.optim.SGD(model.parameters(), args.lr,
                                 momentum=args.momentum,
                                 weight_decay=args.weight_decay,
                                 nesterov=args.nesterov)
 
+    def checkpoint_state(epoch):
+        return {
+            'epoch': epoch,
+            'global_step': global_step,
+            'arch': args.arch,
+            'state_dict': model.state_dict(),
+            'ema_state_dict': ema_model.state_dict(),
+            'best_prec1': best_prec1,
+            'optimizer' : optimizer.state_dict(),
+        }
+
+    def save_step_checkpoint(epoch, step_in_epoch, meters):
+        distributed.average_buffers(ema_model)
+        # Every process continues its own random streams after a resume
+        states = distributed.all_gather_object(random_states())
+        if distributed.is_main_process():
+            save_checkpoint(checkpoint_writer, {
+                **checkpoint_state(epoch),
+                'step_in_epoch': step_in_epoch,
+                'sampler': train_loader.batch_sampler.state_dict(cursor=step_in_epoch),
+                'random_states': states,
+                'meters': meters.state_dict(),
+            }, False, checkpoint_path, 'latest')
+
+    if args.checkpoint_steps:
+        assert isinstance(train_loader.batch_sampler, data.TwoStreamBatchSampler), \
+            "--checkpoint-steps needs --labeled-batch-size"
+
     # optionally resume from a checkpoint
+    resume_step = None
     if args.resume:
         assert os.path.isfile(args.resume), "=> no checkpoint found at '{}'".format(args.resume)
         LOG.info("=> loading checkpoint '{}'".format(args.resume))
-        checkpoint = torch.load(args.resume)
+        checkpoint = checkpoints.load_checkpoint(args.resume, map_location=device)
         args.start_epoch = checkpoint['epoch']
         global_step = checkpoint['global_step']
         best_prec1 = checkpoint['best_prec1']
         model.load_state_dict(checkpoint['state_dict'])
         ema_model.load_state_dict(checkpoint['ema_state_dict'])
         optimizer.load_state_dict(checkpoint['optimizer'])
-        LOG.info("=> loaded checkpoint '{}' (epoch {})".format(args.resume, checkpoint['epoch']))
+        if checkpoint.get('step_in_epoch'):
+            # Without it the workers draw other augmentations
+            assert args.checkpoint_steps, "resuming in the middle of an epoch needs --checkpoint-steps"
+            assert len(checkpoint['random_states']) == args.world_size, \
+                "resuming in the middle of an epoch needs the same --world-size"
+            train_loader.batch_sampler.load_state_dict(checkpoint['sampler'])
+            resume_step = {
+                'step_in_epoch': checkpoint['step_in_epoch'],
+                'random_states': checkpoint['random_states'][distributed.rank()],
+                'meters': checkpoint['meters'],
+            }
+            LOG.info("=> loaded checkpoint '{}' (epoch {}, step {})".format(
+                args.resume, checkpoint['epoch'], checkpoint['step_in_epoch']))
+        else:
+            LOG.info("=> loaded checkpoint '{}' (epoch {})".format(args.resume, checkpoint['epoch']))
 
     cudnn.benchmark = True
 
+    # Only the main process evaluates, so without the collective ops of
+    # DistributedDataParallel
+    eval_model = model.module if distributed.is_distributed() else model
+
     if args.evaluate:
-        LOG.info("Evaluating the primary model:")
-        validate(eval_loader, model, validation_log, global_step, args.start_epoch)
-        LOG.info("Evaluating the EMA model:")
-        validate(eval_loader, ema_model, ema_validation_log, global_step, args.start_epoch)
+        if distributed.is_main_process():
+            LOG.info("Evaluating the primary and the EMA model:")
+            validate(eval_loader, {'primary': (eval_model, validation_log), 'EMA': (ema_model, ema_validation_log)},
+                     global_step, args.start_epoch)
         return
 
-    for epoch in range(args.start_epoch, args.epochs):
-        start_time = time.time()
-        # train for one epoch
-        train(train_loader, model, ema_model, optimizer, epoch, training_log)
-        LOG.info("--- training epoch in %s seconds ---" % (time.time() - start_time))
-
-        if args.evaluation_epochs and (epoch + 1) % args.evaluation_epochs == 0:
+    # The checkpoints are written on a background thread, all of them by
+    # the end of the block
+    with create_checkpoint_writer() as checkpoint_writer:
+        for epoch in range(args.start_epoch, args.epochs):
             start_time = time.time()
-            LOG.info("Evaluating the primary model:")
-            prec1 = validate(eval_loader, model, validation_log, global_step, epoch + 1)
-            LOG.info("Evaluating the EMA model:")
-            ema_prec1 = validate(eval_loader, ema_model, ema_validation_log, global_step, epoch + 1)
-            LOG.info("--- validation in %s seconds ---" % (time.time() - start_time))
-            is_best = ema_prec1 > best_prec1
-            best_prec1 = max(ema_prec1, best_prec1)
-        else:
-            is_best = False
-
-        if args.checkpoint_epochs and (epoch + 1) % args.checkpoint_epochs == 0:
-            save_checkpoint({
-                'epoch': epoch + 1,
-                'global_step': global_step,
-                'arch': args.arch,
-                'state_dict': model.state_dict(),
-                'ema_state_dict': ema_model.state_dict(),
-                'best_prec1': best_prec1,
-                'optimizer' : optimizer.state_dict(),
-            }, is_best, checkpoint_path, epoch + 1)
+            # train for one epoch
+            train(train_loader, model, ema_model, ema_updater, optimizer, epoch, training_log,
+                  resume_step=resume_step, save_step_checkpoint=save_step_checkpoint)
+            resume_step = None
+            distributed.average_buffers(ema_model)
+            epoch_time = time.time() - start_time
+            LOG.info("--- training epoch in %s seconds (%.1f images/s) ---" % (
+                epoch_time, len(train_loader) * args.batch_size / epoch_time))
+
+            if not distributed.is_main_process():
+                distributed.barrier()
+                continue
+
+            if args.evaluation_epochs and (epoch + 1) % args.evaluation_epochs == 0:
+                start_time = time.time()
+                LOG.info("Evaluating the primary and the EMA model:")
+                ema_prec1 = validate(eval_loader, {'primary': (eval_model, validation_log),
+                                                   'EMA': (ema_model, ema_validation_log)},
+                                     global_step, epoch + 1)['EMA']
+                LOG.info("--- validation in %s seconds ---" % (time.time() - start_time))
+                is_best = ema_prec1 > best_prec1
+                best_prec1 = max(ema_prec1, best_prec1)
+            else:
+                is_best = False
+
+            if args.checkpoint_epochs and (epoch + 1) % args.checkpoint_epochs == 0:
+                save_checkpoint(checkpoint_writer, checkpoint_state(epoch + 1), is_best,
+                                checkpoint_path, epoch + 1)
+            elif args.checkpoint_steps and global_step % args.checkpoint_steps == 0:
+                # The last step of the epoch was skipped by train, so that
+                # checkpoint.latest.ckpt holds the evaluated epoch
+                save_checkpoint(checkpoint_writer, checkpoint_state(epoch + 1), False,
+                                checkpoint_path, 'latest')
+
+            distributed.barrier()
 
 
 def parse_dict_args(**kwargs):
@@ -141,20 +264,32 @@ def parse_dict_args(**kwargs):
 def create_data_loaders(train_transformation,
                         eval_transformation,
                         datadir,
-                        args):
+                        args,
+                        train_batch_transformation=None,
+                        train_reflect_padding=0):
     traindir = os.path.join(datadir, args.train_subdir)
     evaldir = os.path.join(datadir, args.eval_subdir)
 
     assert_exactly_one([args.exclude_unlabeled, args.labeled_batch_size])
 
-    dataset = torchvision.datasets.ImageFolder(traindir, train_transformation)
+    dataset = folders.image_folder(traindir, train_transformation,
+                                   reflect_padding=train_reflect_padding)
 
     if args.labels:
-        with open(args.labels) as f:
-            labels = dict(line.split(' ') for line in f.read().splitlines())
-        labeled_idxs, unlabeled_idxs = data.relabel_dataset(dataset, labels)
-
-    if args.exclude_unlabeled:
+        labeled_idxs, unlabeled_idxs = data.load_label_split(dataset, args.labels)
+    if args.checkpoint_steps:
+        # To get the same augmentations after resuming in the middle of an epoch
+        dataset = data.BatchSeededDataset(dataset)
+
+    if distributed.is_distributed():
+        assert not args.exclude_unlabeled, "--exclude-unlabeled is not supported with --world-size > 1"
+        assert args.batch_size % args.world_size == 0
+        assert args.labeled_batch_size % args.world_size == 0
+        # The batch sizes are those of all processes together
+        batch_sampler = distributed.DistributedTwoStreamBatchSampler(
+            unlabeled_idxs, labeled_idxs,
+            args.batch_size // args.world_size, args.labeled_batch_size // args.world_size)
+    elif args.exclude_unlabeled:
         sampler = SubsetRandomSampler(labeled_idxs)
         batch_sampler = BatchSampler(sampler, args.batch_size, drop_last=True)
     elif args.labeled_batch_size:
@@ -163,66 +298,90 @@ def create_data_loaders(train_transformation,
     else:
         assert False, "labeled batch size {}".format(args.labeled_batch_size)
 
+    pin_memory = device.type == 'cuda'
+    worker_init_fn = backend.pin_worker_threads if args.pin_threads else None
+
     train_loader = torch.utils.data.DataLoader(dataset,
                                                batch_sampler=batch_sampler,
                                                num_workers=args.workers,
-                                               pin_memory=True)
-
-    eval_loader = torch.utils.data.DataLoader(
-        torchvision.datasets.ImageFolder(evaldir, eval_transformation),
-        batch_size=args.batch_size,
-        shuffle=False,
-        num_workers=2 * args.workers,  # Needs images twice as fast
-        pin_memory=True,
-        drop_last=False)
+                                               pin_memory=pin_memory,
+                                               worker_init_fn=worker_init_fn)
+    if train_batch_transformation is not None:
+        train_loader = batch_transforms.TransformingLoader(
+            train_loader, train_batch_transformation, device)
+
+    if args.eval_cache_dir:
+        eval_loader = eval_cache.CachingEvalLoader(
+            folders.image_folder(evaldir),
+            eval_transformation,
+            args.eval_cache_dir,
+            batch_size=args.batch_size,
+            device=device,
+            num_workers=2 * args.workers,
+            pin_memory=pin_memory,
+            worker_init_fn=worker_init_fn)
+    else:
+        eval_loader = torch.utils.data.DataLoader(
+            folders.image_folder(evaldir, eval_transformation),
+            batch_size=args.batch_size,
+            shuffle=False,
+            num_workers=2 * args.workers,  # Needs images twice as fast
+            pin_memory=pin_memory,
+            worker_init_fn=worker_init_fn,
+            drop_last=False)
 
     return train_loader, eval_loader
 
 
-def update_ema_variables(model, ema_model, alpha, global_step):
-    # Use the true average until the exponential average is more correct
-    alpha = min(1 - 1 / (global_step + 1), alpha)
-    for ema_param, param in zip(ema_model.parameters(), model.parameters()):
-        ema_param.data.mul_(alpha).add_(1 - alpha, param.data)
-
-
-def train(train_loader, model, ema_model, optimizer, epoch, log):
+def train(train_loader, model, ema_model, ema_updater, optimizer, epoch, log,
+          resume_step=None, save_step_checkpoint=None):
     global global_step
 
-    class_criterion = nn.CrossEntropyLoss(size_average=False, ignore_index=NO_LABEL).cuda()
-    if args.consistency_type == 'mse':
-        consistency_criterion = losses.softmax_mse_loss
-    elif args.consistency_type == 'kl':
-        consistency_criterion = losses.softmax_kl_loss
-    else:
-        assert False, args.consistency_type
-    residual_logit_criterion = losses.symmetric_mse_loss
+    criterion = losses.MeanTeacherLoss(consistency_type=args.consistency_type,
+                                       logit_distance_cost=args.logit_distance_cost,
+                                       ignore_index=NO_LABEL)
+    # Of the student and the EMA logits stacked
+    precision_names = metrics.precision_names() + metrics.precision_names(prefix='ema_')
 
     meters = AverageMeterSet()
+    # Checked when the meters are synchronized, not on every step
+    no_labels = torch.zeros((), dtype=torch.bool, device=device)
+    loss_explosion = torch.zeros((), dtype=torch.bool, device=device)
 
     # switch to train mode
     model.train()
     ema_model.train()
 
+    batches = iter(train_loader)
+    start_step = 0
+    if resume_step is not None:
+        start_step = resume_step['step_in_epoch']
+        meters.load_state_dict(resume_step['meters'])
+        # After the data loader has drawn its seeds, which happens at the
+        # start of the epoch in an uninterrupted run
+        set_random_states(resume_step['random_states'])
+
     end = time.time()
-    for i, ((input, ema_input), target) in enumerate(train_loader):
+    for i, ((input, ema_input), target) in enumerate(batches, start_step):
         # measure data loading time
         meters.update('data_time', time.time() - end)
 
         adjust_learning_rate(optimizer, epoch, i, len(train_loader))
         meters.update('lr', optimizer.param_groups[0]['lr'])
 
-        input_var = torch.autograd.Variable(input)
-        ema_input_var = torch.autograd.Variable(ema_input, volatile=True)
-        target_var = torch.autograd.Variable(target.cuda(async=True))
+        input_var = input.to(device, non_blocking=True)
+        ema_input_var = ema_input.to(device, non_blocking=True)
+        target_var = target.to(device, non_blocking=True)
 
-        minibatch_size = len(target_var)
-        labeled_minibatch_size = target_var.data.ne(NO_LABEL).sum()
-        assert labeled_minibatch_size > 0
+        labeled_minibatch_size = target_var.ne(NO_LABEL).sum()
+        no_labels |= labeled_minibatch_size.eq(0)
         meters.update('labeled_minibatch_size', labeled_minibatch_size)
 
-        ema_model_out = ema_model(ema_input_var)
-        model_out = model(input_var)
+        with torch.no_grad(), autocast():
+            ema_model_out = ema_model(ema_input_var)
+        with autocast():
+            model_out = model(input_var)
+        ema_model_out, model_out = to_float32(ema_model_out), to_float32(model_out)
 
         if isinstance(model_out, Variable):
             assert args.logit_distance_cost < 0
@@ -234,62 +393,53 @@ def train(train_loader, model, ema_model, optimizer, epoch, log):
             logit1, logit2 = model_out
             ema_logit, _ = ema_model_out
 
-        ema_logit = Variable(ema_logit.detach().data, requires_grad=False)
+        ema_logit = ema_logit.detach()
 
         if args.logit_distance_cost >= 0:
             class_logit, cons_logit = logit1, logit2
-            res_loss = args.logit_distance_cost * residual_logit_criterion(class_logit, cons_logit) / minibatch_size
-            meters.update('res_loss', res_loss.data[0])
         else:
             class_logit, cons_logit = logit1, logit1
-            res_loss = 0
-
-        class_softmax, cons_softmax = F.softmax(class_logit, dim=1), F.softmax(cons_logit, dim=1)
-        ema_softmax = F.softmax(ema_logit, dim=1)
-
-        class_loss = class_criterion(class_logit, target_var) / minibatch_size
-        meters.update('class_loss', class_loss.data[0])
-
-        ema_class_loss = class_criterion(ema_logit, target_var) / minibatch_size
-        meters.update('ema_class_loss', ema_class_loss.data[0])
 
         if args.consistency:
             consistency_weight = get_current_consistency_weight(epoch)
             meters.update('cons_weight', consistency_weight)
-            consistency_loss = consistency_weight * consistency_criterion(cons_logit, ema_logit) / minibatch_size
-            meters.update('cons_loss', consistency_loss.data[0])
         else:
-            consistency_loss = 0
+            consistency_weight = None
+
+        class_loss, consistency_loss, res_loss, ema_class_loss = criterion(
+            class_logit, cons_logit, ema_logit, target_var, consistency_weight)
+        meters.update('class_loss', class_loss.detach())
+        meters.update('ema_class_loss', ema_class_loss)
+        if args.logit_distance_cost >= 0:
+            meters.update('res_loss', res_loss.detach())
+        if args.consistency:
+            meters.update('cons_loss', consistency_loss.detach())
+        else:
             meters.update('cons_loss', 0)
 
         loss = class_loss + consistency_loss + res_loss
-        assert not (np.isnan(loss.data[0]) or loss.data[0] > 1e5), 'Loss explosion: {}'.format(loss.data[0])
-        meters.update('loss', loss.data[0])
-
-        prec1, prec5 = accuracy(class_logit.data, target_var.data, topk=(1, 5))
-        meters.update('top1', prec1[0], labeled_minibatch_size)
-        meters.update('error1', 100. - prec1[0], labeled_minibatch_size)
-        meters.update('top5', prec5[0], labeled_minibatch_size)
-        meters.update('error5', 100. - prec5[0], labeled_minibatch_size)
+        loss_explosion |= loss.detach().isnan() | loss.detach().gt(1e5)
+        meters.update('loss', loss.detach())
 
-        ema_prec1, ema_prec5 = accuracy(ema_logit.data, target_var.data, topk=(1, 5))
-        meters.update('ema_top1', ema_prec1[0], labeled_minibatch_size)
-        meters.update('ema_error1', 100. - ema_prec1[0], labeled_minibatch_size)
-        meters.update('ema_top5', ema_prec5[0], labeled_minibatch_size)
-        meters.update('ema_error5', 100. - ema_prec5[0], labeled_minibatch_size)
+        print_step = i % args.print_freq == 0 or i == len(train_loader) - 1
+        if args.train_accuracy_steps == 'all' or print_step:
+            precisions = metrics.topk_precisions(torch.stack([class_logit.detach(), ema_logit]), target_var)
+            meters.update_many(precision_names, precisions.reshape(-1), labeled_minibatch_size)
 
         # compute gradient and do SGD step
         optimizer.zero_grad()
         loss.backward()
         optimizer.step()
         global_step += 1
-        update_ema_variables(model, ema_model, args.ema_decay, global_step)
+        ema_updater.update(global_step)
 
         # measure elapsed time
         meters.update('batch_time', time.time() - end)
         end = time.time()
 
-        if i % args.print_freq == 0:
+        if print_step:
+            meters.synchronize()
+            check_training(no_labels, loss_explosion, meters)
             LOG.info(
                 'Epoch: [{0}][{1}/{2}]\t'
                 'Time {meters[batch_time]:.3f}\t'
@@ -299,81 +449,134 @@ def train(train_loader, model, ema_model, optimizer, epoch, log):
                 'Prec@1 {meters[top1]:.3f}\t'
                 'Prec@5 {meters[top5]:.3f}'.format(
                     epoch, i, len(train_loader), meters=meters))
-            log.record(epoch + i / len(train_loader), {
-                'step': global_step,
-                **meters.values(),
-                **meters.averages(),
-                **meters.sums()
-            })
+            if log is not None:
+                log.record(epoch + i / len(train_loader), {
+                    'step': global_step,
+                    **meters.values(),
+                    **meters.averages(),
+                    **meters.sums()
+                })
 
+        # The last step of the epoch is saved by main_worker, after the evaluation
+        if args.checkpoint_steps and global_step % args.checkpoint_steps == 0 and i < len(train_loader) - 1:
+            save_step_checkpoint(epoch, i + 1, meters)
 
-def validate(eval_loader, model, log, global_step, epoch):
-    class_criterion = nn.CrossEntropyLoss(size_average=False, ignore_index=NO_LABEL).cuda()
-    meters = AverageMeterSet()
+
+def autocast():
+    """Context of the forward passes, with autocast for --precision bf16
+
+    The weights, and so the optimizer and the EMA updates, stay float32.
+    """
+    return torch.autocast(device.type, dtype=torch.bfloat16, enabled=args.precision == 'bf16')
+
+
+def to_float32(output):
+    """Cast model outputs to float32 for the losses and metrics"""
+    if isinstance(output, torch.Tensor):
+        return output.float()
+    return tuple(tensor.float() for tensor in output)
+
+
+def check_training(no_labels, loss_explosion, meters):
+    assert not no_labels.item(), 'A minibatch without labeled examples'
+    assert not loss_explosion.item(), 'Loss explosion: {}'.format(meters['loss'].val)
+
+
+def validate(eval_loader, models, global_step, epoch):
+    """Evaluate the models, a dict of names to (model, log), on each batch of eval_loader
+
+    The batches are loaded once for all the models. Returns a dict of the
+    names to the top-1 precisions.
+    """
+    class_criterion = nn.CrossEntropyLoss(size_average=False, ignore_index=NO_LABEL).to(device)
+    meter_sets = {name: AverageMeterSet() for name in models}
+    # Checked when the meters are synchronized, like in train
+    no_labels = torch.zeros((), dtype=torch.bool, device=device)
 
     # switch to evaluate mode
-    model.eval()
+    for model, _ in models.values():
+        model.eval()
 
     end = time.time()
     for i, (input, target) in enumerate(eval_loader):
-        meters.update('data_time', time.time() - end)
+        data_time = time.time() - end
 
-        input_var = torch.autograd.Variable(input, volatile=True)
-        target_var = torch.autograd.Variable(target.cuda(async=True), volatile=True)
+        input_var = input.to(device, non_blocking=True)
+        target_var = target.to(device, non_blocking=True)
 
         minibatch_size = len(target_var)
-        labeled_minibatch_size = target_var.data.ne(NO_LABEL).sum()
-        assert labeled_minibatch_size > 0
-        meters.update('labeled_minibatch_size', labeled_minibatch_size)
-
-        # compute output
-        output1, output2 = model(input_var)
-        softmax1, softmax2 = F.softmax(output1, dim=1), F.softmax(output2, dim=1)
-        class_loss = class_criterion(output1, target_var) / minibatch_size
-
-        # measure accuracy and record loss
-        prec1, prec5 = accuracy(output1.data, target_var.data, topk=(1, 5))
-        meters.update('class_loss', class_loss.data[0], labeled_minibatch_size)
-        meters.update('top1', prec1[0], labeled_minibatch_size)
-        meters.update('error1', 100.0 - prec1[0], labeled_minibatch_size)
-        meters.update('top5', prec5[0], labeled_minibatch_size)
-        meters.update('error5', 100.0 - prec5[0], labeled_minibatch_size)
-
-        # measure elapsed time
-        meters.update('batch_time', time.time() - end)
+        labeled_minibatch_size = target_var.ne(NO_LABEL).sum()
+        no_labels |= labeled_minibatch_size.eq(0)
+
+        for name, (model, _) in models.items():
+            meters = meter_sets[name]
+            meters.update('data_time', data_time)
+            meters.update('labeled_minibatch_size', labeled_minibatch_size)
+
+            # compute output
+            with torch.no_grad(), autocast():
+                output1, output2 = to_float32(model(input_var))
+            class_loss = class_criterion(output1, target_var) / minibatch_size
+
+            # measure accuracy and record loss
+            precisions = metrics.topk_precisions(output1, target_var)
+            meters.update('class_loss', class_loss, labeled_minibatch_size)
+            meters.update_many(metrics.precision_names(), precisions, labeled_minibatch_size)
+
+        # measure elapsed time, of all the models
+        batch_time = time.time() - end
+        for meters in meter_sets.values():
+            meters.update('batch_time', batch_time)
         end = time.time()
 
         if i % args.print_freq == 0:
-            LOG.info(
-                'Test: [{0}/{1}]\t'
-                'Time {meters[batch_time]:.3f}\t'
-                'Data {meters[data_time]:.3f}\t'
-                'Class {meters[class_loss]:.4f}\t'
-                'Prec@1 {meters[top1]:.3f}\t'
-                'Prec@5 {meters[top5]:.3f}'.format(
-                    i, len(eval_loader), meters=meters))
+            assert not no_labels.item(), 'A minibatch without labeled examples'
+            for name, meters in meter_sets.items():
+                meters.synchronize()
+                LOG.info(
+                    'Test {name}: [{0}/{1}]\t'
+                    'Time {meters[batch_time]:.3f}\t'
+                    'Data {meters[data_time]:.3f}\t'
+                    'Class {meters[class_loss]:.4f}\t'
+                    'Prec@1 {meters[top1]:.3f}\t'
+                    'Prec@5 {meters[top5]:.3f}'.format(
+                        i, len(eval_loader), name=name, meters=meters))
+
+    assert not no_labels.item(), 'A minibatch without labeled examples'
+    for name, (_, log) in models.items():
+        meters = meter_sets[name]
+        meters.synchronize()
+        LOG.info(' * {name} Prec@1 {top1.avg:.3f}\tPrec@5 {top5.avg:.3f}'
+              .format(name=name, top1=meters['top1'], top5=meters['top5']))
+        if log is not None:
+            log.record(epoch, {
+                'step': global_step,
+                **meters.values(),
+                **meters.averages(),
+                **meters.sums()
+            })
+
+    return {name: meters['top1'].avg for name, meters in meter_sets.items()}
 
-    LOG.info(' * Prec@1 {top1.avg:.3f}\tPrec@5 {top5.avg:.3f}'
-          .format(top1=meters['top1'], top5=meters['top5']))
-    log.record(epoch, {
-        'step': global_step,
-        **meters.values(),
-        **meters.averages(),
-        **meters.sums()
-    })
 
-    return meters['top1'].avg
+def create_checkpoint_writer():
+    assert args.checkpoint_store or not args.checkpoint_compression, \
+        "--checkpoint-compression needs --checkpoint-store"
+    assert args.keep_checkpoints or not args.keep_checkpoint_every, \
+        "--keep-checkpoint-every needs --keep-checkpoints"
+    tensor_store = (checkpoints.TensorStore(compression=args.checkpoint_compression)
+                    if args.checkpoint_store else None)
+    retention = (checkpoints.RetentionPolicy(keep_last=args.keep_checkpoints,
+                                             keep_every=args.keep_checkpoint_every)
+                 if args.keep_checkpoints else None)
+    return checkpoints.CheckpointWriter(tensor_store=tensor_store, retention=retention)
 
 
-def save_checkpoint(state, is_best, dirpath, epoch):
+def save_checkpoint(writer, state, is_best, dirpath, epoch):
     filename = 'checkpoint.{}.ckpt'.format(epoch)
     checkpoint_path = os.path.join(dirpath, filename)
     best_path = os.path.join(dirpath, 'best.ckpt')
-    torch.save(state, checkpoint_path)
-    LOG.info("--- checkpoint saved to %s ---" % checkpoint_path)
-    if is_best:
-        shutil.copyfile(checkpoint_path, best_path)
-        LOG.info("--- checkpoint copied to %s ---" % best_path)
+    writer.save(state, checkpoint_path, link_paths=[best_path] if is_best else [])
 
 
 def adjust_learning_rate(optimizer, epoch, step_in_epoch, total_steps_in_epoch):
@@ -397,22 +600,6 @@ def get_current_consistency_weight(epoch):
     return args.consistency * ramps.sigmoid_rampup(epoch, args.consistency_rampup)
 
 
-def accuracy(output, target, topk=(1,)):
-    """Computes the precision@k for the specified values of k"""
-    maxk = max(topk)
-    labeled_minibatch_size = max(target.ne(NO_LABEL).sum(), 1e-8)
-
-    _, pred = output.topk(maxk, 1, True, True)
-    pred = pred.t()
-    correct = pred.eq(target.view(1, -1).expand_as(pred))
-
-    res = []
-    for k in topk:
-        correct_k = correct[:k].view(-1).float().sum(0, keepdim=True)
-        res.append(correct_k.mul_(100.0 / labeled_minibatch_size))
-    return res
-
-
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
     args = cli.parse_commandline_args()
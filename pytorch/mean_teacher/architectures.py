@@ -1,11 +1,15 @@
 import sys
 import math
 import itertools
+import contextlib
+import functools
 
+import numpy as np
 import torch
 from torch import nn
 from torch.nn import functional as F
-from torch.autograd import Variable, Function
+from torch.autograd import Function
+from torch.utils.checkpoint import checkpoint
 
 from .utils import export, parameter_count
 
@@ -20,6 +24,16 @@ def cifar_shakeshake26(pretrained=False, **kwargs):
     return model
 
 
+@export
+def cifar_shakeshake26_fused(pretrained=False, **kwargs):
+    assert not pretrained
+    model = ResNet32x32(FusedShakeShakeBlock,
+                        layers=[4, 4, 4],
+                        channels=96,
+                        downsample='shift_conv', **kwargs)
+    return model
+
+
 @export
 def resnext152(pretrained=False, **kwargs):
     assert not pretrained
@@ -85,7 +99,7 @@ class ResNet224x224(nn.Module):
         for i in range(1, blocks):
             layers.append(block(self.inplanes, planes, groups))
 
-        return nn.Sequential(*layers)
+        return CheckpointedSequential(*layers)
 
     def forward(self, x):
         x = self.conv1(x)
@@ -149,7 +163,7 @@ class ResNet32x32(nn.Module):
         for i in range(1, blocks):
             layers.append(block(self.inplanes, planes, groups))
 
-        return nn.Sequential(*layers)
+        return CheckpointedSequential(*layers)
 
     def forward(self, x):
         x = self.conv1(x)
@@ -161,6 +175,64 @@ class ResNet32x32(nn.Module):
         return self.fc1(x), self.fc2(x)
 
 
+def set_activation_checkpointing(model, segments):
+    """Checkpoint the activations of the stages of a ResNet
+
+    segments has the number of checkpointed segments for each stage
+    (layer1, layer2, ...), 0 for none. See CheckpointedSequential.
+    """
+    stages = [module for name, module in sorted(model.named_children())
+              if name.startswith('layer') and isinstance(module, CheckpointedSequential)]
+    assert len(segments) == len(stages), \
+        "expected activation checkpointing segments for {} stages, got {}".format(len(stages), segments)
+    for stage, stage_segments in zip(stages, segments):
+        assert 0 <= stage_segments <= len(stage)
+        stage.segments = stage_segments
+    return model
+
+
+class CheckpointedSequential(nn.Sequential):
+    """nn.Sequential that can recompute its activations in the backward pass
+
+    With segments > 0, the blocks are split into that many segments and
+    only the input of each segment is kept for the backward pass, where the
+    segment is run again. The random state is restored for the rerun, so
+    random ops like the shake gates draw the same numbers, and the
+    BatchNorm running statistics are not updated a second time.
+    """
+    segments = 0
+
+    def forward(self, x):
+        if not self.segments or not torch.is_grad_enabled():
+            return super().forward(x)
+        for blocks in np.array_split(np.arange(len(self)), self.segments):
+            segment = nn.Sequential(*(self[int(idx)] for idx in blocks))
+            x = checkpoint(segment, x, use_reentrant=False,
+                           context_fn=functools.partial(_recomputation_context, segment))
+        return x
+
+
+def _recomputation_context(segment):
+    return contextlib.nullcontext(), _frozen_batch_norm_statistics(segment)
+
+
+@contextlib.contextmanager
+def _frozen_batch_norm_statistics(module):
+    # With momentum 0 the running statistics keep their values, but the
+    # rerun still does (and saves for backward) the same as the first run
+    batch_norms = [m for m in module.modules()
+                   if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    saved = [(m.momentum, m.num_batches_tracked.clone()) for m in batch_norms]
+    for batch_norm in batch_norms:
+        batch_norm.momentum = 0.
+    try:
+        yield
+    finally:
+        for batch_norm, (momentum, num_batches_tracked) in zip(batch_norms, saved):
+            batch_norm.momentum = momentum
+            batch_norm.num_batches_tracked.copy_(num_batches_tracked)
+
+
 def conv3x3(in_planes, out_planes, stride=1):
     "3x3 convolution with padding"
     return nn.Conv2d(in_planes, out_planes, kernel_size=3, stride=stride,
@@ -210,6 +282,9 @@ class BottleneckBlock(nn.Module):
 
 
 class ShakeShakeBlock(nn.Module):
+    # Use traceable_shake instead of the Shake autograd function (see compile_model)
+    traceable = False
+
     @classmethod
     def out_channels(cls, planes, groups):
         assert groups == 1
@@ -248,42 +323,185 @@ class ShakeShakeBlock(nn.Module):
         b = self.conv_b2(b)
         b = self.bn_b2(b)
 
-        ab = shake(a, b, training=self.training)
+        if self.traceable:
+            ab = traceable_shake(a, b, training=self.training)
+        else:
+            ab = shake(a, b, training=self.training)
 
         if self.downsample is not None:
             residual = self.downsample(x)
 
         return residual + ab
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if prefix + 'conv1.weight' in state_dict:
+            _unfuse_branches(state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+class FusedShakeShakeBlock(nn.Module):
+    """ShakeShakeBlock with both branches computed by the same convolutions
+
+    The first convolutions of the branches are concatenated into one with
+    twice the output channels and the second ones run as one grouped
+    convolution. The outputs are those of ShakeShakeBlock, and either block
+    loads the state dicts of the other.
+    """
+    traceable = False
 
-class Shake(Function):
     @classmethod
-    def forward(cls, ctx, inp1, inp2, training):
+    def out_channels(cls, planes, groups):
+        assert groups == 1
+        return planes
+
+    def __init__(self, inplanes, planes, groups, stride=1, downsample=None):
+        super().__init__()
+        assert groups == 1
+        self.conv1 = conv3x3(inplanes, 2 * planes, stride)
+        self.bn1 = nn.BatchNorm2d(2 * planes)
+        self.conv2 = nn.Conv2d(2 * planes, 2 * planes, kernel_size=3, stride=1,
+                               padding=1, groups=2, bias=False)
+        self.bn2 = nn.BatchNorm2d(2 * planes)
+
+        self.downsample = downsample
+        self.stride = stride
+
+    def forward(self, x):
+        residual = x
+
+        ab = F.relu(x, inplace=False)
+        ab = self.conv1(ab)
+        ab = self.bn1(ab)
+        ab = F.relu(ab, inplace=True)
+        ab = self.conv2(ab)
+        ab = self.bn2(ab)
+        a, b = ab.chunk(2, dim=1)
+
+        if self.traceable:
+            ab = traceable_shake(a, b, training=self.training)
+        else:
+            ab = shake(a, b, training=self.training)
+
+        if self.downsample is not None:
+            residual = self.downsample(x)
+
+        return residual + ab
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if prefix + 'conv_a1.weight' in state_dict:
+            _fuse_branches(state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+# (branch a, branch b, fused) module names of the shake-shake blocks
+_BRANCH_MODULES = [('conv_a1', 'conv_b1', 'conv1'),
+                   ('bn_a1', 'bn_b1', 'bn1'),
+                   ('conv_a2', 'conv_b2', 'conv2'),
+                   ('bn_a2', 'bn_b2', 'bn2')]
+
+
+def _fuse_branches(state_dict, prefix):
+    for name_a, name_b, name in _BRANCH_MODULES:
+        for key in [key for key in state_dict if key.startswith(prefix + name_a + '.')]:
+            tensor_name = key[len(prefix + name_a):]
+            tensor_a = state_dict.pop(key)
+            tensor_b = state_dict.pop(prefix + name_b + tensor_name)
+            if tensor_name == '.num_batches_tracked':
+                state_dict[prefix + name + tensor_name] = tensor_a
+            else:
+                state_dict[prefix + name + tensor_name] = torch.cat([tensor_a, tensor_b])
+
+
+def _unfuse_branches(state_dict, prefix):
+    for name_a, name_b, name in _BRANCH_MODULES:
+        for key in [key for key in state_dict if key.startswith(prefix + name + '.')]:
+            tensor_name = key[len(prefix + name):]
+            tensor = state_dict.pop(key)
+            if tensor_name == '.num_batches_tracked':
+                tensor_a = tensor_b = tensor
+            else:
+                tensor_a, tensor_b = tensor.chunk(2)
+            state_dict[prefix + name_a + tensor_name] = tensor_a
+            state_dict[prefix + name_b + tensor_name] = tensor_b
+
+
+class Shake(Function):
+    """Blend two inputs with a random gate per example and random gradients
+
+    Each direction is one lerp-style pass without full-size temporaries.
+    The backward pass draws its own gate, so nothing is saved for it and
+    it can run more than once.
+    """
+    @staticmethod
+    def forward(ctx, inp1, inp2, training, generator=None):
         assert inp1.size() == inp2.size()
-        gate_size = [inp1.size()[0], *itertools.repeat(1, inp1.dim() - 1)]
-        gate = inp1.new(*gate_size)
         if training:
-            gate.uniform_(0, 1)
+            gate = inp1.new_empty(_gate_size(inp1)).uniform_(0, 1, generator=generator)
+            output = torch.lerp(inp2, inp1, gate)
         else:
-            gate.fill_(0.5)
-        return inp1 * gate + inp2 * (1. - gate)
-
-    @classmethod
-    def backward(cls, ctx, grad_output):
-        grad_inp1 = grad_inp2 = grad_training = None
-        gate_size = [grad_output.size()[0], *itertools.repeat(1,
-                                                              grad_output.dim() - 1)]
-        gate = Variable(grad_output.data.new(*gate_size).uniform_(0, 1))
+            output = torch.lerp(inp2, inp1, 0.5)
+        ctx.gate_size = _gate_size(inp1)
+        ctx.generator = generator
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_inp1 = grad_inp2 = None
+        gate = grad_output.new_empty(ctx.gate_size).uniform_(0, 1, generator=ctx.generator)
         if ctx.needs_input_grad[0]:
             grad_inp1 = grad_output * gate
         if ctx.needs_input_grad[1]:
-            grad_inp2 = grad_output * (1 - gate)
+            grad_inp2 = grad_output * gate.neg_().add_(1)
         assert not ctx.needs_input_grad[2]
-        return grad_inp1, grad_inp2, grad_training
+        return grad_inp1, grad_inp2, None, None
+
+
+def shake(inp1, inp2, training=False, generator=None):
+    """Shake the outputs of two branches
+
+    The gates are drawn from the given torch.Generator, e.g. with a fixed
+    seed in tests, or from the default one.
+    """
+    return Shake.apply(inp1, inp2, training, generator)
 
 
-def shake(inp1, inp2, training=False):
-    return Shake.apply(inp1, inp2, training)
+def traceable_shake(inp1, inp2, training=False, generator=None):
+    """shake without a custom autograd function, so that it can be compiled
+
+    The output is exactly that of shake. The gradients use a second random
+    gate like in shake, but it is drawn in the forward pass instead of the
+    backward pass, so the random numbers are consumed in another order.
+    """
+    assert inp1.size() == inp2.size()
+    if training:
+        gate = torch.rand(_gate_size(inp1), generator=generator, dtype=inp1.dtype, device=inp1.device)
+        output = torch.lerp(inp2, inp1, gate)
+    else:
+        output = torch.lerp(inp2, inp1, 0.5)
+    if not torch.is_grad_enabled() or not (inp1.requires_grad or inp2.requires_grad):
+        return output
+
+    backward_gate = torch.rand(_gate_size(inp1), generator=generator, dtype=inp1.dtype, device=inp1.device)
+    surrogate = torch.lerp(inp2, inp1, backward_gate)
+    # Has the value of output and the gradients of surrogate
+    return output.detach() + (surrogate - surrogate.detach())
+
+
+def _gate_size(inp):
+    return [inp.size(0), *itertools.repeat(1, inp.dim() - 1)]
+
+
+def compile_model(model, **kwargs):
+    """Compile the forward and backward passes of the model in place
+
+    Uses nn.Module.compile, which keeps the parameter names (and so the
+    checkpoints) unchanged. The kwargs are passed to torch.compile.
+    """
+    for module in model.modules():
+        if isinstance(module, (ShakeShakeBlock, FusedShakeShakeBlock)):
+            module.traceable = True
+    model.compile(**kwargs)
+    return model
 
 
 class ShiftConvDownsample(nn.Module):
@@ -0,0 +1,76 @@
+"""Selecting the compute device and tuning the CPU backend"""
+
+import logging
+import os
+
+import torch
+
+
+LOG = logging.getLogger('main')
+
+
+def select_device(name='auto'):
+    """Returns the torch.device to train on
+
+    'auto' picks CUDA when it is available and falls back to the CPU.
+    """
+    if name == 'auto':
+        name = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if name == 'cuda' and not torch.cuda.is_available():
+        raise RuntimeError("--device cuda requested but CUDA is not available")
+    return torch.device(name)
+
+
+def configure_cpu_backend(intra_op_threads=None, inter_op_threads=None,
+                          mkldnn=True, pin_threads=False):
+    """Set the thread pools and oneDNN usage of the CPU backend
+
+    With pin_threads, the training process is pinned to its first
+    intra_op_threads cores. Data loading workers should then call
+    pin_worker_threads so that they run on the remaining cores and do
+    not compete with the compute threads.
+    """
+    torch.backends.mkldnn.enabled = mkldnn
+
+    if intra_op_threads:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads and torch.get_num_interop_threads() != inter_op_threads:
+        # Can only be set once per process, before any inter-op parallel work
+        torch.set_num_interop_threads(inter_op_threads)
+
+    if pin_threads and hasattr(os, 'sched_setaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+        compute_cores = cores[:torch.get_num_threads()]
+        os.sched_setaffinity(0, compute_cores)
+        os.environ['MEAN_TEACHER_WORKER_CORES'] = ','.join(
+            str(core) for core in cores[len(compute_cores):] or cores)
+        LOG.info("=> pinned compute threads to cores %s", compute_cores)
+
+    LOG.info("=> CPU backend: %d intra-op threads, %d inter-op threads, oneDNN %s",
+             torch.get_num_threads(), torch.get_num_interop_threads(),
+             'enabled' if torch.backends.mkldnn.enabled else 'disabled')
+
+
+def pin_worker_threads(worker_id):
+    """DataLoader worker_init_fn that moves workers off the compute cores"""
+    cores = os.environ.get('MEAN_TEACHER_WORKER_CORES')
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, [int(core) for core in cores.split(',')])
+
+
+def configure_compile_cache(cache_dir=None):
+    """Keep the graphs compiled by torch.compile in a cache shared by runs
+
+    With the cache, later runs (e.g. the other jobs of a sweep) load the
+    compiled forward and backward graphs instead of compiling them again.
+    By default the cache is in the temporary directory of the machine.
+    """
+    if cache_dir:
+        os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(cache_dir)
+    import torch._inductor.config
+    torch._inductor.config.fx_graph_cache = True
+    import torch._functorch.config
+    if hasattr(torch._functorch.config, 'enable_autograd_cache'):
+        torch._functorch.config.enable_autograd_cache = True
+    LOG.info("=> caching compiled graphs in %s",
+             os.environ.get('TORCHINDUCTOR_CACHE_DIR', 'the default torch inductor directory'))
@@ -0,0 +1,207 @@
+"""Augmentations that run on whole collated batches
+
+With these the data loading workers only decode and crop the images to
+uint8 tensors. Everything else runs as vectorized tensor operations on
+the batch, on the training device, after the DataLoader has collated it.
+Each transform draws its random parameters independently for every
+image of the batch.
+"""
+
+import torch
+from torch.nn import functional as F
+
+
+class Compose:
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, batch):
+        for transform in self.transforms:
+            batch = transform(batch)
+        return batch
+
+
+class TransformTwice:
+    """Batch version of data.TransformTwice"""
+
+    def __init__(self, transform):
+        self.transform = transform
+
+    def __call__(self, batch):
+        out1 = self.transform(batch)
+        out2 = self.transform(batch)
+        return out1, out2
+
+
+class ToFloat:
+    """Convert N x C x H x W uint8 images to floats in [0, 1]"""
+
+    def __call__(self, batch):
+        return batch.float().div_(255)
+
+
+class Normalize:
+    def __init__(self, mean, std):
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+
+    def __call__(self, batch):
+        mean = self.mean.to(batch.device)
+        std = self.std.to(batch.device)
+        return (batch - mean) / std
+
+
+class RandomHorizontalFlip:
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, batch):
+        flips = torch.rand(len(batch), device=batch.device) < self.p
+        return torch.where(flips.view(-1, 1, 1, 1), batch.flip(3), batch)
+
+
+class RandomTranslateWithReflect:
+    """Batch version of data.RandomTranslateWithReflect
+
+    Pads the batch with reflect padding once and crops every image at its
+    own random offset with a single gather.
+    """
+
+    def __init__(self, max_translation):
+        self.max_translation = max_translation
+
+    def __call__(self, batch):
+        n, _, height, width = batch.size()
+        padding = self.max_translation
+        padded = F.pad(batch, (padding, padding, padding, padding), mode='reflect')
+        translations = torch.randint(-padding, padding + 1, (n, 2), device=batch.device)
+        rows = (padding - translations[:, 1]).view(-1, 1) + torch.arange(height, device=batch.device)
+        cols = (padding - translations[:, 0]).view(-1, 1) + torch.arange(width, device=batch.device)
+        images = torch.arange(n, device=batch.device).view(-1, 1, 1)
+        # Advanced indexing moves the channel dimension last
+        return padded.permute(0, 2, 3, 1)[images, rows[:, :, None], cols[:, None, :]].permute(0, 3, 1, 2)
+
+
+class ColorJitter:
+    """Batch version of torchvision.transforms.ColorJitter
+
+    Works on float images in [0, 1] with the same formulas as the
+    torchvision tensor transforms. The adjustment factors are drawn for
+    every image, the order of the adjustments once per batch.
+    """
+
+    def __init__(self, brightness=0, contrast=0, saturation=0, hue=0):
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+
+    def __call__(self, batch):
+        adjustments = [
+            (self.brightness, adjust_brightness),
+            (self.contrast, adjust_contrast),
+            (self.saturation, adjust_saturation),
+        ]
+        adjustments = [(torch.empty(len(batch), device=batch.device).uniform_(max(0, 1 - amount), 1 + amount),
+                        adjust)
+                       for amount, adjust in adjustments if amount]
+        if self.hue:
+            factors = torch.empty(len(batch), device=batch.device).uniform_(-self.hue, self.hue)
+            adjustments.append((factors, adjust_hue))
+
+        for idx in torch.randperm(len(adjustments)).tolist():
+            factors, adjust = adjustments[idx]
+            batch = adjust(batch, factors)
+        return batch
+
+
+def _blend(batch1, batch2, factors):
+    factors = factors.view(-1, 1, 1, 1)
+    return (factors * batch1 + (1 - factors) * batch2).clamp_(0, 1)
+
+
+def _grayscale(batch):
+    r, g, b = batch.unbind(dim=1)
+    return (0.2989 * r + 0.587 * g + 0.114 * b).unsqueeze(dim=1)
+
+
+def adjust_brightness(batch, factors):
+    return _blend(batch, torch.zeros_like(batch), factors)
+
+
+def adjust_contrast(batch, factors):
+    mean = _grayscale(batch).mean(dim=(1, 2, 3), keepdim=True)
+    return _blend(batch, mean, factors)
+
+
+def adjust_saturation(batch, factors):
+    return _blend(batch, _grayscale(batch), factors)
+
+
+def adjust_hue(batch, factors):
+    h, s, v = _rgb_to_hsv(batch).unbind(dim=1)
+    h = torch.remainder(h + factors.view(-1, 1, 1), 1.0)
+    return _hsv_to_rgb(h, s, v)
+
+
+def _rgb_to_hsv(batch):
+    r, g, b = batch.unbind(dim=1)
+    maxc = batch.max(dim=1).values
+    minc = batch.min(dim=1).values
+    eqc = maxc == minc
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    s = cr / torch.where(eqc, ones, maxc)
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+    hr = (maxc == r) * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)) * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)) * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+    return torch.stack((h, s, maxc), dim=1)
+
+
+def _hsv_to_rgb(h, s, v):
+    i = torch.floor(h * 6.0)
+    f = h * 6.0 - i
+    i = i.long() % 6
+    p = (v * (1.0 - s)).clamp(0.0, 1.0)
+    q = (v * (1.0 - s * f)).clamp(0.0, 1.0)
+    t = (v * (1.0 - s * (1.0 - f))).clamp(0.0, 1.0)
+    # Candidates for each of the six hue sectors, indexed by i
+    r = torch.stack((v, q, p, p, t, v), dim=1)
+    g = torch.stack((t, v, v, q, p, p), dim=1)
+    b = torch.stack((p, p, t, v, v, q), dim=1)
+    i = i.unsqueeze(dim=1)
+    return torch.cat((r.gather(1, i), g.gather(1, i), b.gather(1, i)), dim=1)
+
+
+class TransformingLoader:
+    """Apply a batch transform to the inputs of every batch of a DataLoader
+
+    The inputs are moved to the device before they are transformed, so
+    the augmentations run on the training device. Other attributes, like
+    batch_sampler, are those of the wrapped loader.
+    """
+
+    def __init__(self, loader, transform, device):
+        self.loader = loader
+        self.transform = transform
+        self.device = device
+
+    def __iter__(self):
+        for input, target in self.loader:
+            input = input.to(self.device, non_blocking=True)
+            yield self.transform(input), target
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        # Not for the attributes of the wrapper itself, which copy and
+        # unpickling look up before setting them
+        if name.startswith('_') or name == 'loader':
+            raise AttributeError(name)
+        return getattr(self.loader, name)
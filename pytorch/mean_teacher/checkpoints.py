@@ -0,0 +1,481 @@
+"""Writing checkpoints without stalling the training loop, keeping fewer of them and loading them fast"""
+
+import collections
+import glob
+import hashlib
+import io
+import json
+import logging
+import mmap
+import os
+import queue
+import re
+import shutil
+import struct
+import threading
+import zlib
+
+import torch
+
+
+LOG = logging.getLogger('main')
+
+
+class CheckpointWriter:
+    """Writes checkpoints on a background thread
+
+    save() only copies the tensors of the state into host memory, which is
+    needed anyway as the training goes on updating them, and returns. The
+    background thread serializes the copy into a temporary file next to
+    the checkpoint and renames it over the checkpoint, so checkpoint files
+    are always complete, also after a crash in the middle of a write.
+    At most max_pending copies wait for the thread, after which save()
+    blocks. Call wait() to make sure that the checkpoints are written and
+    close() when done.
+
+    With a TensorStore, the checkpoint files only refer to the tensors in
+    the store, see load_checkpoint. With a RetentionPolicy, the thread
+    prunes the checkpoints of the directory after each write.
+    """
+
+    def __init__(self, max_pending=1, tensor_store=None, retention=None):
+        self.tensor_store = tensor_store
+        self.retention = retention
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+        self._thread.start()
+
+    def save(self, state, path, link_paths=()):
+        """Write state to path, and then hard link it to the link paths"""
+        self._raise_error()
+        self._queue.put((snapshot(state), path, list(link_paths)))
+
+    def wait(self):
+        """Block until the checkpoints saved so far are written"""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self._queue.put(None)
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # Without replacing the exception of the block
+        try:
+            self.close()
+        except RuntimeError:
+            LOG.exception("--- writing a checkpoint failed too ---")
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                state, path, link_paths = item
+                if self.tensor_store is not None:
+                    state = self.tensor_store.put_all(state, os.path.dirname(path))
+                atomic_save(state, path)
+                LOG.info("--- checkpoint saved to %s ---" % path)
+                for link_path in link_paths:
+                    atomic_link(path, link_path)
+                    LOG.info("--- checkpoint linked to %s ---" % link_path)
+                if self.retention is not None:
+                    self.retention.prune(os.path.dirname(path))
+                if self.tensor_store is not None:
+                    # Of the deleted and of the overwritten checkpoints
+                    self.tensor_store.collect_garbage(os.path.dirname(path))
+            except BaseException as error:
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('writing a checkpoint failed') from error
+
+
+def snapshot(state):
+    """Copy the tensors in the nested dicts, lists and tuples of state to host memory
+
+    CUDA tensors are copied asynchronously into pinned memory, with a single
+    synchronization at the end.
+    """
+    cuda_copies = []
+
+    def copy(value):
+        if isinstance(value, torch.Tensor):
+            if value.device.type == 'cuda':
+                host = torch.empty_like(value, device='cpu', pin_memory=True)
+                host.copy_(value.detach(), non_blocking=True)
+                cuda_copies.append(host)
+                return host
+            return value.detach().clone()
+        elif isinstance(value, dict):
+            copied = type(value)((key, copy(item)) for key, item in value.items())
+            if hasattr(value, '_metadata'):
+                # The versions of the modules in a state_dict
+                copied._metadata = value._metadata
+            return copied
+        elif isinstance(value, (list, tuple)):
+            return type(value)(copy(item) for item in value)
+        else:
+            return value
+
+    state = copy(state)
+    if cuda_copies:
+        torch.cuda.synchronize()
+    return state
+
+
+def atomic_save(state, path):
+    """torch.save into a temporary file that is then renamed to path"""
+    temporary_path = _temporary_path(path, 'tmp')
+    file = open(temporary_path, 'wb')
+    try:
+        with file:
+            torch.save(state, file)
+            file.flush()
+            os.fsync(file.fileno())
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+    _replace(temporary_path, path)
+
+
+def atomic_link(path, link_path):
+    """Replace link_path with a hard link to path, or a copy where links are not supported"""
+    temporary_path = _temporary_path(link_path, 'link')
+    try:
+        os.link(path, temporary_path)
+    except OSError:
+        shutil.copyfile(path, temporary_path)
+    _replace(temporary_path, link_path)
+
+
+def _temporary_path(path, suffix):
+    # In the same directory, so that it can be renamed to path
+    directory, filename = os.path.split(os.path.abspath(path))
+    return os.path.join(directory, '.{}.{}.{}'.format(filename, os.getpid(), suffix))
+
+
+def _replace(temporary_path, path):
+    # Also syncs the directory, so that the rename itself survives a crash
+    os.replace(temporary_path, path)
+    if hasattr(os, 'O_DIRECTORY'):
+        directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+
+class RetentionPolicy:
+    """Which of the checkpoint.EPOCH.ckpt files of a directory to keep
+
+    Keeps the last keep_last of them (at least one, to resume from), the
+    ones of every keep_every-th epoch and the one best.ckpt links to, and
+    deletes the others. Other files, like checkpoint.latest.ckpt and
+    best.ckpt itself, are left alone.
+    """
+    FILENAME = re.compile(r'checkpoint\.(\d+)\.ckpt$')
+
+    def __init__(self, keep_last=1, keep_every=0):
+        self.keep_last = max(keep_last, 1)
+        self.keep_every = keep_every
+
+    def prune(self, directory):
+        epochs = sorted(int(match.group(1)) for match in map(self.FILENAME.match, os.listdir(directory))
+                        if match)
+        best_path = os.path.join(directory, 'best.ckpt')
+        for epoch in epochs[:-self.keep_last]:
+            path = os.path.join(directory, 'checkpoint.{}.ckpt'.format(epoch))
+            if self.keep_every and epoch % self.keep_every == 0:
+                continue
+            if os.path.exists(best_path) and os.path.samefile(path, best_path):
+                continue
+            os.unlink(path)
+            LOG.info("--- checkpoint %s deleted ---" % path)
+
+
+class TensorStore:
+    """Content-addressed storage of the tensors of checkpoints
+
+    Each tensor is stored once, in a file named after the digest of its
+    dtype, shape and contents in the store subdirectory next to the
+    checkpoints, so the tensors that did not change since an earlier
+    checkpoint (or that are in both the latest and an epoch checkpoint)
+    are not written again. With compression 'zlib' the files are
+    compressed.
+    """
+    SUBDIRECTORY = 'tensors'
+    # The keys of the stored tensors and of the checkpoints that use a store
+    REFERENCE = '__stored_tensor__'
+    STORE = '__tensor_store__'
+    COMPRESSIONS = [None, 'zlib']
+
+    def __init__(self, compression=None):
+        assert compression in self.COMPRESSIONS, compression
+        self.compression = compression
+        # The stored tensors of each checkpoint file, by the stat of the file
+        self._checkpoint_references = {}
+
+    def put_all(self, state, directory):
+        """state with its tensors written to the store of directory and replaced with references"""
+        store_directory = os.path.join(directory, self.SUBDIRECTORY)
+        os.makedirs(store_directory, exist_ok=True)
+
+        def put(value):
+            if isinstance(value, torch.Tensor):
+                return self.put(value, store_directory)
+            elif isinstance(value, dict):
+                stored = type(value)((key, put(item)) for key, item in value.items())
+                if hasattr(value, '_metadata'):
+                    stored._metadata = value._metadata
+                return stored
+            elif isinstance(value, (list, tuple)):
+                return type(value)(put(item) for item in value)
+            else:
+                return value
+
+        return {**put(state), self.STORE: self.SUBDIRECTORY}
+
+    def put(self, tensor, store_directory):
+        data = _tensor_data(tensor)
+        digest = hashlib.sha1('{} {}'.format(tensor.dtype, list(tensor.shape)).encode('utf-8'))
+        digest.update(data)
+        filename = digest.hexdigest() + ('.' + self.compression if self.compression else '')
+        path = os.path.join(store_directory, filename)
+        if not os.path.exists(path):
+            if self.compression == 'zlib':
+                data = zlib.compress(data, 1)
+            temporary_path = _temporary_path(path, 'tmp')
+            with open(temporary_path, 'wb') as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            _replace(temporary_path, path)
+        return {self.REFERENCE: filename, 'dtype': str(tensor.dtype).replace('torch.', ''),
+                'shape': list(tensor.shape)}
+
+    def collect_garbage(self, directory):
+        """Delete the stored tensors that no checkpoint of directory refers to"""
+        store_directory = os.path.join(directory, self.SUBDIRECTORY)
+        referenced = set()
+        for path in glob.glob(os.path.join(directory, '*.ckpt')):
+            referenced |= self.references(path)
+        for filename in os.listdir(store_directory):
+            if filename not in referenced and not filename.startswith('.'):
+                os.unlink(os.path.join(store_directory, filename))
+
+    def references(self, path):
+        """The stored tensors the checkpoint file refers to
+
+        Only read again when the file changed. The tensors of checkpoints
+        are memory-mapped and never read, so checkpoints that do not use
+        the store only cost unpickling their structure.
+        """
+        stat = os.stat(path)
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        cached = self._checkpoint_references.get(path)
+        if cached is None or cached[0] != key:
+            references = set()
+            if not is_mapped_checkpoint(path):
+                # Which are self-contained
+                _references(torch.load(path, map_location='cpu', weights_only=True, mmap=True), references)
+            cached = self._checkpoint_references[path] = key, references
+        return cached[1]
+
+
+def load_checkpoint(path, map_location=None, keys=None):
+    """torch.load a checkpoint, written to a TensorStore or not, or load a mapped checkpoint
+
+    With keys, only those entries are returned, and of a mapped checkpoint
+    only those are read.
+    """
+    if is_mapped_checkpoint(path):
+        return load_mapped_checkpoint(path, map_location=map_location, keys=keys)
+    state = torch.load(path, map_location=map_location)
+    if keys is not None:
+        state = {key: state[key] for key in list(keys) + [TensorStore.STORE] if key in state}
+    if not isinstance(state, dict) or TensorStore.STORE not in state:
+        return state
+    store_directory = os.path.join(os.path.dirname(path), state.pop(TensorStore.STORE))
+
+    def load(value):
+        if isinstance(value, dict) and TensorStore.REFERENCE in value:
+            tensor = _load_tensor(os.path.join(store_directory, value[TensorStore.REFERENCE]),
+                                  getattr(torch, value['dtype']), value['shape'])
+            return tensor if map_location is None else tensor.to(map_location)
+        elif isinstance(value, dict):
+            loaded = type(value)((key, load(item)) for key, item in value.items())
+            if hasattr(value, '_metadata'):
+                loaded._metadata = value._metadata
+            return loaded
+        elif isinstance(value, (list, tuple)):
+            return type(value)(load(item) for item in value)
+        else:
+            return value
+
+    return load(state)
+
+
+class MappedCheckpoint:
+    """A checkpoint file laid out to be memory-mapped
+
+    The file starts with MAGIC, the length of a JSON header and the header.
+    The header indexes the tensors of the state dicts of the checkpoint,
+    that is its dict entries whose values are all tensors, like
+    state_dict and ema_state_dict. Their raw bytes follow, each buffer
+    aligned to ALIGNMENT bytes. The other entries, like the optimizer
+    state, are pickled with torch.save into a last buffer.
+
+    Loading a state dict maps the file copy-on-write and views the tensors
+    into it, so nothing is read or copied until the tensors are used, and
+    the other entries are only unpickled when asked for.
+    """
+    MAGIC = b'MTMAPPED'
+    VERSION = 1
+    ALIGNMENT = 64
+    # The key of the pickled entries in the header
+    PICKLED = '__pickled__'
+
+
+def save_mapped_checkpoint(state, path):
+    """Write state as a MappedCheckpoint, into a temporary file that is then renamed to path"""
+    sections = {key: value for key, value in state.items()
+                if isinstance(value, dict) and value and
+                all(isinstance(tensor, torch.Tensor) for tensor in value.values())}
+    pickled = io.BytesIO()
+    torch.save({key: value for key, value in state.items() if key not in sections}, pickled)
+
+    # The offsets are relative to the aligned end of the header
+    buffers, offset = [], 0
+
+    def add_buffer(data, nbytes):
+        nonlocal offset
+        entry = {'offset': offset, 'nbytes': nbytes}
+        buffers.append((entry, data))
+        offset = _align(offset + nbytes)
+        return entry
+
+    header = {'version': MappedCheckpoint.VERSION, 'keys': list(state.keys()), 'sections': {}}
+    for key, state_dict in sections.items():
+        header['sections'][key] = {
+            'tensors': {name: dict(add_buffer(_tensor_data(tensor), tensor.numel() * tensor.element_size()),
+                                   dtype=str(tensor.dtype).replace('torch.', ''), shape=list(tensor.shape))
+                        for name, tensor in state_dict.items()},
+            # The versions of the modules
+            'metadata': getattr(state_dict, '_metadata', None),
+        }
+    header[MappedCheckpoint.PICKLED] = add_buffer(pickled.getbuffer(), pickled.getbuffer().nbytes)
+    encoded_header = json.dumps(header).encode('utf-8')
+
+    temporary_path = _temporary_path(path, 'tmp')
+    file = open(temporary_path, 'wb')
+    try:
+        with file:
+            file.write(MappedCheckpoint.MAGIC)
+            file.write(struct.pack('<Q', len(encoded_header)))
+            file.write(encoded_header)
+            data_offset = _data_offset(len(encoded_header))
+            for entry, data in buffers:
+                file.write(b'\0' * (data_offset + entry['offset'] - file.tell()))
+                file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+    _replace(temporary_path, path)
+
+
+def is_mapped_checkpoint(path):
+    with open(path, 'rb') as file:
+        return file.read(len(MappedCheckpoint.MAGIC)) == MappedCheckpoint.MAGIC
+
+
+def load_mapped_checkpoint(path, map_location=None, keys=None):
+    """Load the entries of a MappedCheckpoint, by default all of them
+
+    On the CPU, the tensors of the state dicts are views into the mapped
+    file; modifying them does not change the file.
+    """
+    with open(path, 'rb') as file:
+        assert file.read(len(MappedCheckpoint.MAGIC)) == MappedCheckpoint.MAGIC, path
+        header_length, = struct.unpack('<Q', file.read(8))
+        header = json.loads(file.read(header_length).decode('utf-8'))
+        assert header['version'] == MappedCheckpoint.VERSION, header['version']
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+    data_offset = _data_offset(header_length)
+
+    keys = header['keys'] if keys is None else [key for key in keys if key in header['keys']]
+    state = {}
+    if any(key not in header['sections'] for key in keys):
+        entry = header[MappedCheckpoint.PICKLED]
+        pickled = mapped[data_offset + entry['offset']:data_offset + entry['offset'] + entry['nbytes']]
+        state.update(torch.load(io.BytesIO(pickled), map_location=map_location))
+    for key in keys:
+        if key in header['sections']:
+            section = header['sections'][key]
+            state_dict = collections.OrderedDict((name, _mapped_tensor(mapped, data_offset, entry, map_location))
+                                                 for name, entry in section['tensors'].items())
+            if section['metadata'] is not None:
+                state_dict._metadata = section['metadata']
+            state[key] = state_dict
+    return {key: state[key] for key in keys}
+
+
+def _tensor_data(tensor):
+    return tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy()
+
+
+def _mapped_tensor(mapped, data_offset, entry, map_location):
+    dtype = getattr(torch, entry['dtype'])
+    if entry['nbytes'] == 0:
+        tensor = torch.empty(entry['shape'], dtype=dtype)
+    else:
+        tensor = torch.frombuffer(mapped, dtype=torch.uint8, count=entry['nbytes'],
+                                  offset=data_offset + entry['offset'])
+        tensor = tensor.view(dtype).reshape(entry['shape'])
+    return tensor if map_location is None else tensor.to(map_location)
+
+
+def _data_offset(header_length):
+    return _align(len(MappedCheckpoint.MAGIC) + 8 + header_length)
+
+
+def _align(offset):
+    return -(-offset // MappedCheckpoint.ALIGNMENT) * MappedCheckpoint.ALIGNMENT
+
+
+def _load_tensor(path, dtype, shape):
+    with open(path, 'rb') as file:
+        data = file.read()
+    if path.endswith('.zlib'):
+        data = zlib.decompress(data)
+    if not data:
+        return torch.empty(shape, dtype=dtype)
+    return torch.frombuffer(bytearray(data), dtype=torch.uint8).view(dtype).reshape(shape)
+
+
+def _references(value, references):
+    if isinstance(value, dict):
+        if TensorStore.REFERENCE in value:
+            references.add(value[TensorStore.REFERENCE])
+        for item in value.values():
+            _references(item, references)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _references(item, references)
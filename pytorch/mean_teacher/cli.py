@@ -25,12 +25,45 @@ def create_parser():
                         help='list of image labels (default: based on directory structure)')
     parser.add_argument('--exclude-unlabeled', default=False, type=str2bool, metavar='BOOL',
                         help='exclude unlabeled examples from the training set')
+    parser.add_argument('--batch-augmentation', default=False, type=str2bool, metavar='BOOL',
+                        help='only decode and crop in the data loading workers and augment whole batches on the training device')
+    parser.add_argument('--eval-cache-dir', default=None, type=str, metavar='DIR',
+                        help='keep the transformed evaluation images in a memory-mapped cache in this directory, written in the first evaluation (default: none)')
     parser.add_argument('--arch', '-a', metavar='ARCH', default='resnet18',
                         choices=architectures.__all__,
                         help='model architecture: ' +
                             ' | '.join(architectures.__all__))
     parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
                         help='number of data loading workers (default: 4)')
+    parser.add_argument('--device', default='auto', type=str, metavar='DEVICE',
+                        choices=['auto', 'cpu', 'cuda'],
+                        help='device to train on: auto | cpu | cuda (default: auto)')
+    parser.add_argument('--intra-op-threads', default=None, type=int, metavar='N',
+                        help='number of threads used inside CPU ops (default: torch default)')
+    parser.add_argument('--inter-op-threads', default=None, type=int, metavar='N',
+                        help='number of threads running independent CPU ops (default: torch default)')
+    parser.add_argument('--mkldnn', default=True, type=str2bool, metavar='BOOL',
+                        help='use oneDNN (MKL-DNN) kernels on the CPU (default: True)')
+    parser.add_argument('--pin-threads', default=False, type=str2bool, metavar='BOOL',
+                        help='pin compute threads to their own cores and data loading workers to the rest')
+    parser.add_argument('--world-size', default=1, type=int, metavar='N',
+                        help='number of training processes with DistributedDataParallel (default: 1, a single process)')
+    parser.add_argument('--dist-backend', default='auto', type=str, metavar='BACKEND',
+                        choices=['auto', 'gloo', 'nccl'],
+                        help='torch.distributed backend: auto | gloo | nccl (default: nccl on CUDA, gloo on CPU)')
+    parser.add_argument('--dist-url', default='auto', type=str, metavar='URL',
+                        help='URL to set up the process group (default: a free local port)')
+    parser.add_argument('--dist-timeout', default=120, type=int, metavar='MINUTES',
+                        help='timeout of the collective ops, which has to cover an evaluation (default: 120)')
+    parser.add_argument('--precision', default='fp32', type=str, metavar='PRECISION',
+                        choices=['fp32', 'bf16'],
+                        help='precision of the forward passes: fp32 | bf16 (autocast with float32 weights, default: fp32)')
+    parser.add_argument('--compile', default=False, type=str2bool, metavar='BOOL',
+                        help='compile the model and the EMA model with torch.compile')
+    parser.add_argument('--compile-cache-dir', default=None, type=str, metavar='DIR',
+                        help='directory of the compiled graphs, shared by runs (default: torch default)')
+    parser.add_argument('--activation-checkpointing', default=None, type=str2segments, metavar='SEGMENTS',
+                        help='comma-separated number of activation checkpointing segments for each stage of the ResNet, 0 for none (default: none)')
     parser.add_argument('--epochs', default=90, type=int, metavar='N',
                         help='number of total epochs to run')
     parser.add_argument('--start-epoch', default=0, type=int, metavar='N',
@@ -55,6 +88,10 @@ def create_parser():
                         metavar='W', help='weight decay (default: 1e-4)')
     parser.add_argument('--ema-decay', default=0.999, type=float, metavar='ALPHA',
                         help='ema variable decay rate (default: 0.999)')
+    parser.add_argument('--ema-update-interval', default=1, type=int, metavar='STEPS',
+                        help='update the EMA model every this many steps, with the decay adjusted accordingly (default: 1)')
+    parser.add_argument('--ema-buffers', default=False, type=str2bool, metavar='BOOL',
+                        help='average the buffers of the model, like the BatchNorm statistics, in the EMA model too')
     parser.add_argument('--consistency', default=None, type=float, metavar='WEIGHT',
                         help='use consistency loss with given weight (default: None)')
     parser.add_argument('--consistency-type', default="mse", type=str, metavar='TYPE',
@@ -66,10 +103,24 @@ def create_parser():
                         help='let the student model have two outputs and use an MSE loss between the logits with the given weight (default: only have one output)')
     parser.add_argument('--checkpoint-epochs', default=1, type=int,
                         metavar='EPOCHS', help='checkpoint frequency in epochs, 0 to turn checkpointing off (default: 1)')
+    parser.add_argument('--keep-checkpoints', default=0, type=int, metavar='N',
+                        help='keep only the last N epoch checkpoints, besides the best one and those of --keep-checkpoint-every (default: 0, all)')
+    parser.add_argument('--keep-checkpoint-every', default=0, type=int, metavar='EPOCHS',
+                        help='with --keep-checkpoints, also keep the checkpoints of every this many epochs')
+    parser.add_argument('--checkpoint-store', default=False, type=str2bool, metavar='BOOL',
+                        help='write the tensors of the checkpoints to a content-addressed store, once for all the checkpoints that contain them')
+    parser.add_argument('--checkpoint-compression', default=None, type=str, metavar='COMPRESSION',
+                        choices=['zlib'],
+                        help='compress the tensors of the --checkpoint-store: zlib (default: none)')
+    parser.add_argument('--checkpoint-steps', default=0, type=int, metavar='STEPS',
+                        help='also save the full training state every this many steps to checkpoint.latest.ckpt, to resume in the middle of an epoch (default: 0, off)')
     parser.add_argument('--evaluation-epochs', default=1, type=int,
                         metavar='EPOCHS', help='evaluation frequency in epochs, 0 to turn evaluation off (default: 1)')
     parser.add_argument('--print-freq', '-p', default=10, type=int,
                         metavar='N', help='print frequency (default: 10)')
+    parser.add_argument('--train-accuracy-steps', default='all', type=str, metavar='STEPS',
+                        choices=['all', 'print'],
+                        help='training steps whose accuracy is measured: all | print (only the printed steps, default: all)')
     parser.add_argument('--resume', default='', type=str, metavar='PATH',
                         help='path to latest checkpoint (default: none)')
     parser.add_argument('-e', '--evaluate', type=str2bool,
@@ -123,3 +174,14 @@ def str2epochs(v):
         raise argparse.ArgumentTypeError(
             'Expected the epochs to be listed in increasing order')
     return epochs
+
+
+def str2segments(v):
+    try:
+        segments = [int(string) for string in v.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'Expected comma-separated list of integers, got "{}"'.format(v))
+    if any(segment < 0 for segment in segments):
+        raise argparse.ArgumentTypeError('Expected non-negative numbers of segments')
+    return segments
@@ -1,17 +1,45 @@
 """Functions to load data from folders and augment it"""
 
-import itertools
+import hashlib
 import logging
 import os.path
+import random
 
 from PIL import Image
 import numpy as np
+import torch
+from torch.nn import functional as F
 from torch.utils.data.sampler import Sampler
+import torchvision.transforms as transforms
 
 
 LOG = logging.getLogger('main')
 NO_LABEL = -1
 
+_shareable_transforms = set()
+
+
+def shareable(transform_type):
+    """Declare that a transform type is deterministic
+
+    TransformTwice applies the leading shareable transforms of a pipeline
+    only once for both views. Can be used as a class decorator.
+    Shareable transforms must not be followed by transforms that modify
+    their input in place.
+    """
+    _shareable_transforms.add(transform_type)
+    return transform_type
+
+
+def is_shareable(transform):
+    return isinstance(transform, tuple(_shareable_transforms))
+
+
+for transform_type in [transforms.Resize, transforms.CenterCrop, transforms.Grayscale,
+                       transforms.ToTensor, transforms.PILToTensor,
+                       transforms.ConvertImageDtype, transforms.Normalize]:
+    shareable(transform_type)
+
 
 
 
@@ -62,82 +90,443 @@ class RandomTranslateWithReflect:
         return new_image
 
 
+def reflect_pad(images, padding):
+    """Reflect-pad the spatial axes of an H x W x C or N x H x W x C array
+
+    This is the padding RandomTranslateWithReflect builds from flipped
+    copies of the image.
+    """
+    spatial = ((padding, padding), (padding, padding), (0, 0))
+    if images.ndim == 4:
+        spatial = ((0, 0),) + spatial
+    return np.pad(images, spatial, mode='reflect')
+
+
+def translate_with_reflect(padded_images, padding, translations, flips):
+    """Crop translated and optionally mirrored views of reflect-padded images
+
+    padded_images is an N x (H + 2 * padding) x (W + 2 * padding) x C array,
+    translations an N x 2 array of (x, y) translations and flips an array of
+    N booleans. Returns the N x H x W x C views in a single gather.
+    """
+    n, padded_height, padded_width = padded_images.shape[:3]
+    height, width = padded_height - 2 * padding, padded_width - 2 * padding
+    translations = np.asarray(translations)
+    rows = (padding - translations[:, 1])[:, None] + np.arange(height)
+    cols = (padding - translations[:, 0])[:, None] + np.arange(width)
+    cols = np.where(np.asarray(flips)[:, None], cols[:, ::-1], cols)
+    return padded_images[np.arange(n)[:, None, None], rows[:, :, None], cols[:, None, :]]
+
+
+@shareable
+class ReflectPad:
+    """Reflect-pad a C x H x W tensor (see PaddedRandomTranslateWithReflect)"""
+
+    def __init__(self, padding):
+        self.padding = padding
+
+    def __call__(self, tensor):
+        padding = self.padding
+        return F.pad(tensor, (padding, padding, padding, padding), mode='reflect')
+
+
+class PaddedRandomTranslateWithReflect:
+    """RandomTranslateWithReflect and RandomHorizontalFlip on padded arrays
+
+    Takes images that are already reflect-padded by max_translation (see
+    reflect_pad and ReflectPad) and crops each view directly from the
+    padded buffer, instead of building a new padded PIL image for every
+    view. Consumes the random numbers in the same order as the PIL
+    transforms, so with the same seeds the output is identical.
+
+    Call it with a single H x W x C array or C x H x W tensor, or use
+    batch() for a whole N x H x W x C array.
+    """
+
+    def __init__(self, max_translation, flip=True):
+        self.max_translation = max_translation
+        self.flip = flip
+
+    def __call__(self, padded_image):
+        xtranslation, ytranslation = np.random.randint(-self.max_translation,
+                                                       self.max_translation + 1,
+                                                       size=2)
+        top = self.max_translation - ytranslation
+        left = self.max_translation - xtranslation
+        flip = self.flip and torch.rand(1) < 0.5
+
+        if isinstance(padded_image, torch.Tensor):
+            height = padded_image.size(1) - 2 * self.max_translation
+            width = padded_image.size(2) - 2 * self.max_translation
+            image = padded_image[:, top:top + height, left:left + width]
+            return image.flip(2) if flip else image.contiguous()
+
+        height = padded_image.shape[0] - 2 * self.max_translation
+        width = padded_image.shape[1] - 2 * self.max_translation
+        image = padded_image[top:top + height, left:left + width]
+        if flip:
+            image = image[:, ::-1]
+        return np.ascontiguousarray(image)
+
+    def batch(self, padded_images):
+        n = len(padded_images)
+        translations = np.random.randint(-self.max_translation,
+                                         self.max_translation + 1,
+                                         size=(n, 2))
+        if self.flip:
+            flips = (torch.rand(n) < 0.5).numpy()
+        else:
+            flips = np.zeros(n, dtype=bool)
+        return translate_with_reflect(padded_images, self.max_translation, translations, flips)
+
+
 class TransformTwice:
-    def __init__(self, transform):
+    """Create two randomly augmented views of an input
+
+    The shared part of the transform is applied once and its output is
+    then fed to the random part twice. By default, the shared part is the
+    leading shareable transforms (see shareable) of a Compose.
+    """
+
+    def __init__(self, transform, shared=None):
+        if shared is None and isinstance(transform, transforms.Compose):
+            steps = transform.transforms
+            n_shared = next((idx for idx, step in enumerate(steps) if not is_shareable(step)), len(steps))
+            if n_shared > 0:
+                shared = transforms.Compose(steps[:n_shared])
+                transform = transforms.Compose(steps[n_shared:])
+        self.shared = shared
         self.transform = transform
 
     def __call__(self, inp):
+        if self.shared is not None:
+            inp = self.shared(inp)
         out1 = self.transform(inp)
         out2 = self.transform(inp)
         return out1, out2
 
 
-def relabel_dataset(dataset, labels):
-    unlabeled_idxs = []
-    for idx in range(len(dataset.imgs)):
-        path, _ = dataset.imgs[idx]
-        filename = os.path.basename(path)
-        if filename in labels:
-            label_idx = dataset.class_to_idx[labels[filename]]
-            dataset.imgs[idx] = path, label_idx
-            del labels[filename]
+class SampleTable:
+    """The (path, label) pairs of a dataset stored in contiguous arrays
+
+    Indexing and iterating behave like the list of (path, label) tuples in
+    ImageFolder.imgs. The paths are UTF-8 bytes in a single buffer with an
+    array of offsets, relative to root if it is given, and the labels are
+    an int64 array. Unlike a list of tuples, the table has no per-sample
+    Python objects, so forked data loading workers never touch (and copy)
+    its pages.
+    """
+
+    def __init__(self, buffer, offsets, labels, root=None):
+        assert len(offsets) == len(labels) + 1
+        self.buffer = buffer
+        self.offsets = offsets
+        self.labels = labels
+        self.root = root
+
+    @classmethod
+    def from_paths(cls, paths, labels, root=None):
+        encoded = np.char.encode(np.asarray(paths, dtype=np.str_), 'utf-8')
+        lengths = np.char.str_len(encoded).astype(np.int64)
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        if len(encoded) > 0 and encoded.itemsize > 0:
+            chars = encoded.view(np.uint8).reshape(len(encoded), encoded.itemsize)
+            buffer = chars[np.arange(encoded.itemsize) < lengths[:, None]]
         else:
-            dataset.imgs[idx] = path, NO_LABEL
-            unlabeled_idxs.append(idx)
+            buffer = np.zeros(0, dtype=np.uint8)
+        return cls(buffer, offsets, np.array(labels, dtype=np.int64), root)
 
-    if len(labels) != 0:
+    @classmethod
+    def from_samples(cls, samples):
+        paths = [path for path, _ in samples]
+        labels = [label for _, label in samples]
+        return cls.from_paths(paths, labels)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def path(self, index):
+        path = self.buffer[self.offsets[index]:self.offsets[index + 1]].tobytes().decode('utf-8')
+        if self.root is not None:
+            path = os.path.join(self.root, path)
+        return path
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.path(index), int(self.labels[index])
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+    def basenames(self):
+        """The file names of all the samples as a fixed-width bytes array"""
+        starts, ends = self.offsets[:-1], self.offsets[1:]
+        # A file name starts after the last slash of its path
+        slashes = np.flatnonzero(self.buffer == ord('/'))
+        if len(slashes) > 0:
+            last_slashes = np.searchsorted(slashes, ends) - 1
+            # Or of an earlier path, when the path has no slash
+            has_slash = last_slashes >= 0
+            has_slash[has_slash] = slashes[last_slashes[has_slash]] >= starts[has_slash]
+            starts = np.where(has_slash, slashes[last_slashes.clip(min=0)] + 1, starts)
+        lengths = ends - starts
+        width = max(int(lengths.max(initial=0)), 1)
+        # A column at a time, with temporaries of the size of the table
+        # rather than of the result
+        chars = np.zeros((len(lengths), width), dtype=np.uint8)
+        for column in range(width):
+            within = lengths > column
+            chars[within, column] = self.buffer[starts[within] + column]
+        return chars.view('S{}'.format(width)).reshape(-1)
+
+
+def sample_table(dataset):
+    """The samples of the dataset, converted to a SampleTable if needed"""
+    if not isinstance(dataset.imgs, SampleTable):
+        dataset.imgs = dataset.samples = SampleTable.from_samples(dataset.imgs)
+        dataset.targets = dataset.imgs.labels
+    return dataset.imgs
+
+
+def relabel_dataset(dataset, labels):
+    """Replace the labels of the dataset with those in the labels dict
+
+    labels maps file names to class names. The samples that are not in it
+    get NO_LABEL, and so do all but the first of the samples with the same
+    file name. The matching is vectorized over the sample table of the
+    dataset. Returns the arrays of labeled and unlabeled indices.
+    """
+    samples = sample_table(dataset)
+
+    filenames = samples.basenames()
+    label_filenames = np.char.encode(np.array(list(labels.keys()), dtype=np.str_), 'utf-8')
+    label_idxs = np.array([dataset.class_to_idx[class_name] for class_name in labels.values()],
+                          dtype=np.int64)
+
+    samples.labels[:] = NO_LABEL
+    is_labeled = np.zeros(len(samples), dtype=bool)
+    is_known = np.zeros(len(labels), dtype=bool)
+    if len(labels) > 0:
+        order = np.argsort(label_filenames)
+        positions = np.searchsorted(label_filenames[order], filenames).clip(max=len(labels) - 1)
+        is_labeled = label_filenames[order][positions] == filenames
+        # Each file name labels its first sample only
+        _, first_samples = np.unique(order[positions[is_labeled]], return_index=True)
+        duplicates = np.ones(is_labeled.sum(), dtype=bool)
+        duplicates[first_samples] = False
+        is_labeled[np.flatnonzero(is_labeled)[duplicates]] = False
+        matches = order[positions[is_labeled]]
+        is_known[matches] = True
+        samples.labels[is_labeled] = label_idxs[matches]
+
+    if not is_known.all():
         message = "List of unlabeled contains {} unknown files: {}, ..."
-        some_missing = ', '.join(list(labels.keys())[:5])
-        raise LookupError(message.format(len(labels), some_missing))
+        unknown = [name.decode('utf-8') for name in label_filenames[~is_known]]
+        raise LookupError(message.format(len(unknown), ', '.join(unknown[:5])))
 
-    labeled_idxs = sorted(set(range(len(dataset.imgs))) - set(unlabeled_idxs))
+    labeled_idxs = np.flatnonzero(is_labeled)
+    unlabeled_idxs = np.flatnonzero(~is_labeled)
 
     return labeled_idxs, unlabeled_idxs
 
 
+def read_labels(labels_path):
+    """Read a label file with a "filename class" pair on each line"""
+    with open(labels_path) as f:
+        return dict(line.split(' ') for line in f.read().splitlines())
+
+
+def dataset_fingerprint(dataset):
+    """A hash of the classes and the sample paths of the dataset
+
+    The labels of the samples are not included, so relabeling does not
+    change the fingerprint.
+    """
+    samples = sample_table(dataset)
+    digest = hashlib.sha1()
+    digest.update('\n'.join(sorted(dataset.class_to_idx, key=dataset.class_to_idx.get)).encode('utf-8'))
+    digest.update(samples.offsets.tobytes())
+    digest.update(samples.buffer.tobytes())
+    return digest.hexdigest()
+
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+# Changes recompile the existing label splits
+LABEL_SPLIT_VERSION = 2
+
+
+def label_split_path(labels_path, fingerprint):
+    """The compiled split of labels/00.txt is labels/00.<fingerprint>.split.npz
+
+    The fingerprint is the one of the dataset the split indexes into, so
+    the splits of the same label file for different datasets can coexist.
+    """
+    root, _ = os.path.splitext(labels_path)
+    return "{}.{}.split.npz".format(root, fingerprint[:16])
+
+
+def compile_label_split(dataset, labels_path):
+    """Relabel the dataset with a label file and write the split next to it
+
+    Returns the arrays of labeled and unlabeled indices like relabel_dataset.
+    """
+    fingerprint = dataset_fingerprint(dataset)
+    labeled_idxs, unlabeled_idxs = relabel_dataset(dataset, read_labels(labels_path))
+    split = {
+        'version': np.array(LABEL_SPLIT_VERSION),
+        'fingerprint': np.array(fingerprint),
+        'labels_digest': np.array(file_digest(labels_path)),
+        'labeled_idxs': labeled_idxs,
+        'unlabeled_idxs': unlabeled_idxs,
+        'targets': dataset.imgs.labels[labeled_idxs],
+    }
+    split_path = label_split_path(labels_path, fingerprint)
+    tmp_path = "{}.{}.tmp.npz".format(split_path, os.getpid())
+    try:
+        np.savez(tmp_path, **split)
+        os.replace(tmp_path, split_path)
+    except OSError as error:
+        LOG.warning("=> could not save label split %s: %s", split_path, error)
+    return labeled_idxs, unlabeled_idxs
+
+
+def load_label_split(dataset, labels_path):
+    """Relabel the dataset with a label file
+
+    Uses the compiled split of the label file for this dataset if there
+    is an up-to-date one (see compile_label_split), and compiles it
+    otherwise. Returns the arrays of labeled and unlabeled indices like
+    relabel_dataset.
+    """
+    fingerprint = dataset_fingerprint(dataset)
+    split_path = label_split_path(labels_path, fingerprint)
+    try:
+        with np.load(split_path) as stored:
+            split = {key: stored[key] for key in stored.files}
+    except FileNotFoundError:
+        return compile_label_split(dataset, labels_path)
+    except (OSError, ValueError) as error:
+        LOG.warning("=> ignoring unreadable label split %s: %s", split_path, error)
+        return compile_label_split(dataset, labels_path)
+
+    if (int(split.get('version', 0)) != LABEL_SPLIT_VERSION or
+            str(split.get('fingerprint')) != fingerprint or
+            str(split.get('labels_digest')) != file_digest(labels_path)):
+        return compile_label_split(dataset, labels_path)
+
+    samples = sample_table(dataset)
+    samples.labels[:] = NO_LABEL
+    samples.labels[split['labeled_idxs']] = split['targets']
+    return split['labeled_idxs'], split['unlabeled_idxs']
+
+
 class TwoStreamBatchSampler(Sampler):
     """Iterate two sets of indices
 
     An 'epoch' is one iteration through the primary indices.
     During the epoch, the secondary indices are iterated through
     as many times as needed.
+
+    The batches of an epoch are int64 arrays drawn from a random state
+    seeded at the start of the epoch, so state_dict() can describe the
+    position within the epoch with just the seed and a batch cursor.
+    After load_state_dict() the next iteration continues the saved epoch
+    with exactly the same batches. The seed is kept after the epoch is
+    over, as the data loader can be done with the sampler before the
+    training loop is done with the batches.
     """
     def __init__(self, primary_indices, secondary_indices, batch_size, secondary_batch_size):
-        self.primary_indices = primary_indices
-        self.secondary_indices = secondary_indices
+        self.primary_indices = np.asarray(primary_indices, dtype=np.int64)
+        self.secondary_indices = np.asarray(secondary_indices, dtype=np.int64)
         self.secondary_batch_size = secondary_batch_size
         self.primary_batch_size = batch_size - secondary_batch_size
+        self.epoch_seed = None
+        self.cursor = 0
 
         assert len(self.primary_indices) >= self.primary_batch_size > 0
         assert len(self.secondary_indices) >= self.secondary_batch_size > 0
 
     def __iter__(self):
-        primary_iter = iterate_once(self.primary_indices)
-        secondary_iter = iterate_eternally(self.secondary_indices)
-        return (
-            primary_batch + secondary_batch
-            for (primary_batch, secondary_batch)
-            in  zip(grouper(primary_iter, self.primary_batch_size),
-                    grouper(secondary_iter, self.secondary_batch_size))
-        )
+        if self.epoch_seed is None or self.cursor >= len(self):
+            self.epoch_seed = self.new_epoch_seed()
+            self.cursor = 0
+        batches = self.epoch_batches(self.epoch_seed)
+        while self.cursor < len(batches):
+            self.cursor += 1
+            yield batches[self.cursor - 1]
+
+    def new_epoch_seed(self):
+        return np.random.randint(2 ** 31)
+
+    def epoch_batches(self, seed):
+        """All the batches of an epoch as a len(self) x batch_size array"""
+        random_state = np.random.RandomState(seed)
+        n_batches = len(self)
+        primary = random_state.permutation(self.primary_indices)
+        primary = primary[:n_batches * self.primary_batch_size].reshape(n_batches, -1)
+        n_secondary = n_batches * self.secondary_batch_size
+        n_shuffles = -(-n_secondary // len(self.secondary_indices))
+        secondary = np.concatenate([random_state.permutation(self.secondary_indices)
+                                    for _ in range(n_shuffles)])
+        secondary = secondary[:n_secondary].reshape(n_batches, -1)
+        return np.concatenate([primary, secondary], axis=1)
+
+    def state_dict(self, cursor=None):
+        """The position of the sampler within the current epoch
+
+        The data loader workers prefetch batches, so the sampler is ahead of
+        the training loop. Pass the number of batches the training loop has
+        consumed as cursor to resume right after the last trained batch.
+        """
+        return {
+            'epoch_seed': self.epoch_seed,
+            'cursor': self.cursor if cursor is None else cursor,
+        }
+
+    def load_state_dict(self, state_dict):
+        self.epoch_seed = state_dict['epoch_seed']
+        self.cursor = state_dict['cursor']
 
     def __len__(self):
         return len(self.primary_indices) // self.primary_batch_size
 
 
-def iterate_once(iterable):
-    return np.random.permutation(iterable)
+class BatchSeededDataset(torch.utils.data.Dataset):
+    """Draw the random augmentations of each batch from a seed of its indices
 
+    In the data loader workers, the Python, NumPy and torch random states
+    are seeded from the indices of each batch before it is loaded. The
+    augmentations of a batch then do not depend on which worker loads it
+    or on how many batches the worker loaded before, so a run resumed in
+    the middle of an epoch gets exactly the same batches. Without workers
+    the random states of the main process are left alone.
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, index):
+        return self.dataset[index]
 
-def iterate_eternally(indices):
-    def infinite_shuffles():
-        while True:
-            yield np.random.permutation(indices)
-    return itertools.chain.from_iterable(infinite_shuffles())
+    def __getitems__(self, indices):
+        if torch.utils.data.get_worker_info() is not None:
+            seed = batch_seed(indices)
+            random.seed(seed)
+            np.random.seed(seed % 2 ** 32)
+            torch.manual_seed(seed)
+        return [self.dataset[index] for index in indices]
+
+    def __len__(self):
+        return len(self.dataset)
 
 
-def grouper(iterable, n):
-    "Collect data into fixed-length chunks or blocks"
-    # grouper('ABCDEFG', 3) --> ABC DEF"
-    args = [iter(iterable)] * n
-    return zip(*args)
+def batch_seed(indices):
+    digest = hashlib.sha1(np.asarray(indices, dtype=np.int64).tobytes()).digest()
+    return int.from_bytes(digest[:8], 'little') >> 1
@@ -1,21 +1,42 @@
 import torchvision.transforms as transforms
 
-from . import data
+from . import data, batch_transforms
 from .utils import export
 
 
+# With batch_augmentation=True, the train_transformation only decodes
+# and crops the images to uint8 tensors in the data loading workers.
+# The rest of the augmentation, including creating the two views, is
+# done by train_batch_transformation on the collated batches.
+
+
 @export
-def imagenet():
+def imagenet(batch_augmentation=False):
     channel_stats = dict(mean=[0.485, 0.456, 0.406],
                          std=[0.229, 0.224, 0.225])
-    train_transformation = data.TransformTwice(transforms.Compose([
-        transforms.RandomRotation(10),
-        transforms.RandomResizedCrop(224),
-        transforms.RandomHorizontalFlip(),
-        transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.4, hue=0.1),
-        transforms.ToTensor(),
-        transforms.Normalize(**channel_stats)
-    ]))
+    if batch_augmentation:
+        # Both views share the rotation and the crop
+        train_transformation = transforms.Compose([
+            transforms.RandomRotation(10),
+            transforms.RandomResizedCrop(224),
+            transforms.PILToTensor()
+        ])
+        train_batch_transformation = batch_transforms.TransformTwice(batch_transforms.Compose([
+            batch_transforms.ToFloat(),
+            batch_transforms.RandomHorizontalFlip(),
+            batch_transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.4, hue=0.1),
+            batch_transforms.Normalize(**channel_stats)
+        ]))
+    else:
+        train_transformation = data.TransformTwice(transforms.Compose([
+            transforms.RandomRotation(10),
+            transforms.RandomResizedCrop(224),
+            transforms.RandomHorizontalFlip(),
+            transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.4, hue=0.1),
+            transforms.ToTensor(),
+            transforms.Normalize(**channel_stats)
+        ]))
+        train_batch_transformation = None
     eval_transformation = transforms.Compose([
         transforms.Resize(256),
         transforms.CenterCrop(224),
@@ -25,6 +46,7 @@ def imagenet():
 
     return {
         'train_transformation': train_transformation,
+        'train_batch_transformation': train_batch_transformation,
         'eval_transformation': eval_transformation,
         'datadir': 'data-local/images/ilsvrc2012/',
         'num_classes': 1000
@@ -32,15 +54,28 @@ def imagenet():
 
 
 @export
-def cifar10():
+def cifar10(batch_augmentation=False):
     channel_stats = dict(mean=[0.4914, 0.4822, 0.4465],
                          std=[0.2470,  0.2435,  0.2616])
-    train_transformation = data.TransformTwice(transforms.Compose([
-        data.RandomTranslateWithReflect(4),
-        transforms.RandomHorizontalFlip(),
-        transforms.ToTensor(),
-        transforms.Normalize(**channel_stats)
-    ]))
+    if batch_augmentation:
+        train_transformation = transforms.PILToTensor()
+        train_batch_transformation = batch_transforms.TransformTwice(batch_transforms.Compose([
+            batch_transforms.ToFloat(),
+            batch_transforms.RandomTranslateWithReflect(4),
+            batch_transforms.RandomHorizontalFlip(),
+            batch_transforms.Normalize(**channel_stats)
+        ]))
+    else:
+        # Same output as RandomTranslateWithReflect(4) + RandomHorizontalFlip()
+        # before ToTensor() + Normalize(), but the views share everything
+        # except the final crop
+        train_transformation = data.TransformTwice(transforms.Compose([
+            transforms.ToTensor(),
+            transforms.Normalize(**channel_stats),
+            data.ReflectPad(4),
+            data.PaddedRandomTranslateWithReflect(4)
+        ]))
+        train_batch_transformation = None
     eval_transformation = transforms.Compose([
         transforms.ToTensor(),
         transforms.Normalize(**channel_stats)
@@ -48,7 +83,37 @@ def cifar10():
 
     return {
         'train_transformation': train_transformation,
+        'train_batch_transformation': train_batch_transformation,
         'eval_transformation': eval_transformation,
         'datadir': 'data-local/images/cifar/cifar10/by-image',
         'num_classes': 10
     }
+
+
+@export
+def cifar10_packed(batch_augmentation=False):
+    """CIFAR-10 read from the packed arrays written by data-local/bin/pack_cifar10.py
+
+    The training images are stored reflect-padded, so that the translations
+    are crops of the padded arrays.
+    """
+    if batch_augmentation:
+        return {
+            **cifar10(batch_augmentation=True),
+            'datadir': 'data-local/images/cifar/cifar10/packed'
+        }
+
+    channel_stats = dict(mean=[0.4914, 0.4822, 0.4465],
+                         std=[0.2470,  0.2435,  0.2616])
+    train_transformation = data.TransformTwice(transforms.Compose([
+        transforms.ToTensor(),
+        transforms.Normalize(**channel_stats),
+        data.PaddedRandomTranslateWithReflect(4)
+    ]))
+
+    return {
+        **cifar10(),
+        'train_transformation': train_transformation,
+        'train_reflect_padding': 4,
+        'datadir': 'data-local/images/cifar/cifar10/packed'
+    }
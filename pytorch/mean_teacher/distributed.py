@@ -0,0 +1,117 @@
+"""Multi-process training with torch.distributed
+
+main.py runs one process per --world-size with torch.multiprocessing.
+Each process trains its own replica of the student under
+DistributedDataParallel on its shard of every batch. Only the main
+process (rank 0) logs metrics, evaluates and writes checkpoints.
+"""
+
+import datetime
+import logging
+import socket
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+from .data import TwoStreamBatchSampler
+
+
+LOG = logging.getLogger('main')
+
+
+def free_local_url():
+    """A TCP URL on a free port of this host, for single-node runs"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return 'tcp://127.0.0.1:{}'.format(sock.getsockname()[1])
+
+
+def init_process_group(rank, world_size, device, backend='auto', url='auto', timeout_minutes=120):
+    """Join the process group and return the device of this process
+
+    backend 'auto' picks nccl for CUDA and gloo for the CPU. With CUDA,
+    the processes on a node take one GPU each. The collective ops fail
+    after timeout_minutes, which has to cover the evaluation of the main
+    process, as the other processes wait for it at a barrier.
+    """
+    if backend == 'auto':
+        backend = 'nccl' if device.type == 'cuda' else 'gloo'
+    if device.type == 'cuda':
+        device = torch.device('cuda', rank % torch.cuda.device_count())
+        torch.cuda.set_device(device)
+    dist.init_process_group(backend, init_method=url, rank=rank, world_size=world_size,
+                            timeout=datetime.timedelta(minutes=timeout_minutes))
+    if rank != 0:
+        # Metrics are reported by the main process only
+        LOG.setLevel(logging.WARNING)
+    LOG.info("=> process group of %d processes on the %s backend", world_size, backend)
+    return device
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def is_main_process():
+    return not is_distributed() or dist.get_rank() == 0
+
+
+def rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def all_gather_object(obj):
+    """The objects of all the processes, by rank"""
+    if not is_distributed():
+        return [obj]
+    objects = [None] * dist.get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
+
+
+def average_buffers(module):
+    """Average the floating point buffers of module, like the BatchNorm statistics, over the processes"""
+    if not is_distributed():
+        return
+    for buffer in module.buffers():
+        if buffer.is_floating_point():
+            dist.all_reduce(buffer)
+            buffer.div_(dist.get_world_size())
+
+
+class DistributedTwoStreamBatchSampler(TwoStreamBatchSampler):
+    """TwoStreamBatchSampler that shards both streams across processes
+
+    Every process draws the same global batches of num_replicas times
+    batch_size indices, with the epoch seed broadcast from rank 0, and
+    takes its own slice of the primary and of the secondary part. The
+    batch sizes are those of a single process.
+    """
+    def __init__(self, primary_indices, secondary_indices, batch_size, secondary_batch_size,
+                 num_replicas=None, rank=None):
+        self.num_replicas = dist.get_world_size() if num_replicas is None else num_replicas
+        self.rank = dist.get_rank() if rank is None else rank
+        super().__init__(primary_indices, secondary_indices,
+                         batch_size * self.num_replicas,
+                         secondary_batch_size * self.num_replicas)
+
+    def new_epoch_seed(self):
+        seed = [super().new_epoch_seed()]
+        if is_distributed():
+            dist.broadcast_object_list(seed, src=0)
+        return seed[0]
+
+    def epoch_batches(self, seed):
+        batches = super().epoch_batches(seed)
+        primary = batches[:, :self.primary_batch_size]
+        secondary = batches[:, self.primary_batch_size:]
+        return np.concatenate([self._shard(primary), self._shard(secondary)], axis=1)
+
+    def _shard(self, batches):
+        return batches.reshape(len(batches), self.num_replicas, -1)[:, self.rank]
@@ -0,0 +1,70 @@
+"""Updating the mean teacher as an exponential moving average of the student"""
+
+import math
+
+import torch
+
+
+class ExponentialMovingAverage:
+    """Keeps the parameters of ema_model an exponential moving average of model
+
+    The tensors are updated with multi-tensor ops, a few kernel launches for
+    the whole model instead of two per tensor. With buffers, the floating
+    point buffers (e.g. the BatchNorm running statistics) are averaged too
+    and the others (e.g. num_batches_tracked) copied.
+
+    With interval k, the teacher is only updated every k steps, from the
+    current student. The decay is then the product of the decays of the
+    k steps, so the old average keeps the same weight as with per-step
+    updates.
+    """
+
+    def __init__(self, model, ema_model, alpha, interval=1, buffers=False):
+        assert interval >= 1
+        self.alpha = alpha
+        self.interval = interval
+        self.params = list(model.parameters())
+        self.ema_params = list(ema_model.parameters())
+        self.float_buffers, self.ema_float_buffers = [], []
+        self.other_buffers, self.ema_other_buffers = [], []
+        if buffers:
+            for buffer, ema_buffer in zip(model.buffers(), ema_model.buffers()):
+                if buffer.is_floating_point():
+                    self.float_buffers.append(buffer)
+                    self.ema_float_buffers.append(ema_buffer)
+                else:
+                    self.other_buffers.append(buffer)
+                    self.ema_other_buffers.append(ema_buffer)
+
+    def decay(self, global_step):
+        """The weight of the old average when updating after global_step"""
+        # Use the true average until the exponential average is more correct
+        return math.prod(min(1 - 1 / (step + 1), self.alpha)
+                         for step in range(global_step - self.interval + 1, global_step + 1))
+
+    def update(self, global_step):
+        """Update the teacher after global_step steps, if it is due"""
+        if global_step % self.interval != 0:
+            return
+        decay = self.decay(global_step)
+        with torch.no_grad():
+            self._average(self.ema_params, self.params, decay)
+            self._average(self.ema_float_buffers, self.float_buffers, decay)
+            for ema_buffer, buffer in zip(self.ema_other_buffers, self.other_buffers):
+                ema_buffer.copy_(buffer)
+
+    @staticmethod
+    def _average(ema_tensors, tensors, decay):
+        if ema_tensors:
+            # A single pass over the memory, unlike a mul_ followed by an add_
+            _foreach_lerp_(ema_tensors, tensors, 1 - decay)
+
+
+def _foreach_lerp_(tensors, ends, weight):
+    # torch._foreach_lerp_ is private, so fall back to a lerp_ per tensor
+    # where it is missing
+    if hasattr(torch, '_foreach_lerp_'):
+        torch._foreach_lerp_(tensors, ends, weight)
+    else:
+        for tensor, end in zip(tensors, ends):
+            tensor.lerp_(end, weight)
@@ -0,0 +1,195 @@
+"""A cache of the evaluation images after their deterministic transforms
+
+The evaluation transformations of the datasets are deterministic, so
+decoding and transforming the evaluation set again at every evaluation
+gives the same images every time. CachingEvalLoader keeps them in a
+memory-mapped uint8 array instead, before ToTensor() and Normalize(),
+which are then applied to whole batches on the device.
+"""
+
+import copy
+import glob
+import hashlib
+import logging
+import os
+import time
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from torch.utils.data.sampler import BatchSampler, SequentialSampler
+
+from . import batch_transforms, data, folders
+
+
+LOG = logging.getLogger('main')
+
+# Changes invalidate the existing caches
+CACHE_VERSION = 1
+# The caches of a dataset unused for this long are removed when a new one is written
+STALE_CACHE_SECONDS = 7 * 24 * 60 * 60
+
+
+def split_transform(transform):
+    """Split Compose([..., ToTensor(), Normalize()]) into an image transform and a batch transform
+
+    The image transform applies the transforms before ToTensor() and
+    returns C x H x W uint8 tensors. The batch transform turns batches of
+    those into the normalized float batches the original transform would
+    give.
+    """
+    assert isinstance(transform, transforms.Compose), transform
+    *image_transforms, to_tensor, normalize = transform.transforms
+    assert isinstance(to_tensor, transforms.ToTensor) and isinstance(normalize, transforms.Normalize), \
+        "expected the transform to end with ToTensor() and Normalize(), got {}".format(transform)
+    image_transform = transforms.Compose(image_transforms + [transforms.PILToTensor()])
+    batch_transform = batch_transforms.Compose([
+        batch_transforms.ToFloat(),
+        batch_transforms.Normalize(mean=normalize.mean, std=normalize.std)
+    ])
+    return image_transform, batch_transform
+
+
+def cache_key(dataset, image_transform):
+    """A hash of the image transform and of the samples and the files of the dataset"""
+    digest = hashlib.sha1('{} {!r}'.format(CACHE_VERSION, image_transform).encode('utf-8'))
+    digest.update(data.dataset_fingerprint(dataset).encode('utf-8'))
+    if folders.is_packed(dataset.root):
+        paths = [os.path.join(dataset.root, folders.PACKED_IMAGES)]
+    else:
+        paths = [dataset.imgs.path(index) for index in range(len(dataset))]
+    stats = [os.stat(path) for path in paths]
+    digest.update(np.array([(stat.st_size, stat.st_mtime_ns) for stat in stats], dtype=np.int64).tobytes())
+    return digest.hexdigest()
+
+
+def cache_path(directory, root, key):
+    """The cache of data/val is directory/val.<hash of the root path>.<key>.eval_cache.npy"""
+    root = os.path.abspath(root)
+    root_digest = hashlib.sha1(root.encode('utf-8')).hexdigest()
+    return os.path.join(directory, "{}.{}.{}.eval_cache.npy".format(
+        os.path.basename(root), root_digest[:8], key[:16]))
+
+
+class CachedImages(torch.utils.data.Dataset):
+    """The cached images and the targets of a dataset, indexed by lists of indices
+
+    dataset[indices] is a whole batch, an N x C x H x W uint8 tensor and
+    the targets, to be used with a BatchSampler as the sampler.
+    """
+
+    def __init__(self, path, targets):
+        self.path = path
+        self.targets = np.asarray(targets)
+        self._images = None
+
+    @property
+    def images(self):
+        # Opened lazily so that every worker process maps the file itself
+        if self._images is None:
+            self._images = np.load(self.path, mmap_mode='r')
+        return self._images
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, indices):
+        if indices[-1] - indices[0] == len(indices) - 1:
+            # Consecutive, as in the evaluation
+            images = self.images[indices[0]:indices[-1] + 1]
+        else:
+            images = self.images[indices]
+        return torch.from_numpy(np.array(images)), torch.from_numpy(self.targets[indices])
+
+
+class CachingEvalLoader:
+    """Iterate over the batches of an evaluation set, from the cache once there is one
+
+    dataset is an image folder and transform its evaluation transformation
+    (see split_transform). The first pass decodes and transforms the
+    images like a DataLoader would and writes them to a cache in
+    cache_directory, and the later passes, also of later runs, only read
+    the cache. The cache is rewritten when the transformation, the samples
+    or the files of the dataset change, and the caches of the same dataset
+    unused for STALE_CACHE_SECONDS are then removed. Like batch_transforms.TransformingLoader,
+    the loader yields the inputs on the device.
+    """
+
+    def __init__(self, dataset, transform, cache_directory, batch_size, device, num_workers=0,
+                 pin_memory=False, worker_init_fn=None):
+        self.image_transform, self.batch_transform = split_transform(transform)
+        self.dataset = copy.copy(dataset)
+        self.dataset.transform = self.image_transform
+        self.cache_directory = cache_directory
+        self.batch_size = batch_size
+        self.device = device
+        self.loader_args = dict(num_workers=num_workers, pin_memory=pin_memory, worker_init_fn=worker_init_fn)
+        self.path = None
+
+    def __iter__(self):
+        if self.path is None:
+            self.path = cache_path(self.cache_directory, self.dataset.root,
+                                   cache_key(self.dataset, self.image_transform))
+        if os.path.isfile(self.path):
+            # Marks the cache as in use, see _remove_stale_caches. Reading
+            # needs no write access, e.g. to a shared cache directory.
+            try:
+                os.utime(self.path)
+            except OSError:
+                pass
+            batches = self._cached_batches()
+        else:
+            batches = self._caching_batches()
+        for input, target in batches:
+            input = input.to(self.device, non_blocking=True)
+            yield self.batch_transform(input), target
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def _cached_batches(self):
+        cached_images = CachedImages(self.path, self.dataset.targets)
+        sampler = BatchSampler(SequentialSampler(cached_images), self.batch_size, drop_last=False)
+        return torch.utils.data.DataLoader(cached_images, sampler=sampler, batch_size=None, **self.loader_args)
+
+    def _caching_batches(self):
+        LOG.info("=> caching the evaluation images in %s", self.path)
+        loader = torch.utils.data.DataLoader(self.dataset, batch_size=self.batch_size, shuffle=False,
+                                             drop_last=False, **self.loader_args)
+        os.makedirs(self.cache_directory, exist_ok=True)
+        temporary_path = "{}.{}.tmp.npy".format(self.path, os.getpid())
+        cache, start = None, 0
+        try:
+            for input, target in loader:
+                if cache is None:
+                    cache = np.lib.format.open_memmap(temporary_path, mode='w+', dtype=np.uint8,
+                                                      shape=(len(self.dataset),) + tuple(input.shape[1:]))
+                cache[start:start + len(input)] = input.numpy()
+                start += len(input)
+                yield input, target
+            cache.flush()
+            del cache
+            os.replace(temporary_path, self.path)
+        finally:
+            if os.path.exists(temporary_path):
+                # After an interrupted pass
+                os.unlink(temporary_path)
+        self._remove_stale_caches()
+
+    def _remove_stale_caches(self):
+        # Of the same dataset root and unused for a while, since other runs
+        # may be using the caches of other transformations
+        prefix = self.path[:-len('.eval_cache.npy')].rsplit('.', 1)[0]
+        for path in glob.glob(glob.escape(prefix) + '.*.eval_cache.npy'):
+            try:
+                if path != self.path and time.time() - os.stat(path).st_mtime > STALE_CACHE_SECONDS:
+                    os.unlink(path)
+                    LOG.info("=> removed the stale evaluation cache %s", path)
+            except FileNotFoundError:
+                # Removed by another run
+                pass
@@ -0,0 +1,245 @@
+"""Image datasets stored as packed arrays or as image folders"""
+
+import logging
+import os
+
+from PIL import Image
+import numpy as np
+import torch.utils.data
+import torchvision.datasets
+from torchvision.datasets.folder import IMG_EXTENSIONS, default_loader, has_file_allowed_extension
+
+from .data import reflect_pad, SampleTable
+
+
+LOG = logging.getLogger('main')
+
+PACKED_IMAGES = 'images.npy'
+PACKED_LABELS = 'labels.npy'
+PACKED_FILENAMES = 'filenames.npy'
+PACKED_CLASSES = 'classes.npy'
+
+
+def image_folder(root, transform=None, reflect_padding=0):
+    """Open a packed dataset if there is one in root and an indexed ImageFolder otherwise
+
+    reflect_padding is only supported by packed datasets. See
+    PackedImageFolder.
+    """
+    if is_packed(root):
+        return PackedImageFolder(root, transform, reflect_padding=reflect_padding)
+    assert not reflect_padding, "reflect padding needs a packed dataset in {}".format(root)
+    return IndexedImageFolder(root, transform)
+
+
+def is_packed(root):
+    return os.path.isfile(os.path.join(root, PACKED_IMAGES))
+
+
+def write_packed(root, images, labels, filenames, classes):
+    """Write a packed dataset
+
+    images is an N x H x W x C uint8 array, labels are class indices into
+    classes and filenames are the names the images would have in an
+    ImageFolder (they are used to match the label files).
+    """
+    images = np.ascontiguousarray(images, dtype=np.uint8)
+    assert images.ndim == 4
+    assert len(images) == len(labels) == len(filenames)
+    os.makedirs(root, exist_ok=True)
+    np.save(os.path.join(root, PACKED_IMAGES), images)
+    np.save(os.path.join(root, PACKED_LABELS), np.asarray(labels, dtype=np.int64))
+    np.save(os.path.join(root, PACKED_FILENAMES), np.asarray(filenames, dtype=np.str_))
+    np.save(os.path.join(root, PACKED_CLASSES), np.asarray(classes, dtype=np.str_))
+
+
+class PackedImageFolder(torch.utils.data.Dataset):
+    """Drop-in replacement of ImageFolder for a packed dataset
+
+    The images are a single memory-mapped uint8 array, so there is nothing
+    to decode and the data loading workers share the pages of the file.
+    Like in ImageFolder, imgs holds the (filename, class index) pairs
+    that relabel_dataset rewrites, but as a data.SampleTable.
+
+    With reflect_padding, the transform gets H x W x C uint8 arrays that
+    are reflect-padded by that many pixels instead of PIL images (see
+    data.PaddedRandomTranslateWithReflect). The padded copy of the images
+    is written next to the original array once and memory-mapped as well.
+    """
+
+    def __init__(self, root, transform=None, target_transform=None, reflect_padding=0):
+        self.root = root
+        self.transform = transform
+        self.target_transform = target_transform
+        self.reflect_padding = reflect_padding
+
+        self.classes = [str(name) for name in np.load(os.path.join(root, PACKED_CLASSES))]
+        self.class_to_idx = {name: idx for idx, name in enumerate(self.classes)}
+        filenames = np.load(os.path.join(root, PACKED_FILENAMES))
+        labels = np.load(os.path.join(root, PACKED_LABELS))
+        self.imgs = self.samples = SampleTable.from_paths(filenames, labels)
+        self.targets = self.imgs.labels
+        self._images = None
+
+        if reflect_padding and not os.path.isfile(self._images_path()):
+            self._write_padded_images()
+
+    @property
+    def images(self):
+        # Opened lazily so that every worker process maps the file itself
+        if self._images is None:
+            self._images = np.load(self._images_path(), mmap_mode='r')
+        return self._images
+
+    def _images_path(self):
+        if self.reflect_padding:
+            return os.path.join(self.root, 'images.reflect{}.npy'.format(self.reflect_padding))
+        return os.path.join(self.root, PACKED_IMAGES)
+
+    def _write_padded_images(self, chunk_size=4096):
+        images = np.load(os.path.join(self.root, PACKED_IMAGES), mmap_mode='r')
+        n, height, width, channels = images.shape
+        padding = self.reflect_padding
+        tmp_path = "{}.{}.tmp".format(self._images_path(), os.getpid())
+        padded = np.lib.format.open_memmap(
+            tmp_path, mode='w+', dtype=np.uint8,
+            shape=(n, height + 2 * padding, width + 2 * padding, channels))
+        for start in range(0, n, chunk_size):
+            padded[start:start + chunk_size] = reflect_pad(images[start:start + chunk_size], padding)
+        padded.flush()
+        del padded
+        os.replace(tmp_path, self._images_path())
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    def __len__(self):
+        return len(self.imgs)
+
+    def __getitem__(self, index):
+        target = int(self.imgs.labels[index])
+        if self.reflect_padding:
+            img = np.array(self.images[index])
+        else:
+            img = Image.fromarray(np.asarray(self.images[index]))
+        if self.transform is not None:
+            img = self.transform(img)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return img, target
+
+
+class IndexedImageFolder(torchvision.datasets.ImageFolder):
+    """ImageFolder that caches the result of scanning its directory tree
+
+    The first time, the file paths, the class indices and the modification
+    times of the directories are stored in an index file next to root (see
+    image_index_path). Later the index is used as long as the modification
+    times of the directories are unchanged, which only takes a stat per
+    directory instead of a listing of every directory and a check of every
+    file. So only added, removed or renamed files are detected, since they
+    change the modification time of their directory; a file modified in
+    place is not.
+
+    The samples are kept in a data.SampleTable instead of a list.
+    """
+
+    def __init__(self, root, transform=None, target_transform=None, loader=default_loader):
+        # Like DatasetFolder.__init__ but without building per-sample lists
+        torchvision.datasets.VisionDataset.__init__(self, root, transform=transform,
+                                                    target_transform=target_transform)
+        self.classes, self.class_to_idx = self.find_classes(self.root)
+        self.imgs = self.samples = self.make_dataset(self.root, self.class_to_idx)
+        self.targets = self.samples.labels
+        self.loader = loader
+        self.extensions = IMG_EXTENSIONS
+
+    def make_dataset(self, directory, class_to_idx, extensions=None, is_valid_file=None,
+                     allow_empty=False):
+        if extensions is None and is_valid_file is None:
+            extensions = IMG_EXTENSIONS
+        index_path = image_index_path(directory)
+
+        index = load_image_index(index_path, directory, class_to_idx)
+        if index is None:
+            LOG.info("=> indexing image folder %s", directory)
+            index = scan_image_folder(directory, class_to_idx, extensions, is_valid_file)
+            save_image_index(index_path, index)
+
+        if not allow_empty and len(index['paths']) == 0:
+            raise FileNotFoundError("Found no valid file in {}".format(directory))
+        return SampleTable.from_paths(index['paths'], index['labels'], root=directory)
+
+
+def image_index_path(directory):
+    """The index of data/train is data/.train.image_index.npz
+
+    It is outside the directory, since writing it inside would change the
+    modification time of the directory.
+    """
+    parent, name = os.path.split(os.path.normpath(directory))
+    return os.path.join(parent, ".{}.image_index.npz".format(name))
+
+
+def scan_image_folder(directory, class_to_idx, extensions=None, is_valid_file=None):
+    """List the samples of an image folder in the same order as ImageFolder
+
+    Returns the index as a dict of arrays.
+    """
+    if is_valid_file is None:
+        def is_valid_file(path):
+            return has_file_allowed_extension(path, extensions)
+
+    paths, labels = [], []
+    dirs, dir_mtimes = ['.'], [os.stat(directory).st_mtime_ns]
+    for target_class in sorted(class_to_idx.keys()):
+        target_dir = os.path.join(directory, target_class)
+        for root, _, fnames in sorted(os.walk(target_dir, followlinks=True)):
+            dirs.append(os.path.relpath(root, directory))
+            dir_mtimes.append(os.stat(root).st_mtime_ns)
+            for fname in sorted(fnames):
+                path = os.path.join(root, fname)
+                if is_valid_file(path):
+                    paths.append(os.path.relpath(path, directory))
+                    labels.append(class_to_idx[target_class])
+
+    return {
+        'classes': np.array(sorted(class_to_idx, key=class_to_idx.get), dtype=np.str_),
+        'paths': np.array(paths, dtype=np.str_),
+        'labels': np.array(labels, dtype=np.int64),
+        'dirs': np.array(dirs, dtype=np.str_),
+        'dir_mtimes': np.array(dir_mtimes, dtype=np.int64),
+    }
+
+
+def load_image_index(index_path, directory, class_to_idx):
+    """Return the index stored in index_path, or None if it is missing or stale"""
+    if not os.path.isfile(index_path):
+        return None
+    try:
+        with np.load(index_path) as stored:
+            index = {key: stored[key] for key in stored.files}
+    except (OSError, ValueError, KeyError) as error:
+        LOG.warning("=> ignoring unreadable image index %s: %s", index_path, error)
+        return None
+
+    if list(index['classes']) != sorted(class_to_idx, key=class_to_idx.get):
+        return None
+    for path, mtime in zip(index['dirs'], index['dir_mtimes']):
+        try:
+            if os.stat(os.path.join(directory, path)).st_mtime_ns != mtime:
+                return None
+        except FileNotFoundError:
+            return None
+    return index
+
+
+def save_image_index(index_path, index):
+    tmp_path = "{}.{}.tmp.npz".format(index_path, os.getpid())
+    try:
+        np.savez(tmp_path, **index)
+        os.replace(tmp_path, index_path)
+    except OSError as error:
+        LOG.warning("=> could not save image index %s: %s", index_path, error)
@@ -1,9 +1,16 @@
-"""Custom loss functions"""
+"""Custom loss functions
+
+The losses are computed in float32, also when the logits come from a
+bfloat16 or float16 forward pass.
+"""
 
 import torch
+from torch import nn
 from torch.nn import functional as F
 from torch.autograd import Variable
 
+from .data import NO_LABEL
+
 
 def softmax_mse_loss(input_logits, target_logits):
     """Takes softmax on both sides and returns MSE loss
@@ -14,8 +21,8 @@ def softmax_mse_loss(input_logits, target_logits):
     - Sends gradients to inputs but not the targets.
     """
     assert input_logits.size() == target_logits.size()
-    input_softmax = F.softmax(input_logits, dim=1)
-    target_softmax = F.softmax(target_logits, dim=1)
+    input_softmax = F.softmax(input_logits.float(), dim=1)
+    target_softmax = F.softmax(target_logits.float(), dim=1)
     num_classes = input_logits.size()[1]
     return F.mse_loss(input_softmax, target_softmax, size_average=False) / num_classes
 
@@ -29,8 +36,8 @@ def softmax_kl_loss(input_logits, target_logits):
     - Sends gradients to inputs but not the targets.
     """
     assert input_logits.size() == target_logits.size()
-    input_log_softmax = F.log_softmax(input_logits, dim=1)
-    target_softmax = F.softmax(target_logits, dim=1)
+    input_log_softmax = F.log_softmax(input_logits.float(), dim=1)
+    target_softmax = F.softmax(target_logits.float(), dim=1)
     return F.kl_div(input_log_softmax, target_softmax, size_average=False)
 
 
@@ -44,4 +51,65 @@ def symmetric_mse_loss(input1, input2):
     """
     assert input1.size() == input2.size()
     num_classes = input1.size()[1]
-    return torch.sum((input1 - input2)**2) / num_classes
+    return torch.sum((input1.float() - input2.float())**2) / num_classes
+
+
+class MeanTeacherLoss(nn.Module):
+    """All the losses of a training step of the mean teacher
+
+    Computes the class loss, the consistency loss, the residual logit loss
+    and the class loss of the EMA model like CrossEntropyLoss and the
+    functions above, with the softmax and log-softmax of each logit tensor
+    computed only once. Each loss is the sum over the examples divided by
+    the minibatch size. Sends gradients to the student logits only.
+    """
+    def __init__(self, consistency_type='mse', logit_distance_cost=-1, ignore_index=NO_LABEL):
+        super().__init__()
+        assert consistency_type in ['mse', 'kl'], consistency_type
+        self.consistency_type = consistency_type
+        self.logit_distance_cost = logit_distance_cost
+        self.ignore_index = ignore_index
+
+    def forward(self, class_logit, cons_logit, ema_logit, target, consistency_weight=None):
+        """Returns class_loss, consistency_loss, res_loss, ema_class_loss
+
+        The consistency loss is 0 without a consistency weight and the
+        residual logit loss without a logit distance cost.
+        """
+        assert class_logit.size() == cons_logit.size() == ema_logit.size()
+        minibatch_size, num_classes = class_logit.size()
+        shared_logit = cons_logit is class_logit
+        class_logit = class_logit.float()
+        cons_logit = class_logit if shared_logit else cons_logit.float()
+        ema_logit = ema_logit.detach().float()
+
+        class_log_softmax = F.log_softmax(class_logit, dim=1)
+        ema_log_softmax = F.log_softmax(ema_logit, dim=1)
+        class_loss = F.nll_loss(class_log_softmax, target, ignore_index=self.ignore_index,
+                                reduction='sum') / minibatch_size
+        ema_class_loss = F.nll_loss(ema_log_softmax, target, ignore_index=self.ignore_index,
+                                    reduction='sum') / minibatch_size
+
+        if self.logit_distance_cost >= 0:
+            res_loss = self.logit_distance_cost * symmetric_mse_loss(class_logit, cons_logit) / minibatch_size
+        else:
+            res_loss = 0
+
+        if consistency_weight is None:
+            consistency_loss = 0
+        elif self.consistency_type == 'mse':
+            if shared_logit:
+                cons_softmax = class_log_softmax.exp()
+            else:
+                cons_softmax = F.softmax(cons_logit, dim=1)
+            consistency_loss = torch.sum((cons_softmax - ema_log_softmax.exp())**2) / num_classes
+            consistency_loss = consistency_weight * consistency_loss / minibatch_size
+        else:
+            if shared_logit:
+                cons_log_softmax = class_log_softmax
+            else:
+                cons_log_softmax = F.log_softmax(cons_logit, dim=1)
+            consistency_loss = torch.sum(ema_log_softmax.exp() * (ema_log_softmax - cons_log_softmax))
+            consistency_loss = consistency_weight * consistency_loss / minibatch_size
+
+        return class_loss, consistency_loss, res_loss, ema_class_loss
@@ -0,0 +1,31 @@
+"""Classification metrics computed on the device"""
+
+import torch
+
+from .data import NO_LABEL
+
+
+def precision_names(topk=(1, 5), prefix=''):
+    """Meter names of the values of topk_precisions"""
+    return ([prefix + 'top{}'.format(k) for k in topk] +
+            [prefix + 'error{}'.format(k) for k in topk])
+
+
+def topk_precisions(logits, target, topk=(1, 5)):
+    """Computes the precision@k and the error@k for the specified values of k
+
+    The logits are [batch, classes], or the logits of several models for the
+    same batch stacked into [models, batch, classes], which share a single
+    topk. Returns the percentages of the labeled examples in a tensor of
+    [..., 2 * len(topk)], the precisions followed by the errors, in the
+    order of precision_names.
+    """
+    maxk = max(topk)
+    labeled_minibatch_size = target.ne(NO_LABEL).sum().float().clamp(min=1e-8)
+
+    _, pred = logits.topk(maxk, dim=-1, largest=True, sorted=True)
+    # Labels are unique in each row, so the cumulative sum says if one of the top k is correct
+    correct = pred.eq(target.unsqueeze(-1)).cumsum(dim=-1)
+    correct_k = correct[..., [k - 1 for k in topk]].sum(dim=-2)
+    precisions = correct_k.float().mul_(100.0 / labeled_minibatch_size)
+    return torch.cat([precisions, 100.0 - precisions], dim=-1)
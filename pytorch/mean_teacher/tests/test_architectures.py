@@ -0,0 +1,118 @@
+import torch
+
+from ..architectures import (shake, traceable_shake, compile_model, set_activation_checkpointing,
+                             cifar_shakeshake26, cifar_shakeshake26_fused, ResNet32x32,
+                             ShakeShakeBlock, FusedShakeShakeBlock)
+
+
+def shake_output_and_grads(shake_function, training):
+    torch.manual_seed(0)
+    inp1 = torch.randn(4, 3, 5, 5, requires_grad=True)
+    inp2 = torch.randn(4, 3, 5, 5, requires_grad=True)
+    grad_output = torch.randn(4, 3, 5, 5)
+    torch.manual_seed(1)
+    output = shake_function(inp1, inp2, training=training)
+    output.backward(grad_output)
+    return output, inp1.grad, inp2.grad
+
+
+def test_traceable_shake_matches_shake():
+    # With a single shake, both draw the forward gate and then the backward gate
+    for training in [True, False]:
+        expected = shake_output_and_grads(shake, training)
+        actual = shake_output_and_grads(traceable_shake, training)
+        for expected_tensor, actual_tensor in zip(expected, actual):
+            assert torch.equal(expected_tensor, actual_tensor)
+
+
+def test_shake_with_generator():
+    inp1 = torch.randn(4, 3, 5, 5, requires_grad=True)
+    inp2 = torch.randn(4, 3, 5, 5, requires_grad=True)
+    grad_output = torch.randn(4, 3, 5, 5)
+    rng_state = torch.get_rng_state()
+
+    output = shake(inp1, inp2, training=True, generator=torch.Generator().manual_seed(0))
+    output.backward(grad_output)
+
+    # Only the given generator is used
+    assert torch.equal(torch.get_rng_state(), rng_state)
+    gates = torch.rand(2, 4, 1, 1, 1, generator=torch.Generator().manual_seed(0))
+    assert torch.allclose(output, inp1 * gates[0] + inp2 * (1 - gates[0]))
+    assert torch.allclose(inp1.grad, grad_output * gates[1])
+    assert torch.allclose(inp2.grad, grad_output * (1 - gates[1]))
+
+
+def test_shake_backward_twice():
+    inp1 = torch.randn(4, 3, 5, 5, requires_grad=True)
+    inp2 = torch.randn(4, 3, 5, 5, requires_grad=True)
+    grad_output = torch.randn(4, 3, 5, 5)
+    output = shake(inp1, inp2, training=True)
+
+    output.backward(grad_output, retain_graph=True)
+    output.backward(grad_output)
+
+    # Each backward pass splits grad_output between the inputs
+    assert torch.allclose(inp1.grad + inp2.grad, 2 * grad_output, atol=1e-6)
+
+
+def test_compile_model_keeps_parameter_names():
+    model = cifar_shakeshake26(num_classes=10)
+    names = list(model.state_dict().keys())
+
+    compile_model(model)
+
+    assert list(model.state_dict().keys()) == names
+    assert all(module.traceable for module in model.modules() if isinstance(module, ShakeShakeBlock))
+
+
+def test_activation_checkpointing_replays_shake_gates():
+    def run(segments):
+        torch.manual_seed(0)
+        model = ResNet32x32(ShakeShakeBlock, layers=[2, 2, 2], channels=8, num_classes=10)
+        set_activation_checkpointing(model, segments)
+        inputs = torch.randn(4, 3, 32, 32)
+        logits1, logits2 = model(inputs)
+        logits = logits1 + logits2
+        logits.sum().backward()
+        return logits, [param.grad for param in model.parameters()], list(model.buffers())
+
+    expected_logits, expected_grads, expected_buffers = run([0, 0, 0])
+    logits, grads, buffers = run([1, 2, 1])
+
+    assert torch.allclose(logits, expected_logits)
+    assert all(torch.allclose(grad, expected_grad, atol=1e-6) for grad, expected_grad in zip(grads, expected_grads))
+    # The running statistics are only updated once
+    assert all(torch.equal(buffer, expected_buffer) for buffer, expected_buffer in zip(buffers, expected_buffers))
+
+
+def test_fused_shake_shake_block_matches_shake_shake_block():
+    torch.manual_seed(0)
+    model = ResNet32x32(ShakeShakeBlock, layers=[2, 2, 2], channels=8, num_classes=10)
+    fused_model = ResNet32x32(FusedShakeShakeBlock, layers=[2, 2, 2], channels=8, num_classes=10)
+    fused_model.load_state_dict(model.state_dict())
+    inputs = torch.randn(4, 3, 32, 32)
+
+    for training in [True, False]:
+        model.train(training)
+        fused_model.train(training)
+        torch.manual_seed(1)
+        expected = model(inputs)
+        torch.manual_seed(1)
+        actual = fused_model(inputs)
+        assert all(torch.equal(logits, expected_logits) for logits, expected_logits in zip(actual, expected))
+
+    # Both ways, including the running statistics
+    unfused_model = ResNet32x32(ShakeShakeBlock, layers=[2, 2, 2], channels=8, num_classes=10)
+    unfused_model.load_state_dict(fused_model.state_dict())
+    state = model.state_dict()
+    assert all(torch.equal(tensor, state[key]) for key, tensor in unfused_model.state_dict().items())
+
+
+def test_compile_model_fused_keeps_parameter_names():
+    model = cifar_shakeshake26_fused(num_classes=10)
+    names = list(model.state_dict().keys())
+
+    compile_model(model)
+
+    assert list(model.state_dict().keys()) == names
+    assert all(module.traceable for module in model.modules() if isinstance(module, FusedShakeShakeBlock))
@@ -0,0 +1,61 @@
+import copy
+import pickle
+
+import numpy as np
+import torch
+import torchvision.transforms.functional as TF
+
+from .. import batch_transforms
+from ..data import reflect_pad, translate_with_reflect
+
+
+def test_color_adjustments_match_torchvision():
+    batch = torch.rand(6, 3, 20, 24)
+    factors = torch.tensor([0.6, 0.8, 1.0, 1.2, 1.4, 0.7])
+    hue_factors = torch.tensor([-0.1, -0.05, 0.0, 0.03, 0.08, 0.1])
+
+    for adjust, reference, factors in [
+            (batch_transforms.adjust_brightness, TF.adjust_brightness, factors),
+            (batch_transforms.adjust_contrast, TF.adjust_contrast, factors),
+            (batch_transforms.adjust_saturation, TF.adjust_saturation, factors),
+            (batch_transforms.adjust_hue, TF.adjust_hue, hue_factors)]:
+        expected = torch.stack([reference(image, factor.item())
+                                for image, factor in zip(batch, factors)])
+        assert torch.allclose(adjust(batch, factors), expected, atol=1e-6)
+
+
+def test_batch_translate_matches_array_translate():
+    images = torch.randint(0, 256, (5, 3, 32, 32), dtype=torch.uint8)
+
+    torch.manual_seed(0)
+    translated = batch_transforms.RandomTranslateWithReflect(4)(images.float())
+
+    torch.manual_seed(0)
+    translations = torch.randint(-4, 5, (5, 2)).numpy()
+    padded = reflect_pad(images.permute(0, 2, 3, 1).numpy(), 4)
+    expected = translate_with_reflect(padded, 4, translations, np.zeros(5, dtype=bool))
+    assert np.array_equal(translated.permute(0, 2, 3, 1).numpy(), expected)
+
+
+def test_transforming_loader_makes_two_views():
+    loader = [(torch.randint(0, 256, (4, 3, 8, 8), dtype=torch.uint8), torch.arange(4))]
+    transform = batch_transforms.TransformTwice(batch_transforms.Compose([
+        batch_transforms.ToFloat(),
+        batch_transforms.RandomHorizontalFlip(),
+        batch_transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.25, 0.25, 0.25])
+    ]))
+
+    (view1, view2), target = next(iter(batch_transforms.TransformingLoader(loader, transform, 'cpu')))
+
+    assert view1.dtype == view2.dtype == torch.float32
+    assert view1.size() == view2.size() == (4, 3, 8, 8)
+    assert target.tolist() == [0, 1, 2, 3]
+
+
+def test_transforming_loader_can_be_copied():
+    loader = batch_transforms.TransformingLoader([], batch_transforms.ToFloat(), 'cpu')
+
+    copied = copy.copy(loader)
+
+    assert copied.loader is loader.loader
+    assert pickle.loads(pickle.dumps(loader)).device == 'cpu'
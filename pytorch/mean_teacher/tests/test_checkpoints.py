@@ -0,0 +1,146 @@
+import os
+
+import pytest
+import torch
+from torch import nn
+
+from ..checkpoints import (CheckpointWriter, RetentionPolicy, TensorStore, atomic_save, load_checkpoint,
+                           save_mapped_checkpoint)
+
+
+def test_checkpoint_writer(tmpdir):
+    model = nn.BatchNorm2d(3)
+    checkpoint_path, best_path = str(tmpdir.join('checkpoint.1.ckpt')), str(tmpdir.join('best.ckpt'))
+
+    with CheckpointWriter() as writer:
+        writer.save({'epoch': 1, 'state_dict': model.state_dict()}, checkpoint_path, link_paths=[best_path])
+        # The checkpoint has the state at the time of save
+        with torch.no_grad():
+            model.weight.add_(1)
+    checkpoint = torch.load(checkpoint_path)
+
+    assert checkpoint['epoch'] == 1
+    assert torch.equal(checkpoint['state_dict']['weight'], torch.ones(3))
+    assert checkpoint['state_dict']._metadata == model.state_dict()._metadata
+    assert os.path.samefile(checkpoint_path, best_path)
+    assert sorted(os.listdir(str(tmpdir))) == ['best.ckpt', 'checkpoint.1.ckpt']
+
+
+def test_checkpoint_writer_reports_errors(tmpdir):
+    writer = CheckpointWriter()
+    writer.save({'epoch': 1}, str(tmpdir.join('missing', 'checkpoint.1.ckpt')))
+
+    with pytest.raises(RuntimeError):
+        writer.wait()
+    writer.close()
+
+
+def test_checkpoint_writer_keeps_the_exception_of_the_block(tmpdir):
+    with pytest.raises(KeyError):
+        with CheckpointWriter() as writer:
+            writer.save({'epoch': 1}, str(tmpdir.join('missing', 'checkpoint.1.ckpt')))
+            raise KeyError('training failed')
+
+    assert not writer._thread.is_alive()
+
+
+def test_checkpoint_writer_close_stops_the_thread_after_errors(tmpdir):
+    writer = CheckpointWriter()
+    writer.save({'epoch': 1}, str(tmpdir.join('missing', 'checkpoint.1.ckpt')))
+
+    with pytest.raises(RuntimeError):
+        writer.close()
+    assert not writer._thread.is_alive()
+
+
+@pytest.mark.parametrize('save', [atomic_save, save_mapped_checkpoint])
+def test_atomic_saves_keep_the_error_of_open(tmpdir, save):
+    with pytest.raises(FileNotFoundError) as error:
+        save({'epoch': 1, 'state_dict': {}, 'ema_state_dict': {}}, str(tmpdir.join('missing', 'checkpoint.1.ckpt')))
+    # Not the one of removing the temporary file
+    assert error.value.__context__ is None
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_tensor_store(tmpdir, compression):
+    model = nn.BatchNorm2d(3)
+    state = {'epoch': 1, 'state_dict': model.state_dict(), 'steps': [torch.tensor(1.5, dtype=torch.bfloat16)]}
+
+    with CheckpointWriter(tensor_store=TensorStore(compression=compression)) as writer:
+        writer.save(state, str(tmpdir.join('checkpoint.1.ckpt')))
+        writer.save({**state, 'epoch': 2}, str(tmpdir.join('checkpoint.2.ckpt')))
+    loaded = load_checkpoint(str(tmpdir.join('checkpoint.1.ckpt')))
+
+    # Stored once for both checkpoints: the ones of weight and running_var, the
+    # zeros of bias and running_mean, num_batches_tracked and the bfloat16 tensor
+    assert len(tmpdir.join('tensors').listdir()) == 4
+    assert loaded['epoch'] == 1
+    assert loaded['steps'][0].dtype == torch.bfloat16 and loaded['steps'][0].item() == 1.5
+    assert loaded['state_dict'].keys() == state['state_dict'].keys()
+    assert all(torch.equal(loaded['state_dict'][key], tensor) for key, tensor in state['state_dict'].items())
+    nn.BatchNorm2d(3).load_state_dict(loaded['state_dict'])
+
+
+def test_tensor_store_garbage_collection(tmpdir, monkeypatch):
+    store = TensorStore()
+    torch.save({'epoch': 1, 'weight': torch.zeros(3)}, str(tmpdir.join('plain.ckpt')))
+    with CheckpointWriter(tensor_store=store) as writer:
+        writer.save({'weight': torch.ones(3)}, str(tmpdir.join('checkpoint.latest.ckpt')))
+        writer.save({'weight': torch.full((3,), 2.0)}, str(tmpdir.join('checkpoint.latest.ckpt')))
+    # Only the tensor of the last checkpoint is left
+    assert len(tmpdir.join('tensors').listdir()) == 1
+
+    loads = []
+    monkeypatch.setattr(torch, 'load', lambda *args, **kwargs: loads.append(args))
+    store.collect_garbage(str(tmpdir))
+    # The unchanged checkpoints are not read again
+    assert loads == []
+    assert len(tmpdir.join('tensors').listdir()) == 1
+
+
+def test_retention_policy(tmpdir):
+    model = nn.Linear(2, 2)
+    retention = RetentionPolicy(keep_last=2, keep_every=3)
+
+    with CheckpointWriter(tensor_store=TensorStore(), retention=retention) as writer:
+        for epoch in range(1, 9):
+            with torch.no_grad():
+                model.weight.add_(1)
+            writer.save({'state_dict': model.state_dict()}, str(tmpdir.join('checkpoint.{}.ckpt'.format(epoch))),
+                        link_paths=[str(tmpdir.join('best.ckpt'))] if epoch == 2 else [])
+
+    assert sorted(path.basename for path in tmpdir.listdir('*.ckpt')) == [
+        'best.ckpt', 'checkpoint.2.ckpt', 'checkpoint.3.ckpt', 'checkpoint.6.ckpt',
+        'checkpoint.7.ckpt', 'checkpoint.8.ckpt']
+    # The tensors of the deleted checkpoints are deleted too (the bias is shared)
+    assert len(tmpdir.join('tensors').listdir()) == 5 + 1
+
+
+def test_mapped_checkpoint(tmpdir):
+    model = nn.Sequential(nn.Linear(3, 2), nn.BatchNorm1d(2))
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9)
+    model(torch.randn(4, 3)).sum().backward()
+    optimizer.step()
+    state = {'epoch': 1, 'state_dict': model.state_dict(),
+             'ema_state_dict': {'weight': torch.arange(3, dtype=torch.bfloat16), 'empty': torch.zeros(0, 2)},
+             'optimizer': optimizer.state_dict()}
+    path = str(tmpdir.join('checkpoint.1.ckpt'))
+    save_mapped_checkpoint(state, path)
+
+    loaded = load_checkpoint(path)
+    assert list(loaded.keys()) == list(state.keys())
+    assert loaded['epoch'] == 1
+    assert loaded['state_dict']._metadata == model.state_dict()._metadata
+    for key in ['state_dict', 'ema_state_dict']:
+        assert list(loaded[key].keys()) == list(state[key].keys())
+        assert all(torch.equal(tensor, state[key][name]) for name, tensor in loaded[key].items())
+    assert torch.equal(loaded['optimizer']['state'][0]['momentum_buffer'],
+                       optimizer.state_dict()['state'][0]['momentum_buffer'])
+    model.load_state_dict(loaded['state_dict'])
+    optimizer.load_state_dict(loaded['optimizer'])
+
+    # The tensors can be modified without changing the file
+    loaded['ema_state_dict']['weight'].add_(1)
+    ema_only = load_checkpoint(path, keys=['ema_state_dict', 'missing'])
+    assert list(ema_only.keys()) == ['ema_state_dict']
+    assert torch.equal(ema_only['ema_state_dict']['weight'], torch.arange(3, dtype=torch.bfloat16))
@@ -1,8 +1,14 @@
 from itertools import islice, chain
 
+from PIL import Image
 import numpy as np
+import pytest
+import torch
+import torchvision.transforms as transforms
 
-from ..data import TwoStreamBatchSampler
+from ..data import (TwoStreamBatchSampler, RandomTranslateWithReflect, TransformTwice,
+                    PaddedRandomTranslateWithReflect, ReflectPad, reflect_pad,
+                    SampleTable, relabel_dataset, BatchSeededDataset, NO_LABEL)
 
 def test_two_stream_batch_sampler():
     import sys
@@ -55,3 +61,191 @@ def test_two_stream_batch_sampler_uneven():
 
     # Secondary items are iterated through before beginning again
     assert sorted(i for i in chain(*batches[:3]) if i < 0) == sorted(list(range(-3, 0)) * 2)
+
+
+def test_padded_translate_matches_pil_translate():
+    image = np.random.RandomState(0).randint(0, 256, size=(32, 32, 3)).astype(np.uint8)
+    pil_transform = transforms.Compose([
+        RandomTranslateWithReflect(4),
+        transforms.RandomHorizontalFlip()
+    ])
+    padded_transform = PaddedRandomTranslateWithReflect(4)
+    padded_image = reflect_pad(image, 4)
+
+    for seed in range(50):
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        expected = np.asarray(pil_transform(Image.fromarray(image)))
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        assert np.array_equal(padded_transform(padded_image), expected)
+
+
+def test_padded_translate_batch_matches_single_images():
+    images = np.random.RandomState(0).randint(0, 256, size=(8, 32, 32, 3)).astype(np.uint8)
+    transform = PaddedRandomTranslateWithReflect(4)
+    padded_images = reflect_pad(images, 4)
+
+    np.random.seed(0)
+    torch.manual_seed(0)
+    batch = transform.batch(padded_images)
+
+    np.random.seed(0)
+    torch.manual_seed(0)
+    translations = np.random.randint(-4, 5, size=(8, 2))
+    flips = (torch.rand(8) < 0.5).numpy()
+    for padded_image, translation, flip, view in zip(padded_images, translations, flips, batch):
+        left, top = 4 - translation
+        expected = padded_image[top:top + 32, left:left + 32]
+        assert np.array_equal(view, expected[:, ::-1] if flip else expected)
+
+
+def test_transform_twice_shares_deterministic_prefix():
+    image = Image.fromarray(np.random.RandomState(0).randint(0, 256, size=(32, 32, 3)).astype(np.uint8))
+    normalize = transforms.Normalize(mean=[0.4, 0.5, 0.6], std=[0.2, 0.3, 0.2])
+    unshared = transforms.Compose([
+        RandomTranslateWithReflect(4),
+        transforms.RandomHorizontalFlip(),
+        transforms.ToTensor(),
+        normalize
+    ])
+    shared = TransformTwice(transforms.Compose([
+        transforms.ToTensor(),
+        normalize,
+        ReflectPad(4),
+        PaddedRandomTranslateWithReflect(4)
+    ]))
+
+    assert [type(step) for step in shared.shared.transforms] == [
+        transforms.ToTensor, transforms.Normalize, ReflectPad]
+    assert [type(step) for step in shared.transform.transforms] == [
+        PaddedRandomTranslateWithReflect]
+
+    for seed in range(20):
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        expected = unshared(image), unshared(image)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        views = shared(image)
+        assert all(torch.equal(view, expected_view) for view, expected_view in zip(views, expected))
+
+
+class ListDataset:
+    def __init__(self, imgs, classes):
+        self.imgs = imgs
+        self.class_to_idx = {name: idx for idx, name in enumerate(classes)}
+
+
+def test_sample_table():
+    table = SampleTable.from_paths(['cat/0_cat.png', 'dog/1_dög.png', '2.png'], [0, 1, 0], root='/data')
+
+    assert len(table) == 3
+    assert table[1] == ('/data/dog/1_dög.png', 1)
+    assert list(table)[2] == ('/data/2.png', 0)
+    assert list(table.basenames()) == [b'0_cat.png', '1_dög.png'.encode('utf-8'), b'2.png']
+
+
+def test_sample_table_basenames_without_slashes():
+    table = SampleTable.from_paths(['2.png', 'a/b.png', 'c.png', 'd/e/f.png'], [0, 0, 0, 0])
+
+    assert list(table.basenames()) == [b'2.png', b'b.png', b'c.png', b'f.png']
+
+
+def test_relabel_dataset():
+    dataset = ListDataset([('a/0_cat.png', 0), ('b/1_dog.png', 1), ('b/2_dog.png', 1)], ['cat', 'dog'])
+
+    labeled_idxs, unlabeled_idxs = relabel_dataset(dataset, {'2_dog.png': 'dog', '0_cat.png': 'cat'})
+
+    assert isinstance(dataset.imgs, SampleTable)
+    assert list(labeled_idxs) == [0, 2]
+    assert list(unlabeled_idxs) == [1]
+    assert list(dataset.imgs) == [('a/0_cat.png', 0), ('b/1_dog.png', NO_LABEL), ('b/2_dog.png', 1)]
+
+
+def test_relabel_dataset_flat_paths_and_duplicate_names():
+    dataset = ListDataset([('0_cat.png', 0), ('a/1_dog.png', 1), ('b/0_cat.png', 0), ('2_dog.png', 1)],
+                          ['cat', 'dog'])
+
+    labeled_idxs, unlabeled_idxs = relabel_dataset(dataset, {'0_cat.png': 'cat', '2_dog.png': 'dog'})
+
+    # Only the first sample with a file name is labeled
+    assert list(labeled_idxs) == [0, 3]
+    assert list(unlabeled_idxs) == [1, 2]
+
+
+def test_relabel_dataset_unknown_files():
+    dataset = ListDataset([('a/0_cat.png', 0)], ['cat'])
+
+    with pytest.raises(LookupError):
+        relabel_dataset(dataset, {'0_cat.png': 'cat', '5_cat.png': 'cat'})
+
+
+def test_load_label_split(tmpdir, monkeypatch):
+    from .. import data
+    labels_path = tmpdir.join('00.txt')
+    labels_path.write('2_dog.png dog\n0_cat.png cat\n')
+    samples = [('a/0_cat.png', 0), ('b/1_dog.png', 1), ('b/2_dog.png', 1)]
+
+    compiled = data.load_label_split(ListDataset(list(samples), ['cat', 'dog']), str(labels_path))
+    assert len(tmpdir.listdir(lambda path: path.basename.endswith('.split.npz'))) == 1
+
+    def fail_relabel(*args, **kwargs):
+        assert False, "the compiled split should be used"
+    with monkeypatch.context() as patch:
+        patch.setattr(data, 'relabel_dataset', fail_relabel)
+        dataset = ListDataset(list(samples), ['cat', 'dog'])
+        loaded = data.load_label_split(dataset, str(labels_path))
+    assert [list(idxs) for idxs in loaded] == [list(idxs) for idxs in compiled] == [[0, 2], [1]]
+    assert list(dataset.imgs) == [('a/0_cat.png', 0), ('b/1_dog.png', NO_LABEL), ('b/2_dog.png', 1)]
+
+    labels_path.write('1_dog.png dog\n')
+    labeled_idxs, _ = data.load_label_split(ListDataset(list(samples), ['cat', 'dog']), str(labels_path))
+    assert list(labeled_idxs) == [1]
+
+
+def test_two_stream_batch_sampler_resume():
+    sampler = TwoStreamBatchSampler(primary_indices=range(20),
+                                    secondary_indices=range(-3, 0),
+                                    batch_size=5,
+                                    secondary_batch_size=2)
+    iterator = iter(sampler)
+    first = list(islice(iterator, 2))
+    state = sampler.state_dict()
+    rest = list(iterator)
+    assert all(batch.dtype == np.int64 for batch in first + rest)
+    assert len(first + rest) == len(sampler)
+
+    resumed = TwoStreamBatchSampler(primary_indices=range(20),
+                                    secondary_indices=range(-3, 0),
+                                    batch_size=5,
+                                    secondary_batch_size=2)
+    resumed.load_state_dict(state)
+    assert [list(batch) for batch in resumed] == [list(batch) for batch in rest]
+
+    # The next epoch is a new one
+    assert resumed.state_dict() == {'epoch_seed': state['epoch_seed'], 'cursor': len(sampler)}
+    assert len(list(resumed)) == len(sampler)
+    assert resumed.state_dict()['epoch_seed'] != state['epoch_seed']
+
+
+class RandomDataset(torch.utils.data.Dataset):
+    def __getitem__(self, index):
+        return index, np.random.randint(1000), torch.randint(1000, ())
+
+    def __len__(self):
+        return 12
+
+
+def test_batch_seeded_dataset_in_any_worker():
+    batches = [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9, 10, 11]]
+
+    def load(batches, num_workers):
+        loader = torch.utils.data.DataLoader(BatchSeededDataset(RandomDataset()), batch_sampler=batches,
+                                             num_workers=num_workers)
+        return {tuple(indices.tolist()): (numbers.tolist(), tensors.tolist()) for indices, numbers, tensors in loader}
+
+    loaded = load(batches, 2)
+    # Skipping a batch changes the worker and the position in the worker of the others
+    assert load(batches[1:], 2) == {batch: loaded[batch] for batch in map(tuple, batches[1:])}
+    assert load(batches[::-1], 1) == loaded
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+import torch.multiprocessing
+
+from ..data import TwoStreamBatchSampler
+from ..distributed import DistributedTwoStreamBatchSampler, average_buffers, free_local_url, init_process_group
+
+
+def test_distributed_two_stream_batch_sampler_shards_both_streams():
+    samplers = [DistributedTwoStreamBatchSampler(primary_indices=range(24),
+                                                 secondary_indices=range(-6, 0),
+                                                 batch_size=5,
+                                                 secondary_batch_size=2,
+                                                 num_replicas=2,
+                                                 rank=rank)
+                for rank in range(2)]
+    single = TwoStreamBatchSampler(primary_indices=range(24),
+                                   secondary_indices=range(-6, 0),
+                                   batch_size=10,
+                                   secondary_batch_size=4)
+    assert len(samplers[0]) == len(samplers[1]) == len(single) == 4
+
+    shards = [sampler.epoch_batches(seed=3) for sampler in samplers]
+    assert all(shard.shape == (4, 5) for shard in shards)
+    assert all((shard[:, :3] >= 0).all() and (shard[:, 3:] < 0).all() for shard in shards)
+
+    # Together the processes draw the batches of a single process
+    expected = single.epoch_batches(seed=3)
+    for batch, expected_batch in zip(np.concatenate(shards, axis=1), expected):
+        assert sorted(batch) == sorted(expected_batch)
+
+    # The processes never share a primary index within an epoch
+    primary = np.concatenate([shard[:, :3].reshape(-1) for shard in shards])
+    assert len(set(primary)) == len(primary)
+
+
+def draw_epoch(rank, url, results):
+    init_process_group(rank, 2, torch.device('cpu'), backend='gloo', url=url)
+    np.random.seed(rank)
+    sampler = DistributedTwoStreamBatchSampler(range(12), range(-4, 0), 3, 1)
+    results[rank] = np.concatenate(list(sampler))
+    torch.distributed.destroy_process_group()
+
+
+def test_distributed_two_stream_batch_sampler_agrees_on_epochs():
+    results = torch.multiprocessing.Manager().dict()
+    torch.multiprocessing.spawn(draw_epoch, args=(free_local_url(), results), nprocs=2)
+
+    # Despite different random states, the processes use the seed of rank 0
+    primary = [results[rank][np.asarray(results[rank]) >= 0] for rank in range(2)]
+    assert sorted(np.concatenate(primary)) == list(range(12))
+
+
+def average_batch_norm(rank, url, results):
+    init_process_group(rank, 2, torch.device('cpu'), backend='gloo', url=url)
+    batch_norm = torch.nn.BatchNorm1d(2)
+    batch_norm(torch.full((4, 2), float(rank)))
+    average_buffers(batch_norm)
+    results[rank] = (batch_norm.running_mean.tolist(), int(batch_norm.num_batches_tracked))
+    torch.distributed.destroy_process_group()
+
+
+def test_average_buffers():
+    results = torch.multiprocessing.Manager().dict()
+    torch.multiprocessing.spawn(average_batch_norm, args=(free_local_url(), results), nprocs=2)
+
+    # The running means of the shards, 0 and 0.1, are averaged
+    assert results[0] == results[1]
+    assert results[0][0] == pytest.approx([0.05, 0.05])
+    assert results[0][1] == 1
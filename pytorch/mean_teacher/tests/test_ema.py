@@ -0,0 +1,78 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+from ..ema import ExponentialMovingAverage
+
+
+def create_models():
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(4, 8), nn.BatchNorm1d(8), nn.Linear(8, 2))
+    ema_model = copy.deepcopy(model)
+    for param in ema_model.parameters():
+        param.detach_()
+    model(torch.randn(16, 4))
+    with torch.no_grad():
+        for param in model.parameters():
+            param.add_(torch.randn_like(param))
+    return model, ema_model
+
+
+def update_ema_variables(model, ema_model, alpha, global_step):
+    alpha = min(1 - 1 / (global_step + 1), alpha)
+    for ema_param, param in zip(ema_model.parameters(), model.parameters()):
+        ema_param.data.mul_(alpha).add_(param.data, alpha=1 - alpha)
+
+
+def test_matches_per_tensor_update():
+    model, ema_model = create_models()
+    expected = copy.deepcopy(ema_model)
+    updater = ExponentialMovingAverage(model, ema_model, 0.9)
+
+    for global_step in range(1, 20):
+        updater.update(global_step)
+        update_ema_variables(model, expected, 0.9, global_step)
+
+    for param, expected_param in zip(ema_model.parameters(), expected.parameters()):
+        assert torch.allclose(param, expected_param)
+    # The buffers are left alone by default
+    assert torch.equal(ema_model[1].running_mean, torch.zeros(8))
+
+
+def test_matches_per_tensor_update_without_foreach_lerp(monkeypatch):
+    model, ema_model = create_models()
+    expected = copy.deepcopy(ema_model)
+    ExponentialMovingAverage(model, expected, 0.9).update(5)
+
+    monkeypatch.delattr(torch, '_foreach_lerp_')
+    ExponentialMovingAverage(model, ema_model, 0.9).update(5)
+
+    for param, expected_param in zip(ema_model.parameters(), expected.parameters()):
+        assert torch.allclose(param, expected_param)
+
+
+def test_update_interval_adjusts_decay():
+    # With a fixed student, updating every k steps gives the same teacher
+    model, ema_model = create_models()
+    expected = copy.deepcopy(ema_model)
+    updater = ExponentialMovingAverage(model, ema_model, 0.9, interval=4)
+
+    for global_step in range(1, 21):
+        updater.update(global_step)
+        update_ema_variables(model, expected, 0.9, global_step)
+        if global_step % 4 != 0:
+            assert not torch.allclose(ema_model[0].weight, expected[0].weight)
+
+    for param, expected_param in zip(ema_model.parameters(), expected.parameters()):
+        assert torch.allclose(param, expected_param)
+
+
+def test_buffers():
+    model, ema_model = create_models()
+    updater = ExponentialMovingAverage(model, ema_model, 0.9, buffers=True)
+
+    updater.update(global_step=10)
+
+    assert torch.allclose(ema_model[1].running_mean, 0.1 * model[1].running_mean)
+    assert ema_model[1].num_batches_tracked == model[1].num_batches_tracked == 1
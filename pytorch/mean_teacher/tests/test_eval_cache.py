@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+
+from ..eval_cache import CachingEvalLoader
+from ..folders import image_folder
+from .test_folders import write_tiny_packed
+
+
+def eval_transformation(size=32):
+    return transforms.Compose([
+        transforms.CenterCrop(size),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.4914, 0.4822, 0.4465], std=[0.2470, 0.2435, 0.2616])
+    ])
+
+
+def cache_files(directory):
+    return sorted(os.listdir(str(directory)))
+
+
+def test_caching_eval_loader(tmpdir):
+    data_dir, cache_dir = tmpdir.join('data'), tmpdir.join('cache')
+    write_tiny_packed(data_dir)
+    expected = list(torch.utils.data.DataLoader(image_folder(str(data_dir), eval_transformation()), batch_size=3))
+    loader = CachingEvalLoader(image_folder(str(data_dir)), eval_transformation(), str(cache_dir),
+                               batch_size=3, device=torch.device('cpu'))
+
+    # Writing the cache, and then reading it
+    for _ in range(2):
+        batches = list(loader)
+        assert len(batches) == len(loader) == 2
+        for (input, target), (expected_input, expected_target) in zip(batches, expected):
+            assert torch.equal(input, expected_input)
+            assert torch.equal(target, expected_target)
+        assert len(cache_files(cache_dir)) == 1
+
+    # Another transformation has another cache, which keeps the recently used ones
+    cropping_loader = CachingEvalLoader(image_folder(str(data_dir)), eval_transformation(size=16),
+                                        str(cache_dir), batch_size=3, device=torch.device('cpu'))
+    assert list(cropping_loader)[0][0].shape == (3, 3, 16, 16)
+    assert len(cache_files(cache_dir)) == 2
+
+    # But removes the stale ones
+    os.utime(cropping_loader.path, (0, 0))
+    os.unlink(loader.path)
+    list(loader)
+    assert cache_files(cache_dir) == [os.path.basename(loader.path)]
+
+
+def test_caching_eval_loader_notices_changed_data(tmpdir):
+    data_dir, cache_dir = tmpdir.join('data'), tmpdir.join('cache')
+    write_tiny_packed(data_dir)
+    list(CachingEvalLoader(image_folder(str(data_dir)), eval_transformation(), str(cache_dir),
+                           batch_size=3, device=torch.device('cpu')))
+
+    images_path = str(data_dir.join('images.npy'))
+    images = np.load(images_path)
+    np.save(images_path, 255 - images)
+    stat = os.stat(images_path)
+    os.utime(images_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    input, _ = next(iter(CachingEvalLoader(image_folder(str(data_dir)), eval_transformation(), str(cache_dir),
+                                           batch_size=3, device=torch.device('cpu'))))
+
+    expected_input, _ = next(iter(torch.utils.data.DataLoader(
+        image_folder(str(data_dir), eval_transformation()), batch_size=3)))
+    assert torch.equal(input, expected_input)
+
+
+def test_caching_eval_loader_reads_read_only_caches(tmpdir, monkeypatch):
+    data_dir, cache_dir = tmpdir.join('data'), tmpdir.join('cache')
+    write_tiny_packed(data_dir)
+    loader = CachingEvalLoader(image_folder(str(data_dir)), eval_transformation(), str(cache_dir),
+                               batch_size=3, device=torch.device('cpu'))
+    expected = list(loader)
+
+    def utime(path, *args, **kwargs):
+        raise PermissionError(path)
+    # As in a shared cache directory, also for root
+    monkeypatch.setattr(os, 'utime', utime)
+    assert all(torch.equal(input, expected_input) for (input, _), (expected_input, _) in zip(loader, expected))
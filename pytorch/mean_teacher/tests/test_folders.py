@@ -0,0 +1,89 @@
+import os
+
+from PIL import Image
+import numpy as np
+import torchvision.datasets
+
+from .. import folders
+from ..data import relabel_dataset, reflect_pad, NO_LABEL
+from ..folders import image_folder, write_packed, IndexedImageFolder, PackedImageFolder
+
+
+def write_tiny_packed(root):
+    images = np.arange(4 * 32 * 32 * 3, dtype=np.int64).reshape(4, 32, 32, 3) % 256
+    write_packed(str(root), images,
+                 labels=[0, 1, 1, 0],
+                 filenames=['0_cat.png', '1_dog.png', '2_dog.png', '3_cat.png'],
+                 classes=['cat', 'dog'])
+    return images.astype(np.uint8)
+
+
+def test_packed_image_folder(tmpdir):
+    images = write_tiny_packed(tmpdir)
+    dataset = image_folder(str(tmpdir))
+
+    assert isinstance(dataset, PackedImageFolder)
+    assert len(dataset) == 4
+    assert dataset.class_to_idx == {'cat': 0, 'dog': 1}
+
+    img, target = dataset[2]
+    assert target == 1
+    assert np.array_equal(np.asarray(img), images[2])
+
+
+def test_relabel_packed_image_folder(tmpdir):
+    write_tiny_packed(tmpdir)
+    dataset = image_folder(str(tmpdir))
+
+    labeled_idxs, unlabeled_idxs = relabel_dataset(dataset, {'1_dog.png': 'dog', '3_cat.png': 'cat'})
+
+    assert list(labeled_idxs) == [1, 3]
+    assert list(unlabeled_idxs) == [0, 2]
+    assert [dataset[idx][1] for idx in range(4)] == [NO_LABEL, 1, NO_LABEL, 0]
+
+
+def test_reflect_padded_packed_image_folder(tmpdir):
+    images = write_tiny_packed(tmpdir)
+    dataset = image_folder(str(tmpdir), reflect_padding=4)
+
+    img, target = dataset[3]
+    assert img.shape == (40, 40, 3)
+    assert np.array_equal(img, reflect_pad(images[3], 4))
+    assert tmpdir.join('images.reflect4.npy').check()
+
+
+def write_tiny_image_folder(root):
+    for idx, class_name in enumerate(['cat', 'dog', 'dog']):
+        root.ensure_dir(class_name)
+        Image.new('RGB', (4, 4)).save(str(root.join(class_name, '{}_{}.png'.format(idx, class_name))))
+
+
+def test_indexed_image_folder_matches_image_folder(tmpdir):
+    root = tmpdir.mkdir('train')
+    write_tiny_image_folder(root)
+
+    indexed = image_folder(str(root))
+    assert isinstance(indexed, IndexedImageFolder)
+    assert list(indexed.imgs) == torchvision.datasets.ImageFolder(str(root)).imgs
+    assert tmpdir.join('.train.image_index.npz').check()
+
+
+def test_indexed_image_folder_uses_fresh_index(tmpdir, monkeypatch):
+    root = tmpdir.mkdir('train')
+    write_tiny_image_folder(root)
+    expected = list(image_folder(str(root)).imgs)
+
+    def fail_scan(*args, **kwargs):
+        assert False, "the image folder should not be rescanned"
+    monkeypatch.setattr(folders, 'scan_image_folder', fail_scan)
+    assert list(image_folder(str(root)).imgs) == expected
+
+
+def test_indexed_image_folder_notices_new_files(tmpdir):
+    root = tmpdir.mkdir('train')
+    write_tiny_image_folder(root)
+    assert len(image_folder(str(root))) == 3
+
+    Image.new('RGB', (4, 4)).save(str(root.join('cat', '3_cat.png')))
+    os.utime(str(root.join('cat')), ns=(0, 0))  # Make sure the mtime changes even on coarse filesystems
+    assert len(image_folder(str(root))) == 4
@@ -0,0 +1,58 @@
+import pytest
+import torch
+from torch import nn
+
+from ..losses import MeanTeacherLoss, softmax_mse_loss, softmax_kl_loss, symmetric_mse_loss
+from ..data import NO_LABEL
+
+
+def separate_losses(class_logit, cons_logit, ema_logit, target, consistency_type, logit_distance_cost,
+                    consistency_weight):
+    minibatch_size = len(target)
+    class_criterion = nn.CrossEntropyLoss(reduction='sum', ignore_index=NO_LABEL)
+    consistency_criterion = {'mse': softmax_mse_loss, 'kl': softmax_kl_loss}[consistency_type]
+    class_loss = class_criterion(class_logit, target) / minibatch_size
+    consistency_loss = consistency_weight * consistency_criterion(cons_logit, ema_logit) / minibatch_size
+    res_loss = logit_distance_cost * symmetric_mse_loss(class_logit, cons_logit) / minibatch_size
+    ema_class_loss = class_criterion(ema_logit, target) / minibatch_size
+    return class_loss, consistency_loss, res_loss, ema_class_loss
+
+
+@pytest.mark.parametrize('consistency_type', ['mse', 'kl'])
+@pytest.mark.parametrize('logit_distance_cost', [-1, 0.01])
+def test_mean_teacher_loss_matches_separate_losses(consistency_type, logit_distance_cost):
+    torch.manual_seed(0)
+    target = torch.tensor([0, NO_LABEL, 3, NO_LABEL, 9, 1])
+    ema_logit = torch.randn(6, 10)
+
+    def losses_and_grads(compute_losses):
+        class_logit = torch.randn(6, 10, generator=torch.Generator().manual_seed(1), requires_grad=True)
+        cons_logit = (torch.randn(6, 10, generator=torch.Generator().manual_seed(2), requires_grad=True)
+                      if logit_distance_cost >= 0 else class_logit)
+        losses = compute_losses(class_logit, cons_logit, ema_logit, target)
+        sum(loss for loss in losses[:3] if torch.is_tensor(loss)).backward()
+        return losses, class_logit.grad, cons_logit.grad
+
+    criterion = MeanTeacherLoss(consistency_type, logit_distance_cost)
+    actual = losses_and_grads(
+        lambda *logits_and_target: criterion(*logits_and_target, consistency_weight=3.))
+    expected = losses_and_grads(
+        lambda *logits_and_target: separate_losses(*logits_and_target, consistency_type,
+                                                   max(logit_distance_cost, 0), 3.))
+
+    (losses, class_grad, cons_grad), (expected_losses, expected_class_grad, expected_cons_grad) = actual, expected
+    if logit_distance_cost < 0:
+        assert losses[2] == 0
+        losses, expected_losses = losses[:2] + losses[3:], expected_losses[:2] + expected_losses[3:]
+    assert all(torch.allclose(loss, expected_loss) for loss, expected_loss in zip(losses, expected_losses))
+    assert torch.allclose(class_grad, expected_class_grad, atol=1e-7)
+    assert torch.allclose(cons_grad, expected_cons_grad, atol=1e-7)
+
+
+def test_mean_teacher_loss_without_consistency():
+    logits = torch.randn(4, 10)
+    class_loss, consistency_loss, res_loss, ema_class_loss = MeanTeacherLoss()(
+        logits, logits, logits, torch.tensor([1, 2, NO_LABEL, 4]))
+
+    assert consistency_loss == 0 and res_loss == 0
+    assert torch.equal(class_loss, ema_class_loss)
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+import torch
+
+# main.py logs through run_context, which needs pandas
+pytest.importorskip('pandas')
+import main
+# The modules main uses, which are not those of the relative imports
+from main import architectures, cli
+from mean_teacher.folders import write_packed
+
+
+class Context:
+    def __init__(self, transient_dir):
+        self.transient_dir = str(transient_dir)
+
+    def create_train_log(self, name):
+        return Log()
+
+
+class Log:
+    def record(self, step, values):
+        pass
+
+
+def tiny_shakeshake(pretrained=False, num_classes=10):
+    return architectures.ResNet32x32(architectures.ShakeShakeBlock, layers=[1, 1, 1], channels=4,
+                                     num_classes=num_classes)
+
+
+@pytest.fixture
+def run_main(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setitem(architectures.__dict__, 'tiny_shakeshake', tiny_shakeshake)
+    rng = np.random.RandomState(0)
+    for subdir, count in [('train', 64), ('test', 16)]:
+        labels = np.arange(count) % 10
+        write_packed('data-local/images/cifar/cifar10/packed/' + subdir,
+                     rng.randint(0, 256, (count, 32, 32, 3)), labels,
+                     ['{}_{}.png'.format(idx, label) for idx, label in enumerate(labels)],
+                     [str(label) for label in range(10)])
+    tmpdir.join('labels.txt').write(''.join('{}_{}.png {}\n'.format(idx, idx % 10, idx % 10)
+                                            for idx in range(0, 64, 3)))
+
+    def run(name, **kwargs):
+        main.args = cli.parse_dict_args(**{
+            'dataset': 'cifar10_packed', 'train_subdir': 'train', 'eval_subdir': 'test',
+            'labels': 'labels.txt', 'batch_size': 16, 'labeled_batch_size': 4, 'workers': 0,
+            'consistency': 1.0, 'epochs': 2, 'lr_rampdown_epochs': 3, 'device': 'cpu', **kwargs})
+        main.args.arch = 'tiny_shakeshake'
+        main.global_step, main.best_prec1 = 0, 0
+        transient_dir = tmpdir.mkdir(name)
+        main.main(Context(transient_dir))
+        return transient_dir
+
+    return run
+
+
+def test_resume_from_step_checkpoint(run_main):
+    # 3 steps per epoch, so the step checkpoint is after the first step of
+    # the second epoch
+    uninterrupted = run_main('uninterrupted', checkpoint_steps=4, workers=2)
+    latest = torch.load(str(uninterrupted.join('checkpoint.latest.ckpt')))
+    assert (latest['epoch'], latest['step_in_epoch']) == (1, 1)
+
+    resumed = run_main('resumed', checkpoint_steps=4, workers=2,
+                       resume=str(uninterrupted.join('checkpoint.latest.ckpt')))
+
+    expected = torch.load(str(uninterrupted.join('checkpoint.2.ckpt')))
+    actual = torch.load(str(resumed.join('checkpoint.2.ckpt')))
+    for key in ['state_dict', 'ema_state_dict']:
+        assert all(torch.equal(tensor, expected[key][name]) for name, tensor in actual[key].items())
+
+
+def test_step_checkpoint_at_the_end_of_an_epoch(run_main):
+    # Without epoch checkpoints, the last step of the epoch is saved after
+    # the evaluation, like an epoch checkpoint
+    transient_dir = run_main('run', epochs=1, checkpoint_steps=3, checkpoint_epochs=0)
+
+    latest = torch.load(str(transient_dir.join('checkpoint.latest.ckpt')))
+    assert latest['epoch'] == 1 and 'step_in_epoch' not in latest
+    assert latest['best_prec1'] == main.best_prec1
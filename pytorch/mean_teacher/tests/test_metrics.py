@@ -0,0 +1,28 @@
+import torch
+
+from ..metrics import topk_precisions, precision_names
+from ..data import NO_LABEL
+
+
+def loop_precisions(logits, target, topk):
+    labeled_minibatch_size = target.ne(NO_LABEL).sum().float()
+    _, pred = logits.topk(max(topk), 1, True, True)
+    correct = pred.t().eq(target.view(1, -1).expand_as(pred.t()))
+    precisions = [correct[:k].reshape(-1).float().sum() * 100.0 / labeled_minibatch_size for k in topk]
+    return torch.stack(precisions + [100.0 - precision for precision in precisions])
+
+
+def test_topk_precisions_of_stacked_logits():
+    torch.manual_seed(0)
+    logits = torch.randn(2, 50, 10)
+    target = torch.randint(0, 10, (50,))
+    target[::7] = NO_LABEL
+
+    precisions = topk_precisions(logits, target, topk=(1, 2, 5))
+
+    assert precisions.size() == (2, 6)
+    for model_logits, model_precisions in zip(logits, precisions):
+        assert torch.allclose(model_precisions, loop_precisions(model_logits, target, (1, 2, 5)))
+        assert torch.allclose(topk_precisions(model_logits, target, topk=(1, 2, 5)), model_precisions)
+    assert precision_names((1, 2, 5), prefix='ema_') == [
+        'ema_top1', 'ema_top2', 'ema_top5', 'ema_error1', 'ema_error2', 'ema_error5']
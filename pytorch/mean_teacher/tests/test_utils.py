@@ -0,0 +1,69 @@
+import random
+
+import numpy as np
+import torch
+
+from ..utils import AverageMeterSet, random_states, set_random_states
+
+
+def test_average_meter_set_accumulates_tensors():
+    meters = AverageMeterSet()
+    meters.update('loss', torch.tensor(2.0), torch.tensor(3))
+    meters.update('loss', torch.tensor(4.0), torch.tensor(1))
+    meters.update('lr', 0.1)
+
+    assert isinstance(meters['loss'].sum, torch.Tensor)
+    meters.synchronize()
+    assert meters['loss'].val == 4.0
+    assert meters['loss'].sum == 10.0
+    assert meters['loss'].count == 4
+    assert meters.averages() == {'loss/avg': 2.5, 'lr/avg': 0.1}
+
+
+def test_average_meter_avg_without_synchronize():
+    meters = AverageMeterSet()
+    meters.update('top1', torch.tensor([50.0]), torch.tensor(2))
+    meters.update('top1', torch.tensor([100.0]), torch.tensor(2))
+
+    assert meters['top1'].avg == 75.0
+    assert '{:.1f}'.format(meters['top1']) == '100.0 (75.0)'
+
+
+def test_average_meter_set_update_many():
+    meters = AverageMeterSet()
+    meters.update_many(['top1', 'top5'], torch.tensor([50.0, 75.0]), torch.tensor(2))
+    meters.update_many(['top1', 'top5'], torch.tensor([100.0, 100.0]), torch.tensor(2))
+    meters.update('loss', torch.tensor(1.0))
+
+    assert meters['top1'].val == 100.0
+    assert '{:.1f}'.format(meters['top5']) == '100.0 (87.5)'
+    meters.synchronize()
+    assert meters.sums() == {'top1/sum': 300.0, 'top5/sum': 350.0, 'loss/sum': 1.0}
+    assert meters.counts() == {'top1/count': 4, 'top5/count': 4, 'loss/count': 1}
+
+    meters.reset()
+    assert meters['top1'].avg == 0
+
+
+def test_average_meter_set_state_dict():
+    meters = AverageMeterSet()
+    meters.update_many(['top1', 'top5'], torch.tensor([50.0, 75.0]), torch.tensor(2))
+    meters.update('loss', torch.tensor(1.0))
+
+    resumed = AverageMeterSet()
+    resumed.load_state_dict(meters.state_dict())
+    for each in [meters, resumed]:
+        each.update_many(['top1', 'top5'], torch.tensor([100.0, 100.0]), torch.tensor(2))
+        each.update('loss', torch.tensor(3.0))
+
+    assert resumed.sums() == meters.sums()
+    assert resumed.averages() == meters.averages() == {'top1/avg': 75.0, 'top5/avg': 87.5, 'loss/avg': 2.0}
+
+
+def test_random_states(tmpdir):
+    torch.save(random_states(), str(tmpdir.join('states.pt')))
+    expected = random.random(), np.random.randint(1000), torch.rand(())
+
+    set_random_states(torch.load(str(tmpdir.join('states.pt')), weights_only=True))
+
+    assert (random.random(), np.random.randint(1000), torch.rand(())) == expected
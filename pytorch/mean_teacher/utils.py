@@ -1,7 +1,11 @@
 """Utility functions and classes"""
 
+import random
 import sys
 
+import numpy as np
+import torch
+
 
 def parameters_string(module):
     lines = [
@@ -45,32 +49,103 @@ class AverageMeterSet:
             self.meters[name] = AverageMeter()
         self.meters[name].update(value, n)
 
+    def update_many(self, names, values, n=1):
+        """Update the meters of the names with the elements of a vector
+
+        The vectors are accumulated by a single AverageVectorMeter, so that
+        updating many meters costs as much as updating one.
+        """
+        names = tuple(names)
+        if not names[0] in self.meters:
+            vector_meter = AverageVectorMeter()
+            for index, name in enumerate(names):
+                assert not name in self.meters, name
+                self.meters[name] = AverageMeterElement(vector_meter, index)
+        vector_meter = self.meters[names[0]].meter
+        vector_meter.update(values, n)
+
     def reset(self):
         for meter in self.meters.values():
             meter.reset()
 
+    def synchronize(self):
+        """Turn the tensors accumulated by the meters into numbers
+
+        Copies the tensors of each device to the host in a single transfer.
+        """
+        meters = {id(meter): meter for meter in
+                  (getattr(meter, 'meter', meter) for meter in self.meters.values())}
+        fields_by_device = {}
+        for meter in meters.values():
+            for field in AverageMeter.FIELDS:
+                value = getattr(meter, field)
+                if isinstance(value, torch.Tensor):
+                    fields_by_device.setdefault(value.device, []).append((meter, field, value))
+        for fields in fields_by_device.values():
+            numbers = torch.cat([value.detach().reshape(-1).float() for _, _, value in fields]).tolist()
+            offset = 0
+            for meter, field, value in fields:
+                setattr(meter, field, meter.from_numbers(field, numbers[offset:offset + value.numel()]))
+                offset += value.numel()
+
+    def state_dict(self):
+        self.synchronize()
+        meters, vector_meters = {}, {}
+        for name, meter in self.meters.items():
+            if isinstance(meter, AverageMeterElement):
+                names, _ = vector_meters.setdefault(id(meter.meter), ([], meter.meter))
+                names.append(name)
+            else:
+                meters[name] = {field: getattr(meter, field) for field in AverageMeter.FIELDS}
+        return {
+            'meters': meters,
+            'vector_meters': [(names, {field: getattr(meter, field) for field in AverageMeter.FIELDS})
+                              for names, meter in vector_meters.values()],
+        }
+
+    def load_state_dict(self, state_dict):
+        self.meters = {}
+        for name, fields in state_dict['meters'].items():
+            self.meters[name] = AverageMeter()
+            self.meters[name].__dict__.update(fields)
+        for names, fields in state_dict['vector_meters']:
+            vector_meter = AverageVectorMeter()
+            vector_meter.__dict__.update(fields)
+            for index, name in enumerate(names):
+                self.meters[name] = AverageMeterElement(vector_meter, index)
+
     def values(self, postfix=''):
+        self.synchronize()
         return {name + postfix: meter.val for name, meter in self.meters.items()}
 
     def averages(self, postfix='/avg'):
+        self.synchronize()
         return {name + postfix: meter.avg for name, meter in self.meters.items()}
 
     def sums(self, postfix='/sum'):
+        self.synchronize()
         return {name + postfix: meter.sum for name, meter in self.meters.items()}
 
     def counts(self, postfix='/count'):
+        self.synchronize()
         return {name + postfix: meter.count for name, meter in self.meters.items()}
 
 
 class AverageMeter:
-    """Computes and stores the average and current value"""
+    """Computes and stores the average and current value
+
+    The values and counts can be tensors. They are then accumulated on
+    their device without waiting for it, until AverageMeterSet.synchronize
+    is called or the average is read.
+    """
+
+    FIELDS = ('val', 'sum', 'count')
 
     def __init__(self):
         self.reset()
 
     def reset(self):
         self.val = 0
-        self.avg = 0
         self.sum = 0
         self.count = 0
 
@@ -78,12 +153,103 @@ class AverageMeter:
         self.val = val
         self.sum += val * n
         self.count += n
-        self.avg = self.sum / self.count
+
+    @property
+    def avg(self):
+        self.materialize()
+        return self.sum / self.count if self.count else 0
+
+    def materialize(self):
+        for field in self.FIELDS:
+            value = getattr(self, field)
+            if isinstance(value, torch.Tensor):
+                setattr(self, field, self.from_numbers(field, value.reshape(-1).tolist()))
+
+    @staticmethod
+    def from_numbers(field, numbers):
+        number, = numbers
+        return number
 
     def __format__(self, format):
         return "{self.val:{format}} ({self.avg:{format}})".format(self=self, format=format)
 
 
+class AverageVectorMeter(AverageMeter):
+    """AverageMeter of vectors, read through an AverageMeterElement per element"""
+
+    def update(self, val, n=1):
+        if isinstance(self.sum, list):
+            # Back from the numbers of a synchronize
+            self.sum = torch.tensor(self.sum, dtype=val.dtype, device=val.device)
+        super().update(val, n)
+
+    @property
+    def avg(self):
+        raise TypeError('read the averages of the elements')
+
+    @staticmethod
+    def from_numbers(field, numbers):
+        # The counts are shared by the elements
+        return AverageMeter.from_numbers(field, numbers) if field == 'count' else numbers
+
+
+class AverageMeterElement:
+    """An element of an AverageVectorMeter, read like an AverageMeter"""
+
+    def __init__(self, meter, index):
+        self.meter = meter
+        self.index = index
+
+    def _element(self, value):
+        return value[self.index] if isinstance(value, (list, torch.Tensor)) else value
+
+    @property
+    def val(self):
+        return self._element(self.meter.val)
+
+    @property
+    def sum(self):
+        return self._element(self.meter.sum)
+
+    @property
+    def count(self):
+        return self.meter.count
+
+    @property
+    def avg(self):
+        self.meter.materialize()
+        return self.sum / self.count if self.count else 0
+
+    def reset(self):
+        self.meter.reset()
+
+    __format__ = AverageMeter.__format__
+
+
+def random_states():
+    """The states of the Python, NumPy and torch random number generators
+
+    Only made of tensors and Python numbers, so that checkpoints holding
+    them load with torch.load(weights_only=True).
+    """
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return {
+        'python': random.getstate(),
+        'numpy': (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def set_random_states(states):
+    random.setstate(states['python'])
+    name, keys, pos, has_gauss, cached_gaussian = states['numpy']
+    np.random.set_state((name, keys.cpu().numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(states['torch'].cpu())
+    if states['cuda']:
+        torch.cuda.set_rng_state_all([state.cpu() for state in states['cuda']])
+
+
 def export(fn):
     mod = sys.modules[fn.__module__]
     if hasattr(mod, '__all__'):
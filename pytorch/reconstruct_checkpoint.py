@@ -0,0 +1,18 @@
+"""Write a checkpoint of a --checkpoint-store as a standard, self-contained checkpoint
+
+Usage: python reconstruct_checkpoint.py STORED_CHECKPOINT OUTPUT
+
+The tensors are read from the store next to STORED_CHECKPOINT. main.py
+--resume also reads such checkpoints directly, but OUTPUT can be copied
+elsewhere and loaded with torch.load.
+"""
+
+import sys
+
+from mean_teacher import checkpoints
+
+
+if __name__ == '__main__':
+    stored_path, output_path = sys.argv[1:]
+    checkpoints.atomic_save(checkpoints.load_checkpoint(stored_path, map_location='cpu'), output_path)
+    print("Wrote {} to {}".format(stored_path, output_path))